@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Fake OpenAI-compatible chat server for benchmarking gen_proof.py / pipeline.py
+without a GPU.
+
+For every request it pulls the lemma out of the prompt (the last `Input:`
+section) and answers with an ```isabelle block restating it plus a one-line
+proof; with probability 1 - --pass-rate the proof contains `bench_fail`, which
+bench/bin/isabelle rejects. After the block it keeps "rambling" for
+--ramble-tokens tokens, so fence-aware stopping has something to save.
+
+Timing model per request: wait for one of --slots decode slots (the server's
+batch size), then TTFT drawn from --latency, then completion tokens at
+--token-rate tokens/s (per request, streamed in small chunks with stream=True).
+--error-rate answers with a random status from --error-codes instead.
+
+Supports POST /v1/chat/completions (n, max_tokens, stream, stream_options
+include_usage / continuous_usage_stats) and GET /v1/models.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHUNK_TOKENS = 8
+LEMMA_RE = re.compile(r"Input:\n(.*?)\n\n(?:Output:|Goal:|Previous attempt:)", re.S)
+
+
+def sample_latency(spec: str) -> float:
+    """`const:S`, `uniform:A,B`, `lognormal:MEDIAN,SIGMA` or `exp:MEAN` (seconds)."""
+    kind, _, params = spec.partition(":")
+    p = [float(x) for x in params.split(",")] if params else []
+    if kind == "const":
+        return p[0]
+    if kind == "uniform":
+        return random.uniform(p[0], p[1])
+    if kind == "lognormal":
+        return random.lognormvariate(0, p[1]) * p[0]
+    if kind == "exp":
+        return random.expovariate(1 / p[0])
+    raise ValueError(f"unknown latency distribution {spec!r}")
+
+
+def n_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    cfg = None
+    slots = None
+    stats = {"requests": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def log_message(self, *a):
+        pass
+
+    def _json(self, code: int, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._json(200, {"object": "list", "data": [{"id": self.cfg.model, "object": "model"}]})
+        else:
+            self._json(404, {"error": "not found"})
+
+    def answer(self, prompt: str) -> str:
+        m = None
+        for m in LEMMA_RE.finditer(prompt):
+            pass
+        lemma = m.group(1).strip() if m else "lemma bench_unknown: \"True\""
+        proof = "by simp" if random.random() < self.cfg.pass_rate else "by (simp add: bench_fail)"
+        return f"```isabelle\n{lemma}\n  {proof}\n```"
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        cfg = self.cfg
+        with self.lock:
+            self.stats["requests"] += 1
+        if random.random() < cfg.error_rate:
+            with self.lock:
+                self.stats["errors"] += 1
+            time.sleep(sample_latency(cfg.latency) * 0.1)
+            self._json(random.choice(cfg.error_codes), {"error": {"message": "injected error"}})
+            return
+
+        prompt = req["messages"][-1]["content"]
+        n = req.get("n") or 1
+        max_tokens = req.get("max_tokens")
+        ramble = "\nThis proof works because the simplifier closes the goal." * (cfg.ramble_tokens // 12 + 1)
+        texts, finish = [], []
+        for _ in range(n):
+            full = self.answer(prompt) + "\n" + ramble[:cfg.ramble_tokens * 4]
+            if max_tokens is not None and n_tokens(full) > max_tokens:
+                texts.append(full[:max_tokens * 4])
+                finish.append("length")
+            else:
+                texts.append(full)
+                finish.append("stop")
+        prompt_tokens = n_tokens(prompt)
+
+        with self.slots:
+            time.sleep(sample_latency(cfg.latency))
+            if req.get("stream"):
+                self.stream(req, texts, finish, prompt_tokens)
+            else:
+                time.sleep(max(n_tokens(t) for t in texts) / cfg.token_rate)
+                completion = sum(n_tokens(t) for t in texts)
+                self._json(200, {
+                    "id": "bench", "object": "chat.completion", "created": int(time.time()), "model": cfg.model,
+                    "choices": [{"index": i, "message": {"role": "assistant", "content": t}, "finish_reason": f}
+                                for i, (t, f) in enumerate(zip(texts, finish))],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion,
+                              "total_tokens": prompt_tokens + completion},
+                })
+
+    def stream(self, req, texts, finish, prompt_tokens):
+        opts = req.get("stream_options") or {}
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        sent = 0
+
+        def event(choices, usage=None):
+            obj = {"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": self.cfg.model,
+                   "choices": choices}
+            if usage is not None:
+                obj["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(obj)}\n\n".encode())
+
+        def usage():
+            return {"prompt_tokens": prompt_tokens, "completion_tokens": sent, "total_tokens": prompt_tokens + sent}
+
+        try:
+            pos = [0] * len(texts)
+            while any(p < len(t) for p, t in zip(pos, texts)):
+                time.sleep(CHUNK_TOKENS / self.cfg.token_rate)
+                for i, t in enumerate(texts):
+                    if pos[i] >= len(t):
+                        continue
+                    piece = t[pos[i]:pos[i] + CHUNK_TOKENS * 4]
+                    pos[i] += len(piece)
+                    sent += n_tokens(piece)
+                    done = pos[i] >= len(t)
+                    event([{"index": i, "delta": {"content": piece}, "finish_reason": finish[i] if done else None}],
+                          usage() if opts.get("continuous_usage_stats") else None)
+                self.wfile.flush()
+            if opts.get("include_usage"):
+                event([], usage())
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass    # client closed the stream early (fence stop)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8004)
+    ap.add_argument("--model", default="bench-model")
+    ap.add_argument("--latency", default="lognormal:0.2,0.5", help="TTFT distribution (see sample_latency)")
+    ap.add_argument("--token-rate", type=float, default=500.0, help="decode speed per request, tokens/s")
+    ap.add_argument("--slots", type=int, default=256, help="requests decoded at once; the rest queue")
+    ap.add_argument("--pass-rate", type=float, default=0.5, help="fraction of answers with a passing proof")
+    ap.add_argument("--ramble-tokens", type=int, default=200, help="tokens generated after the closing fence")
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--error-codes", type=lambda s: [int(x) for x in s.split(",")], default=[429, 503])
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args()
+
+    random.seed(args.seed)
+    Handler.cfg = args
+    Handler.slots = threading.BoundedSemaphore(args.slots)
+    ThreadingHTTPServer.request_queue_size = 4096
+    ThreadingHTTPServer.daemon_threads = True
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"mock OpenAI server on http://{args.host}:{server.server_port}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Hermetic end-to-end benchmark of gen_proof.py and eval.py.
+
+Creates a synthetic Isabelle project (one session `Bench`, one theory with
+--lemmas trivial lemmas) and the matching dataset, starts
+bench/mock_openai_server.py, puts the fake bench/bin/isabelle first on PATH,
+and runs gen_proof.py followed by eval.py on it. Reports wall time,
+throughput and the peak RSS of each script (from wait4), plus p50/p95
+latencies from their --metrics output. Each run is appended to --results so
+scheduler or caching changes can be compared across runs with --label.
+
+Usage:
+  python3 bench/run_bench.py --lemmas 10000 --samples 2 --label baseline
+  python3 bench/run_bench.py --lemmas 10000 --samples 2 --label batch \
+      --eval-args "--batch --workers 4 --target_only"
+"""
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from metrics import summarize  # noqa: E402
+
+
+def make_dataset(workdir: Path, n: int) -> tuple[Path, Path]:
+    """Writes project/ROOT, project/Bench.thy and lemmas.jsonl; returns (thy path, dataset path)."""
+    project = workdir / "project"
+    project.mkdir(parents=True, exist_ok=True)
+    (project / "ROOT").write_text("session Bench = HOL +\n  theories\n    Bench\n", encoding="utf-8")
+    thy = project / "Bench.thy"
+    data = workdir / "lemmas.jsonl"
+    with thy.open("w", encoding="utf-8") as ft, data.open("w", encoding="utf-8") as fd:
+        ft.write("theory Bench\n  imports Main\nbegin\n\n")
+        for i in range(n):
+            stmt = f'lemma bench_{i}:\n  "bench_c{i % 97} (x{i} :: nat) = bench_c{i % 97} x{i}"'
+            ft.write(f"{stmt}\n  by simp\n\n")
+            fd.write(json.dumps({"input": stmt, "gt": "by simp"}) + "\n")
+        ft.write("end\n")
+    return thy, data
+
+
+def start_mock(args, workdir: Path) -> tuple[subprocess.Popen, str]:
+    cmd = [sys.executable, str(BENCH_DIR / "mock_openai_server.py"), "--port", "0",
+           "--latency", args.latency, "--token-rate", str(args.token_rate), "--slots", str(args.slots),
+           "--pass-rate", str(args.pass_rate), "--error-rate", str(args.error_rate)]
+    cmd += shlex.split(args.mock_args)
+    log = (workdir / "mock.log").open("w")
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log, text=True)
+    banner = proc.stdout.readline()
+    if "http://" not in banner:
+        proc.kill()
+        sys.exit(f"mock server did not start: {banner!r} (see {workdir / 'mock.log'})")
+    return proc, banner.split()[-1]
+
+
+def run_stage(name: str, cmd: list[str], env: dict, workdir: Path) -> dict:
+    """Runs one script, returning wall time, exit code and its own peak RSS."""
+    print(f"[bench] {name}: {' '.join(shlex.quote(c) for c in cmd)}", file=sys.stderr)
+    log = (workdir / f"{name}.log").open("w")
+    t0 = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=REPO_DIR)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.monotonic() - t0
+    if proc.returncode != 0:
+        print(f"[bench] {name} exited with {proc.returncode}, see {workdir / (name + '.log')}", file=sys.stderr)
+    return {"wall_s": round(wall, 3), "returncode": proc.returncode, "max_rss_mb": round(rusage.ru_maxrss / 1024, 1)}
+
+
+def count_lines(path: Path, pred=lambda r: True) -> int:
+    n = 0
+    if path.exists():
+        with path.open(encoding="utf-8") as f:
+            for line in f:
+                try:
+                    n += bool(pred(json.loads(line)))
+                except ValueError:
+                    pass
+    return n
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Hermetic gen_proof.py + eval.py benchmark")
+    ap.add_argument("--lemmas", type=int, default=1000, help="synthetic lemmas (10 to 100k)")
+    ap.add_argument("--samples", type=int, default=1)
+    ap.add_argument("--label", default="", help="name of this configuration in --results")
+    ap.add_argument("--workdir", default=None, help="keep data, outputs and logs here (default: temp dir)")
+    ap.add_argument("--results", default=str(BENCH_DIR / "results.jsonl"), help="append the run summary here")
+    # mock LLM server
+    ap.add_argument("--latency", default="lognormal:0.2,0.5")
+    ap.add_argument("--token-rate", type=float, default=500.0)
+    ap.add_argument("--slots", type=int, default=256)
+    ap.add_argument("--pass-rate", type=float, default=0.5)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--mock-args", default="", help="extra mock_openai_server.py arguments")
+    # fake isabelle
+    ap.add_argument("--build-time", type=float, default=0.05, help="fixed seconds per fake build")
+    ap.add_argument("--proof-time", type=float, default=0.0002, help="seconds per checked proof")
+    ap.add_argument("--build-mem-mb", type=float, default=64)
+    # scripts under test
+    ap.add_argument("--gen-args", default="", help="extra gen_proof.py arguments")
+    ap.add_argument("--eval-args", default="", help="extra eval.py arguments")
+    ap.add_argument("--skip-eval", action="store_true")
+    args = ap.parse_args()
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="proof_gen_bench_"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    for f in ("gen.jsonl", "report.jsonl", "gen_metrics.jsonl", "eval_metrics.jsonl"):
+        (workdir / f).unlink(missing_ok=True)
+    thy, data = make_dataset(workdir, args.lemmas)
+
+    env = dict(os.environ)
+    env["PATH"] = f"{BENCH_DIR / 'bin'}{os.pathsep}{env.get('PATH', '')}"
+    env["FAKE_ISABELLE_BUILD_TIME"] = str(args.build_time)
+    env["FAKE_ISABELLE_PROOF_TIME"] = str(args.proof_time)
+    env["FAKE_ISABELLE_MEM_MB"] = str(args.build_mem_mb)
+
+    mock, url = start_mock(args, workdir)
+    result = {"label": args.label, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "lemmas": args.lemmas,
+              "samples": args.samples, "gen_args": args.gen_args, "eval_args": args.eval_args}
+    try:
+        gen_out = workdir / "gen.jsonl"
+        result["gen"] = run_stage("gen", [
+            sys.executable, str(REPO_DIR / "gen_proof.py"), "-i", str(data), "-o", str(gen_out),
+            "--base-url", url, "-m", "bench-model", "--shots", "0", "-s", str(args.samples),
+            "--metrics", str(workdir / "gen_metrics.jsonl"), *shlex.split(args.gen_args)], env, workdir)
+    finally:
+        mock.terminate()
+        mock.wait()
+    g = summarize([str(workdir / "gen_metrics.jsonl")]) if (workdir / "gen_metrics.jsonl").exists() else {}
+    result["gen"].update({
+        "records": count_lines(gen_out),
+        "lemmas_per_s": round(args.lemmas / result["gen"]["wall_s"], 2),
+        "requests": g.get("llm_requests"),
+        "completion_tokens": g.get("completion_tokens"),
+        "latency_p50_s": (g.get("latency_s") or {}).get("p50"),
+        "latency_p95_s": (g.get("latency_s") or {}).get("p95"),
+    })
+
+    if not args.skip_eval:
+        report = workdir / "report.jsonl"
+        result["eval"] = run_stage("eval", [
+            sys.executable, str(REPO_DIR / "eval.py"), "--jsonl", str(gen_out), "--thy", str(thy),
+            "--session", "Bench", "--root", str(thy.parent), "--out", str(report),
+            "--metrics", str(workdir / "eval_metrics.jsonl"), *shlex.split(args.eval_args)], env, workdir)
+        e = summarize([str(workdir / "eval_metrics.jsonl")]) if (workdir / "eval_metrics.jsonl").exists() else {}
+        candidates = count_lines(report, lambda r: "success" in r or "error" in r)
+        result["eval"].update({
+            "candidates": candidates,
+            "successes": count_lines(report, lambda r: r.get("success")),
+            "candidates_per_s": round(candidates / result["eval"]["wall_s"], 2),
+            "builds": e.get("builds"),
+            "build_p50_s": (e.get("build_wall_s") or {}).get("p50"),
+            "build_p95_s": (e.get("build_wall_s") or {}).get("p95"),
+            "build_max_rss_kb": e.get("max_peak_rss_kb"),
+        })
+
+    with open(args.results, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result) + "\n")
+    print(json.dumps(result, indent=2))
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Deduplication and ranking of proof candidates before verification.
+
+With several samples and variants per lemma many candidates are the same
+proof up to layout. `canonical_key` maps a candidate to a form where
+comments are dropped, whitespace is collapsed (and removed inside brackets
+and around punctuation) and the facts of simpset modifiers (`simp add:`,
+`simp del:`, `simp only:`, `simp:`, `split:`, `cong:`) are sorted; the
+order of other facts (`intro:`, `wp:`, ...) is kept. `rank_candidates`
+collapses candidates of one lemma with the same key and orders the unique
+ones by
+  1. agreement: how many candidates (over samples and variants) share the key,
+  2. the smoothed success rate of its proof methods in a TacticHistory,
+  3. proof length in tokens (shorter first),
+  4. first appearance.
+Only the first candidate of each group is built; its verdict applies to the
+rest.
+
+TacticHistory is a small JSON file of per-method [tried, succeeded] counts
+that eval.py updates after every run (--tactic_history).
+"""
+
+import json
+import os
+import re
+import threading
+
+STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"|`(?:[^`\\]|\\.)*`|\\<open>.*?\\<close>', re.S)
+COMMENT_RE = re.compile(r"\(\*.*?\*\)", re.S)
+# spaces that never matter: inside brackets, around `, ; |`, before an attribute list
+SPACE_RES = [
+    (re.compile(r"([(\[])\s+"), r"\1"),
+    (re.compile(r"\s+([)\]])"), r"\1"),
+    (re.compile(r"\s*([,;|])\s*"), r"\1"),
+    (re.compile(r"\s+\["), "["),
+    (re.compile(r"\)\("), ") ("),
+]
+# modifiers that add to (or replace) the simpset, whose facts' order does not matter; intro:/dest:/elim:/wp:
+# and friends are left alone, since their order decides which rule is tried first
+SET_MODIFIER_RE = re.compile(r"(?<![\w'])((?:simp(?: (?:add|del|only))?|split|cong):)")
+METHOD_RE = re.compile(r"(?:(?<![\w'])(?:by|apply|applyS|apply_end|proof)|[(,;|])\s*\(?([a-z_][\w']*)(?![\w':])")
+TOKEN_RE = re.compile(r"[\w'.]+|\S")
+NOT_METHODS = {"of", "OF", "where", "THEN", "symmetric", "simplified", "rotated"}
+
+_save_lock = threading.Lock()
+
+
+def _strip_comments(code: str) -> str:
+    # comments are dropped outside strings only; strings are kept intact
+    out, pos = [], 0
+    for m in STRING_RE.finditer(code):
+        out.append(COMMENT_RE.sub(" ", code[pos:m.start()]))
+        out.append(m.group(0))
+        pos = m.end()
+    out.append(COMMENT_RE.sub(" ", code[pos:]))
+    return "".join(out)
+
+
+def _sort_modifier_facts(text: str) -> str:
+    """Sorts the facts after each simpset modifier, up to the next modifier or the end of the method."""
+    out, i = [], 0
+    for m in SET_MODIFIER_RE.finditer(text):
+        if m.start() < i:
+            continue
+        # facts are separated by spaces at bracket depth 0 and end at `)|;,` or at the next `name:` modifier
+        facts, depth, start, j = [], 0, m.end(), m.end()
+        while True:
+            ch = text[j] if j < len(text) else ")"
+            if depth == 0 and ch in " )|;,":
+                fact = text[start:j]
+                if fact.endswith(":"):
+                    j = start
+                    break
+                if fact:
+                    facts.append(fact)
+                if ch != " ":
+                    break
+                start = j + 1
+            else:
+                depth += (ch in "([") - (ch in ")]")
+            j += 1
+        out.append(text[i:m.end()] + " " + " ".join(sorted(dict.fromkeys(facts))))
+        if j < len(text) and text[j] not in ")|;,":
+            out.append(" ")
+        i = min(j, len(text))
+    out.append(text[i:])
+    return "".join(out)
+
+
+def canonical_key(code: str) -> str:
+    """Layout-insensitive form of a candidate; equal keys are checked once."""
+    parts, pos = [], 0
+    code = _strip_comments(code)
+    for m in STRING_RE.finditer(code):
+        parts.append(("code", code[pos:m.start()]))
+        parts.append(("str", " ".join(m.group(0).split())))
+        pos = m.end()
+    parts.append(("code", code[pos:]))
+    out = []
+    for kind, s in parts:
+        if kind == "code":
+            s = re.sub(r"\s+", " ", s)
+            for rx, repl in SPACE_RES:
+                s = rx.sub(repl, s)
+            s = _sort_modifier_facts(s)
+        out.append(s)
+    return "".join(out).strip()
+
+
+def proof_methods(code: str) -> set[str]:
+    """Proof method names used in a candidate (`by (auto simp: ...)` -> auto), strings ignored."""
+    text = STRING_RE.sub('""', _strip_comments(code))
+    return {m.group(1) for m in METHOD_RE.finditer(text) if m.group(1) not in NOT_METHODS}
+
+
+class TacticHistory:
+    """
+    Per-method [tried, succeeded] counts, persisted as JSON. `save` adds the
+    counts recorded since loading to whatever the file holds by then, so
+    concurrent runs (or sessions) do not overwrite each other.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self.counts: dict[str, list[int]] = self._load() if path else {}
+        self.new: dict[str, list[int]] = {}
+
+    def _load(self) -> dict[str, list[int]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return {k: list(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def rate(self, methods: set[str]) -> float:
+        """Mean Laplace-smoothed success rate of `methods` (0.5 when nothing is known)."""
+        if not methods:
+            return 0.5
+        total = 0.0
+        for m in methods:
+            tried, ok = self.counts.get(m, (0, 0))
+            total += (ok + 1) / (tried + 2)
+        return total / len(methods)
+
+    def record(self, code: str, success: bool):
+        for m in proof_methods(code):
+            for table in (self.counts, self.new):
+                c = table.setdefault(m, [0, 0])
+                c[0] += 1
+                c[1] += bool(success)
+
+    def save(self):
+        if not self.path or not self.new:
+            return
+        with _save_lock:
+            counts = self._load()
+            for m, (tried, ok) in self.new.items():
+                c = counts.setdefault(m, [0, 0])
+                c[0] += tried
+                c[1] += ok
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(counts, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+            self.new = {}
+
+
+def rank_candidates(cands: list[dict], history: TacticHistory | None = None) -> list[dict]:
+    """
+    Groups candidates (dicts with "code") of one lemma by canonical_key and
+    returns one dict per group, best first:
+      {"rep": first candidate, "members": [all candidates], "key", "agreement", "tactic_rate", "tokens"}
+    """
+    history = history or TacticHistory()
+    groups: dict[str, dict] = {}
+    for c in cands:
+        key = canonical_key(c["code"])
+        g = groups.get(key)
+        if g is None:
+            groups[key] = {"rep": c, "members": [c], "key": key, "first": len(groups)}
+        else:
+            g["members"].append(c)
+    for g in groups.values():
+        g["agreement"] = len(g["members"])
+        g["tactic_rate"] = round(history.rate(proof_methods(g["rep"]["code"])), 3)
+        g["tokens"] = len(TOKEN_RE.findall(g["key"]))
+    # the rate is bucketed to 0.1 so that length still decides between near-equal histories
+    ranked = sorted(groups.values(),
+                    key=lambda g: (-g["agreement"], -round(g["tactic_rate"], 1), g["tokens"], g["first"]))
+    for g in ranked:
+        del g["first"]
+    return ranked
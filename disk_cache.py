@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Small content-addressed JSON cache on disk.
+
+Entries live in sharded files `<dir>/<key[:2]>/<key>.json`. Every hit touches
+the file's mtime, and when the total size goes over `max_bytes` the least
+recently used entries are deleted until the cache is back under 90% of the cap.
+Writes go through a temp file + rename, so concurrent readers (threads or other
+processes sharing the directory) never see a partial entry.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+
+def cache_key(*parts) -> str:
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(str(p).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class DiskCache:
+    def __init__(self, path, max_bytes: int = 512 * 1024 * 1024):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = sum(f.stat().st_size for f in self.path.glob("*/*.json"))
+
+    def _file(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.json"
+
+    def get(self, key: str):
+        f = self._file(key)
+        try:
+            value = json.loads(f.read_text(encoding="utf-8"))
+            os.utime(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value):
+        f = self._file(key)
+        f.parent.mkdir(exist_ok=True)
+        data = json.dumps(value, ensure_ascii=False)
+        tmp = f.with_name(f".{f.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(data, encoding="utf-8")
+        old = f.stat().st_size if f.exists() else 0
+        os.replace(tmp, f)
+        with self._lock:
+            self._size += len(data.encode("utf-8")) - old
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = []
+        for f in self.path.glob("*/*.json"):
+            try:
+                st = f.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, f))
+        entries.sort()
+        size = sum(e[1] for e in entries)
+        target = int(self.max_bytes * 0.9)
+        for _, sz, f in entries:
+            if size <= target:
+                break
+            f.unlink(missing_ok=True)
+            size -= sz
+        self._size = size
@@ -19,39 +19,89 @@ Batch runner to test multiple LLM-generated Isabelle lemma variants.
     isabelle build -d <ROOT> -b <SESSION>
   collects success/failure, and restores the file to its original state after each attempt.
 
+- With --backend server, one long-lived `isabelle server` keeps the session heap
+  loaded and each patched theory is checked with `use_theories` instead of a full
+  build. If the server cannot be started, the build backend is used instead.
+
 Usage:
   python3 try_lemma_variants.py \
       --jsonl ./results.jsonl \
       --thy ./CorresK_Lemmas.thy \
       --session CorresK \
       --root . \
-      --out ./build_report.jsonl
+      --out ./build_report.jsonl \
+      [--backend server --server_session CorresK]
+
+- With --rank, duplicate candidates of a lemma (across lines and variants,
+  up to layout and simp-argument order) are built once and the unique ones
+  are checked best first; see candidate_rank.py.
+
+- Without --thy, lines may span many theories and sessions: each line is
+  routed by its `file`/`session` fields (see extract_lemmas.py) or by a lemma
+  index over --root and the ROOT files, parent heaps are built once, and
+  sessions are evaluated in dependency order (--session_jobs in parallel):
+  python3 eval.py --jsonl ./l4v_results.jsonl --root ~/l4v --session_jobs 2 --out ./build_report.jsonl
 """
 
 import argparse
+import itertools
 import json
+import os
+import queue
 import re
+import shutil
+import signal
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime
 from pathlib import Path
 
+from candidate_rank import TacticHistory, rank_candidates
+from disk_cache import DiskCache, cache_key
+from isabelle_root import Session, ancestors, find_sessions, find_theories, session_of_file
+from isabelle_server import IsabelleServer, IsabelleServerError
+from metrics import Metrics
+from prefilter import reject_reason
+from thy_index import ThyIndex, build_index, iter_goal_blocks, sorry_proofs
+
 VARIANT_KEYS = ["baseline_output", "cot_output"]
 
 CODE_FENCE_RE = re.compile(r"```isabelle\s*(.*?)```", re.S)
-LEMMA_NAME_RE = re.compile(r"\blemma\s+([A-Za-z0-9_']+)")
-# Matches from "lemma <name>" up to next "lemma <something>" OR "end" at start of line.
-LEMMA_BLOCK_RE_TMPL = r"(?s)(^|\n)(lemma\s+{name}\b.*?)(?=\nlemma\s|\nend\s*$)"
+LEMMA_NAME_RE = re.compile(r"\b(?:lemma|theorem|corollary|proposition|schematic_goal)\s+"
+                           r"(?:\(\s*in\s+[\w'.]+\s*\)\s*)?([A-Za-z0-9_']+)")
+# Isabelle message positions, e.g. `*** At command "by" (line 45 of "~~/lib/CorresK/CorresK_Lemmas.thy")`
+ERROR_POS_RE = re.compile(r'\(line (\d+) of "([^"]*)"')
+AT_COMMAND_RE = re.compile(r'^At command "([^"]+)" \(line (\d+) of "([^"]*)"\)')
+THEORY_HEADER_RE_TMPL = r"(?m)^(\s*theory\s+)\"?{name}\"?"
+RANK_FIELDS = ("rank", "agreement", "tactic_rate", "duplicate_of")
 
 def extract_isabelle_code(s: str) -> str:
     if not s:
         return ""
     m = CODE_FENCE_RE.search(s)
     code = m.group(1) if m else s
-    print(code)
     return code.strip()
 
+def normalize_candidate(code: str) -> str:
+    """
+    Cleans an extracted proof block before it is patched in: CRLF, trailing
+    whitespace, blank lines and stray code-fence lines. None of these change
+    what Isabelle checks, but they would defeat result caching.
+    """
+    lines = []
+    for l in code.replace("\r\n", "\n").split("\n"):
+        l = l.rstrip()
+        if not l.strip() or l.lstrip().startswith("```"):
+            continue
+        lines.append(l)
+    return "\n".join(lines)
+
 def lemma_name_from_code(code: str) -> str | None:
     m = LEMMA_NAME_RE.search(code)
     return m.group(1) if m else None
@@ -62,192 +112,1105 @@ def lemma_name_from_input(inp: str) -> str | None:
     m = LEMMA_NAME_RE.search(inp)
     return m.group(1) if m else None
 
-def replace_lemma_block(thy_text: str, lemma_name: str, new_block: str) -> tuple[str, bool]:
-    """
-    Replace the lemma block named `lemma_name` with `new_block`.
-    Returns (new_text, replaced?)
-    """
-    pattern = re.compile(LEMMA_BLOCK_RE_TMPL.format(name=re.escape(lemma_name)))
-    m = pattern.search(thy_text)
-    if not m:
-        return thy_text, False
+def _group_rss_kb(pgid: int) -> int:
+    """Resident memory (kB) summed over all processes in process group `pgid`."""
+    total = 0
+    page_kb = os.sysconf("SC_PAGE_SIZE") // 1024
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat", "rb") as f:
+                fields = f.read().rsplit(b")", 1)[1].split()
+            if int(fields[2]) != pgid:
+                continue
+            with open(f"/proc/{entry.name}/statm", "rb") as f:
+                total += int(f.read().split()[1]) * page_kb
+        except (OSError, IndexError, ValueError):
+            continue
+    return total
 
-    prefix = thy_text[:m.start(2)]
-    suffix = thy_text[m.end(2):]
-    # Ensure new block ends with a newline
-    if not new_block.endswith("\n"):
-        new_block = new_block + "\n"
-    return prefix + new_block + suffix, True
+def _kill_group(proc: subprocess.Popen):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
 
-def run_isabelle_build(root: Path, session: str, extra_args: list[str] | None = None, timeout: int = 1800):
-    cmd = ["isabelle", "build", "-d", str(root), "-b", session]
+def run_isabelle_build(root: Path, session: str | list[str], extra_args: list[str] | None = None, timeout: int = 1800,
+                       build_heap: bool = True, mem_limit_gb: float | None = None, stats: dict | None = None):
+    """
+    Runs `isabelle build` in its own process group so that a timeout (or the
+    optional `mem_limit_gb` cap on the group's resident memory) kills the
+    Poly/ML children too, not just the `isabelle` wrapper script.
+    The group's peak resident memory (sampled up to once a second) goes to
+    stats["peak_rss_kb"] if `stats` is given.
+    """
+    cmd = ["isabelle", "build", "-d", str(root)]
+    if build_heap:
+        cmd.append("-b")
     if extra_args:
         cmd.extend(extra_args)
-    proc = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
-    return proc.returncode, proc.stdout, proc.stderr
+    cmd.extend([session] if isinstance(session, str) else session)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                            start_new_session=True)
+
+    oom = threading.Event()
+    peak = [0]
+    if mem_limit_gb or stats is not None:
+        limit_kb = int(mem_limit_gb * 1024 * 1024) if mem_limit_gb else None
+
+        def watchdog():
+            delay = 0.05    # sample short builds too, then settle at once a second
+            while proc.poll() is None:
+                rss = _group_rss_kb(proc.pid)
+                peak[0] = max(peak[0], rss)
+                if limit_kb and rss > limit_kb:
+                    oom.set()
+                    _kill_group(proc)
+                    return
+                time.sleep(delay)
+                delay = min(1.0, delay * 2)
+
+        threading.Thread(target=watchdog, daemon=True).start()
+
+    try:
+        out, err = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_group(proc)
+        proc.communicate()
+        raise
+    finally:
+        if stats is not None:
+            stats["peak_rss_kb"] = peak[0]
+    if oom.is_set():
+        err += f"\n[eval] build killed: resident memory exceeded {mem_limit_gb} GB\n"
+    return proc.returncode, out, err
+
+def _atomic_write(path: Path, text: str):
+    """Write via rename, so a hardlinked scratch copy never writes through to the original inode."""
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
+def make_scratch_tree(root: Path, dest: Path) -> Path:
+    """
+    Mirror `root` into `dest` with hardlinks (falling back to copies across
+    devices). Patched files are replaced via rename, never written in place,
+    so the shared tree stays untouched.
+    """
+    def link_or_copy(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    shutil.copytree(root, dest, symlinks=True, copy_function=link_or_copy,
+                    ignore=shutil.ignore_patterns(".git"))
+    return dest
+
+class BuildChecker:
+    """
+    Writes the patched theory over `thy_path`, runs `isabelle build` for the
+    whole session and restores the original text afterwards.
+    """
+    backend = "build"
+
+    def __init__(self, thy_path: Path, root: Path, session: str, timeout: int = 1800,
+                 build_heap: bool = True, threads: int | None = None, mem_limit_gb: float | None = None):
+        self.thy_path = thy_path
+        self.root = root
+        self.session = session
+        self.timeout = timeout
+        self.build_heap = build_heap
+        self.extra_args = ["-o", f"threads={threads}"] if threads else []
+        self.mem_limit_gb = mem_limit_gb
+        self.thy_orig = thy_path.read_text(encoding="utf-8")
+
+    def check(self, new_thy_text: str) -> dict:
+        # Keep a backup next to the theory in case we crash mid-build
+        backup_path = self.thy_path.with_suffix(".thy.bak_tmp")
+        backup_path.write_text(self.thy_orig, encoding="utf-8")
+        try:
+            _atomic_write(self.thy_path, new_thy_text)
+            t0 = time.monotonic()
+            stats = {}
+            rc, out, err = run_isabelle_build(root=self.root, session=self.session, extra_args=self.extra_args,
+                                              timeout=self.timeout, build_heap=self.build_heap,
+                                              mem_limit_gb=self.mem_limit_gb, stats=stats)
+        finally:
+            _atomic_write(self.thy_path, self.thy_orig)
+            backup_path.unlink(missing_ok=True)
+        return {
+            "returncode": rc,
+            "stdout": out,
+            "stderr": err,
+            "success": (rc == 0) and (f"Finished {self.session}" in out),
+            "backend": self.backend,
+            "build_time": round(time.monotonic() - t0, 3),
+            "peak_rss_kb": stats.get("peak_rss_kb"),
+        }
+
+    def close(self):
+        pass
+
+class ServerChecker:
+    """
+    Checks patched theories against a running `isabelle server`.
+
+    The server session (`server_session`, typically the session itself or its
+    parent) is started once; every candidate is written to a sibling file with a
+    fresh theory name, so relative imports keep working and the original file is
+    never touched, and is then loaded with `use_theories` and purged again.
+    """
+    backend = "server"
+    _instances = itertools.count()
+
+    def __init__(self, thy_path: Path, root: Path, session: str, server_session: str | None = None,
+                 timeout: int = 1800):
+        self.thy_path = thy_path.resolve()
+        self.root = root
+        self.session = session
+        self.timeout = timeout
+        self.fallback = None
+        self.theory_name = self.thy_path.stem
+        self.check_name = f"{self.theory_name}__check_{os.getpid()}_{next(self._instances)}"
+        self.server = IsabelleServer()
+        try:
+            self.session_id = self.server.session_start(server_session or session, dirs=[str(root)],
+                                                          timeout=self.timeout)
+        except Exception:
+            self.server.close()
+            raise
+
+    def check(self, new_thy_text: str) -> dict:
+        if self.fallback is not None:
+            return self.fallback.check(new_thy_text)
+        try:
+            return self._check_server(new_thy_text)
+        except subprocess.TimeoutExpired:
+            raise       # a timeout verdict for this candidate; the task was cancelled and the server stays usable
+        except (IsabelleServerError, OSError) as e:
+            # The server went away mid-run; finish with plain builds
+            print(f"[eval] isabelle server failed ({e}); falling back to isabelle build", file=sys.stderr)
+            self.fallback = BuildChecker(self.thy_path, self.root, self.session, timeout=self.timeout)
+            return self.fallback.check(new_thy_text)
+
+    def _check_server(self, new_thy_text: str) -> dict:
+        header_re = re.compile(THEORY_HEADER_RE_TMPL.format(name=re.escape(self.theory_name)))
+        renamed, n = header_re.subn(lambda m: m.group(1) + self.check_name, new_thy_text, count=1)
+        if not n:
+            raise IsabelleServerError(f"theory header '{self.theory_name}' not found")
+        master_dir = str(self.thy_path.parent)
+        check_path = self.thy_path.with_name(self.check_name + ".thy")
+        check_path.write_text(renamed, encoding="utf-8")
+        t0 = time.monotonic()
+        try:
+            res = self.server.use_theories(self.session_id, [self.check_name], master_dir=master_dir,
+                                           timeout=self.timeout)
+        finally:
+            check_path.unlink(missing_ok=True)
+            try:
+                self.server.purge_theories(self.session_id, [self.check_name], master_dir=master_dir)
+            except (IsabelleServerError, OSError):
+                # must not replace a TimeoutExpired from use_theories; a dead server shows up on the next check
+                pass
+        ok = bool(res.get("ok"))
+        errors = []
+        for e in res.get("errors", []):
+            pos = e.get("pos") or {}
+            where = f" (line {pos['line']} of \"{self.thy_path}\")" if "line" in pos else ""
+            first, *rest = (e.get("message", "") or "").split("\n")
+            # same shape as `isabelle build` output: every line of the message marked with ***
+            errors.append("\n".join([f"*** {first}{where}"] + [f"*** {ln}" for ln in rest]))
+        return {
+            "returncode": 0 if ok else 1,
+            "stdout": "\n".join(errors),
+            "stderr": "",
+            "success": ok,
+            "backend": self.backend,
+            "build_time": round(time.monotonic() - t0, 3),
+        }
+
+    def close(self):
+        if self.fallback is not None:
+            self.fallback.close()
+        try:
+            self.server.session_stop(self.session_id, timeout=self.timeout)
+        except Exception:
+            pass
+        self.server.close()
+
+def isabelle_version() -> str:
+    try:
+        proc = subprocess.run(["isabelle", "version"], capture_output=True, text=True, timeout=60)
+        return proc.stdout.strip() or "unknown"
+    except (OSError, subprocess.TimeoutExpired):
+        return "unknown"
+
+def sources_fingerprint(root: Path, exclude: Path) -> str:
+    """
+    Digest of (path, size, mtime) of every theory/ML/ROOT file under `root`
+    except `exclude`, so editing an imported theory invalidates cached results.
+    """
+    exclude = exclude.resolve()
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != ".git"]
+        for fn in filenames:
+            if not (fn.endswith((".thy", ".ML", ".sml")) or fn in ("ROOT", "ROOTS")):
+                continue
+            p = Path(dirpath) / fn
+            if p.resolve() == exclude:
+                continue
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            entries.append(f"{p.relative_to(root)}:{st.st_size}:{st.st_mtime_ns}")
+    entries.sort()
+    return cache_key(*entries)
+
+class CachedChecker:
+    """
+    Wraps a checker with a content-addressed result cache keyed by the full
+    patched theory (horizontal whitespace collapsed), session, backend,
+    Isabelle version and the fingerprint of every other source under --root.
+    Only completed checks are stored; timeouts and killed builds are not.
+    """
+    def __init__(self, inner, cache: DiskCache, session: str, version: str, fingerprint: str):
+        self.inner = inner
+        self.cache = cache
+        self.prefix = (session, version, fingerprint)
+
+    @property
+    def backend(self):
+        return self.inner.backend
+
+    def check(self, new_thy_text: str) -> dict:
+        key = cache_key(*self.prefix, self.inner.backend, re.sub(r"[ \t]+", " ", new_thy_text))
+        hit = self.cache.get(key)
+        if hit is not None:
+            return dict(hit, cached=True)
+        res = self.inner.check(new_thy_text)
+        if res["returncode"] >= 0:
+            self.cache.put(key, dict(res, stdout=tail(res["stdout"], 20000), stderr=tail(res["stderr"], 20000)))
+        return res
+
+    def close(self):
+        self.inner.close()
+
+class MeteredChecker:
+    """Emits a `build` metrics event for every check that reaches Isabelle."""
+    def __init__(self, inner, metrics: Metrics):
+        self.inner = inner
+        self.metrics = metrics
+
+    @property
+    def backend(self):
+        return self.inner.backend
+
+    def check(self, new_thy_text: str) -> dict:
+        t0 = time.monotonic()
+        try:
+            res = self.inner.check(new_thy_text)
+        except subprocess.TimeoutExpired:
+            self.metrics.emit("build", backend=self.backend, wall_s=round(time.monotonic() - t0, 3),
+                              success=False, error="timeout")
+            raise
+        self.metrics.emit("build", backend=res["backend"], wall_s=round(time.monotonic() - t0, 3),
+                          build_time=res.get("build_time"), peak_rss_kb=res.get("peak_rss_kb"),
+                          success=res["success"], returncode=res["returncode"])
+        return res
+
+    def close(self):
+        self.inner.close()
+
+class TargetOnlyChecker:
+    """
+    Checks candidates in two steps. A quick check builds a derived theory where
+    every goal block that is unchanged from the original has its proof replaced
+    by `sorry` under quick_and_dirty, so its cost follows the candidate rather
+    than the file. Only candidates passing it get the strict build of the real
+    patched theory, so reported successes are never based on `sorry`.
+    """
+    def __init__(self, inner, thy: ThyIndex):
+        self.inner = inner
+        self.orig_blocks = {thy.text[e.start:e.end] for e in thy.entries}
+
+    @property
+    def backend(self):
+        return self.inner.backend
+
+    def check(self, new_thy_text: str) -> dict:
+        keep = {start for _, start, _, end in iter_goal_blocks(new_thy_text)
+                if new_thy_text[start:end] not in self.orig_blocks}
+        quick = self.inner.check(sorry_proofs(new_thy_text, keep))
+        summary = {
+            "success": quick["success"],
+            "build_time": quick.get("build_time"),
+            "cached": quick.get("cached", False),
+        }
+        if not quick["success"]:
+            return dict(quick, quick_check=summary)
+        return dict(self.inner.check(new_thy_text), quick_check=summary)
+
+    def close(self):
+        self.inner.close()
+
+def make_checker(args, thy_path: Path, root_path: Path, **build_kwargs):
+    if args.backend == "server":
+        try:
+            return ServerChecker(thy_path, root_path, args.session, server_session=args.server_session,
+                                 timeout=args.timeout)
+        except (IsabelleServerError, OSError, subprocess.TimeoutExpired) as e:
+            print(f"[eval] isabelle server unavailable ({e}); falling back to isabelle build", file=sys.stderr)
+    return BuildChecker(thy_path, root_path, args.session, timeout=args.timeout, **build_kwargs)
+
+def make_worker_checkers(args, thy_path: Path, root_path: Path, scratch_dir: Path) -> list:
+    """
+    One checker per worker. Build workers each get a hardlinked copy of the
+    project root and skip writing the session heap (-b), so parallel builds
+    never race on the same files; server workers only write uniquely named
+    sibling theories and can share the real tree.
+    """
+    threads = args.worker_threads or max(1, (os.cpu_count() or 1) // args.workers)
+    try:
+        rel_thy = thy_path.resolve().relative_to(root_path)
+    except ValueError:
+        sys.exit(f"--workers needs --thy inside --root ({thy_path} is not under {root_path})")
+
+    checkers = []
+    for i in range(args.workers):
+        if args.backend == "server":
+            checkers.append(make_checker(args, thy_path, root_path))
+            continue
+        worker_root = make_scratch_tree(root_path, scratch_dir / f"worker_{i}")
+        checkers.append(BuildChecker(worker_root / rel_thy, worker_root, args.session, timeout=args.timeout,
+                                     build_heap=False, threads=threads, mem_limit_gb=args.worker_mem_gb))
+    return checkers
 
 def tail(s: str, n: int = 2000) -> str:
     if len(s) <= n:
         return s
     return s[-n:]
 
+def now() -> str:
+    return datetime.utcnow().isoformat() + "Z"
+
+def plan_variants(item: dict) -> tuple[str | None, list[tuple[str, str | None, str]]]:
+    """Returns (lemma name guessed from `input`, [(variant_key, lemma_name, code_block), ...])."""
+    inp = item.get("input", "")
+    # Prefer lemma name from code; fallback to input.
+    lemma_name_hint = lemma_name_from_input(inp)
+
+    variants = []
+    for k in VARIANT_KEYS:
+        if k in item and item[k]:
+            code = extract_isabelle_code(item[k])
+            if code:
+                # Try to extract lemma name from the code block itself
+                name_in_code = lemma_name_from_code(code)
+                lemma_name = name_in_code or lemma_name_hint
+                variants.append((k, lemma_name, normalize_candidate(code)))
+    return lemma_name_hint, variants
+
+def result_record(line_no: int, variant_key: str, lemma_name: str, res: dict, args, thy_path: Path) -> dict:
+    return {
+        "time": now(),
+        "line": line_no,
+        "variant": variant_key,
+        "lemma": lemma_name,
+        "returncode": res["returncode"],
+        "stdout_tail": tail(res["stdout"], 4000),
+        "stderr_tail": tail(res["stderr"], 4000),
+        "success": res["success"],
+        "thy": str(thy_path),
+        "session": args.session,
+        "backend": res["backend"],
+        "build_time": res.get("build_time"),
+        "cached": res.get("cached", False),
+        **({"quick_check": res["quick_check"]} if "quick_check" in res else {}),
+    }
+
+def error_record(line_no: int, variant_key: str, lemma_name: str, error: str, args, thy_path: Path) -> dict:
+    return {
+        "time": now(),
+        "line": line_no,
+        "variant": variant_key,
+        "lemma": lemma_name,
+        "error": error,
+        "thy": str(thy_path),
+        "session": args.session,
+    }
+
+def plan_item(line_no: int, item: dict, thy: ThyIndex, thy_path: Path, prefilter: bool = True) -> list[dict]:
+    """
+    Turns one JSONL line into its ordered slots: report records for variants
+    that cannot be checked (including candidates rejected by the static
+    pre-filter), and candidate dicts (marked by "code") for the rest.
+    """
+    lemma_name_hint, variants = plan_variants(item)
+    if not variants:
+        return [{
+            "line": line_no,
+            "input_lemma_guess": lemma_name_hint,
+            "result": "no_variants"
+        }]
+
+    reference = thy.get(lemma_name_hint) if lemma_name_hint else None
+    slots = []
+    for variant_key, lemma_name, code_block in variants:
+        rejected = prefilter and reject_reason(item[variant_key], code_block, item.get("input", ""),
+                                               reference or thy.get(lemma_name or ""))
+        if rejected:
+            slots.append({
+                "line": line_no,
+                "variant": variant_key,
+                "lemma": lemma_name,
+                "result": "rejected",
+                "reject_reason": rejected[0],
+                "reject_detail": rejected[1],
+                "success": False,
+            })
+        elif not lemma_name:
+            slots.append({
+                "line": line_no,
+                "variant": variant_key,
+                "error": "lemma_name_not_found"
+            })
+        elif lemma_name not in thy:
+            slots.append({
+                "line": line_no,
+                "variant": variant_key,
+                "lemma": lemma_name,
+                "error": f"lemma_block_not_found_in_file: {thy_path.name}"
+            })
+        else:
+            slots.append({"line": line_no, "variant": variant_key, "lemma": lemma_name, "code": code_block})
+    return slots
+
+def evaluate_item(line_no: int, item: dict, thy: ThyIndex, checker, args, thy_path: Path) -> list[dict]:
+    """Check every variant of one JSONL line and return its report records in variant order."""
+    records = []
+    for slot in plan_item(line_no, item, thy, thy_path, prefilter=not args.no_prefilter):
+        if "code" not in slot:
+            records.append(slot)
+            continue
+        variant_key, lemma_name = slot["variant"], slot["lemma"]
+
+        if args.dry_run:
+            records.append({
+                "time": now(),
+                "line": line_no,
+                "variant": variant_key,
+                "lemma": lemma_name,
+                "status": "dry_run",
+            })
+            if args.stop_on_success:
+                break
+            continue
+
+        new_thy_text, _ = thy.replace({lemma_name: slot["code"]})
+        try:
+            res = checker.check(new_thy_text)
+        except subprocess.TimeoutExpired as te:
+            records.append(error_record(line_no, variant_key, lemma_name, f"timeout: {te}", args, thy_path))
+            continue
+        except Exception as e:
+            records.append(error_record(line_no, variant_key, lemma_name, f"{type(e).__name__}: {e}", args, thy_path))
+            continue
+
+        records.append(result_record(line_no, variant_key, lemma_name, res, args, thy_path))
+
+        # Stop early if requested and success
+        if args.stop_on_success and res["returncode"] == 0:
+            break
+    return records
+
+def blame_candidates(cands: list[dict], spans: dict, output: str, thy_name: str) -> tuple[list[dict], bool]:
+    """
+    Candidates whose replaced block contains a reported error position, and
+    whether every reported position fell inside some candidate block.
+    """
+    blamed, complete = [], True
+    positions = [(int(m.group(1)), Path(m.group(2)).name) for m in ERROR_POS_RE.finditer(output)]
+    if not positions:
+        return [], False
+    for line, name in positions:
+        hit = None
+        if name == thy_name:
+            hit = next((c for c in cands if spans[c["lemma"]][0] <= line <= spans[c["lemma"]][1]), None)
+        if hit is None:
+            complete = False
+        elif hit not in blamed:
+            blamed.append(hit)
+    return blamed, complete
+
+def first_error(output: str, thy_name: str | None = None, span: tuple[int, int] | None = None) -> dict | None:
+    """
+    The first error message in Isabelle output (`*** ` lines), preferring one
+    positioned inside `span`, the 1-based line range of a candidate in theory
+    file `thy_name`. Returns {"message", "goal", "line", "file", "command"}
+    (goal is the printed goal state, if any; line/file/command may be None).
+    """
+    errors, cur = [], None
+    for raw in output.splitlines():
+        if not raw.startswith("***"):
+            continue
+        text = raw[4:] if raw.startswith("*** ") else raw[3:]
+        at = AT_COMMAND_RE.match(text)
+        if at:
+            if cur is not None:
+                cur["command"] = at.group(1)
+                if cur["line"] is None:
+                    cur["line"], cur["file"] = int(at.group(2)), Path(at.group(3)).name
+            cur = None
+            continue
+        pos = ERROR_POS_RE.search(text)
+        if cur is None or (pos and cur["line"] is not None and not text.startswith(" ")):
+            cur = {"lines": [], "line": int(pos.group(1)) if pos else None,
+                   "file": Path(pos.group(2)).name if pos else None, "command": None}
+            errors.append(cur)
+            text = (text[:pos.start()] + text[pos.end() + 1:]).rstrip().rstrip(":") if pos else text
+        cur["lines"].append(text)
+    if not errors:
+        return None
+
+    def inside(e):
+        return (span is not None and e["line"] is not None and span[0] <= e["line"] <= span[1]
+                and (thy_name is None or e["file"] == thy_name))
+
+    e = next((e for e in errors if inside(e)), errors[0])
+    goal_at = next((i for i, ln in enumerate(e["lines"]) if ln.lstrip().startswith("goal")), len(e["lines"]))
+    return {
+        "message": "\n".join(e["lines"][:goal_at]).strip(),
+        "goal": "\n".join(e["lines"][goal_at:]).strip() or None,
+        "line": e["line"],
+        "file": e["file"],
+        "command": e["command"],
+    }
+
+def check_group(cands: list[dict], thy: ThyIndex, checker, thy_path: Path, stats: dict) -> list[tuple[dict, dict]]:
+    """
+    Builds one theory with every candidate in `cands` patched in (one per lemma)
+    and returns [(candidate, verdict)], verdict being a checker result or {"error": ...}.
+
+    A passing build passes everyone. On failure, an error inside a replaced block
+    fails that candidate and the rest are rebuilt without it; errors that cannot
+    be attributed (no position, another file, a timeout) split the group in halves.
+    """
+    text, spans = thy.replace({c["lemma"]: c["code"] for c in cands})
+    stats["builds"] += 1
+    try:
+        res = checker.check(text)
+    except subprocess.TimeoutExpired as te:
+        if len(cands) == 1:
+            return [(cands[0], {"error": f"timeout: {te}"})]
+        res = None
+    except Exception as e:
+        return [(c, {"error": f"{type(e).__name__}: {e}"}) for c in cands]
+
+    if res is not None and res["success"]:
+        return [(c, res) for c in cands]
+    if len(cands) == 1:
+        return [(cands[0], res)]
+
+    if res is not None:
+        blamed, complete = blame_candidates(cands, spans, res["stdout"] + "\n" + res["stderr"], thy_path.name)
+        if blamed and complete:
+            rest = [c for c in cands if c not in blamed]
+            verdicts = [(c, res) for c in blamed]
+            if rest:
+                verdicts += check_group(rest, thy, checker, thy_path, stats)
+            return verdicts
+
+    mid = len(cands) // 2
+    return (check_group(cands[:mid], thy, checker, thy_path, stats)
+            + check_group(cands[mid:], thy, checker, thy_path, stats))
+
+def check_rounds(queues: dict[str, deque], thy: ThyIndex, checkers: list, args, thy_path: Path) -> dict:
+    """
+    Checks queued candidates (lemma -> candidates in order of preference) in
+    rounds: every round packs the next untested candidate of each lemma into
+    one patched theory and builds it once (split over the workers, and into
+    chunks of --batch_size if set). Sets cand["verdict"] on every checked
+    candidate; with --stop_on_success the rest of a solved line (or of a
+    solved cand["group"], if set) are marked skipped. Returns {"builds", "candidates"}.
+    """
+    pool = queue.Queue()
+    for c in checkers:
+        pool.put(c)
+    stats = {"builds": 0, "candidates": 0}
+
+    def work(group):
+        checker = pool.get()
+        try:
+            return check_group(group, thy, checker, thy_path, stats)
+        finally:
+            pool.put(checker)
+
+    solved_lines = set()
+    with ThreadPoolExecutor(max_workers=len(checkers)) as ex:
+        while True:
+            batch = []
+            for q in queues.values():
+                while q and args.stop_on_success and q[0].get("group", q[0]["line"]) in solved_lines:
+                    q.popleft()["skipped"] = True
+                if q:
+                    batch.append(q.popleft())
+            if not batch:
+                break
+            stats["candidates"] += len(batch)
+
+            n_groups = max(len(checkers), -(-len(batch) // args.batch_size) if args.batch_size else 1)
+            n_groups = min(n_groups, len(batch))
+            groups = [batch[i::n_groups] for i in range(n_groups)]
+            for fut in [ex.submit(work, g) for g in groups]:
+                for cand, verdict in fut.result():
+                    cand["verdict"] = verdict
+                    if args.stop_on_success and verdict.get("returncode") == 0:
+                        solved_lines.add(cand.get("group", cand["line"]))
+    return stats
+
+def check_in_order(queues: dict[str, deque], thy: ThyIndex, checkers: list, args, thy_path: Path) -> dict:
+    """
+    Checks each lemma's queued candidates one build at a time, in queue order,
+    with lemmas spread over the checkers. Sets cand["verdict"] like
+    check_rounds; with --stop_on_success a lemma stops at its first passing
+    candidate. Returns {"builds", "candidates"}.
+    """
+    pool = queue.Queue()
+    for c in checkers:
+        pool.put(c)
+    stats = {"builds": 0, "candidates": 0}
+    lock = threading.Lock()
+
+    def work(q):
+        checker = pool.get()
+        try:
+            while q:
+                cand = q.popleft()
+                new_thy_text, _ = thy.replace({cand["lemma"]: cand["code"]})
+                with lock:
+                    stats["builds"] += 1
+                    stats["candidates"] += 1
+                try:
+                    cand["verdict"] = checker.check(new_thy_text)
+                except subprocess.TimeoutExpired as te:
+                    cand["verdict"] = {"error": f"timeout: {te}"}
+                except Exception as e:
+                    cand["verdict"] = {"error": f"{type(e).__name__}: {e}"}
+                if args.stop_on_success and cand["verdict"].get("returncode") == 0:
+                    for rest in q:
+                        rest["skipped"] = True
+                    break
+        finally:
+            pool.put(checker)
+
+    with ThreadPoolExecutor(max_workers=len(checkers)) as ex:
+        for f in [ex.submit(work, q) for q in queues.values()]:
+            f.result()
+    return stats
+
+def verdict_records(line_no: int, slots: list[dict], args, thy_path: Path, **extra) -> list[dict]:
+    """Report records of one line's slots once their candidates have a "verdict" (unchecked ones are left out)."""
+    records = []
+    for slot in slots:
+        if "code" not in slot:
+            records.append(slot)
+            continue
+        if "verdict" in slot:
+            v = slot["verdict"]
+            if "error" in v:
+                rec = error_record(line_no, slot["variant"], slot["lemma"], v["error"], args, thy_path)
+            else:
+                rec = {**result_record(line_no, slot["variant"], slot["lemma"], v, args, thy_path), **extra}
+        elif args.dry_run and not slot.get("skipped"):
+            rec = {"time": now(), "line": line_no, "variant": slot["variant"], "lemma": slot["lemma"],
+                   "status": "dry_run"}
+        else:
+            continue
+        for k in RANK_FIELDS:
+            if k in slot:
+                rec[k] = slot[k]
+        records.append(rec)
+    return records
+
+def evaluate_batched(items, thy: ThyIndex, checkers: list, args, thy_path: Path):
+    """
+    Batched evaluation (see check_rounds): one build per round of one candidate
+    per distinct lemma. Yields each line's records in input order once all
+    rounds are done.
+    """
+    lines: dict[int, list[dict]] = {}
+    queues: dict[str, deque] = {}
+    for line_no, item, error in items:
+        if error is not None:
+            lines[line_no] = [error]
+            continue
+        lines[line_no] = plan_item(line_no, item, thy, thy_path, prefilter=not args.no_prefilter)
+        for slot in lines[line_no]:
+            if "code" in slot:
+                queues.setdefault(slot["lemma"], deque()).append(slot)
+
+    stats = check_rounds(queues, thy, checkers, args, thy_path)
+    print(f"[eval] batch mode: {stats['candidates']} candidates checked with {stats['builds']} builds",
+          file=sys.stderr)
+
+    for line_no in sorted(lines):
+        yield verdict_records(line_no, lines[line_no], args, thy_path, batched=True)
+
+def evaluate_ranked(items, thy: ThyIndex, checkers: list, args, thy_path: Path):
+    """
+    --rank: the candidates of each lemma, over all lines, are collapsed by
+    canonical form and the unique ones ordered best first (see
+    candidate_rank.py) before anything is built. Only the first candidate of
+    each group is checked (in rounds with --batch, otherwise lemma by lemma)
+    and its verdict is copied to the others, which get "duplicate_of". With
+    --stop_on_success a lemma stops at its first passing group, whichever
+    line it came from. Yields each line's records in input order at the end.
+    """
+    history = TacticHistory(args.tactic_history)
+    lines: dict[int, list[dict]] = {}
+    by_lemma: dict[str, list[dict]] = {}
+    for line_no, item, error in items:
+        if error is not None:
+            lines[line_no] = [error]
+            continue
+        lines[line_no] = plan_item(line_no, item, thy, thy_path, prefilter=not args.no_prefilter)
+        for slot in lines[line_no]:
+            if "code" in slot:
+                by_lemma.setdefault(slot["lemma"], []).append(slot)
+
+    groups, queues = [], {}
+    for lemma, cands in by_lemma.items():
+        ranked = rank_candidates(cands, history)
+        for rank, g in enumerate(ranked, 1):
+            rep = g["rep"]
+            rep["group"] = lemma
+            for c in g["members"]:
+                c.update(rank=rank, agreement=g["agreement"], tactic_rate=g["tactic_rate"])
+                if c is not rep:
+                    c["duplicate_of"] = {"line": rep["line"], "variant": rep["variant"]}
+        queues[lemma] = deque(g["rep"] for g in ranked)
+        groups.extend(ranked)
+
+    stats = {"builds": 0, "candidates": 0}
+    if checkers:
+        stats = (check_rounds if args.batch else check_in_order)(queues, thy, checkers, args, thy_path)
+    for g in groups:
+        rep = g["rep"]
+        for c in g["members"][1:]:
+            for k in ("verdict", "skipped"):
+                if k in rep:
+                    c[k] = rep[k]
+        v = rep.get("verdict")
+        # a timeout counts against the methods, a checker failure says nothing about them
+        if v is not None and not ("error" in v and not v["error"].startswith("timeout")):
+            history.record(rep["code"], bool(v.get("success")))
+    history.save()
+    print(f"[eval] rank: {sum(len(c) for c in by_lemma.values())} candidates, {len(groups)} unique, "
+          f"{stats['candidates']} checked with {stats['builds']} builds", file=sys.stderr)
+
+    for line_no in sorted(lines):
+        yield verdict_records(line_no, lines[line_no], args, thy_path, **({"batched": True} if args.batch else {}))
+
+@contextmanager
+def open_checkers(args, thy: ThyIndex, thy_path: Path, root_path: Path, metrics: Metrics | None = None):
+    """
+    Builds the checkers described by `args` (one per worker, wrapped with
+    metrics, the result cache and target-only mode if requested) and closes
+    them afterwards. Yields an empty list for --dry_run.
+    """
+    scratch_dir = None
+    if args.dry_run:
+        checkers = []
+    elif args.workers > 1:
+        scratch_dir = Path(args.scratch_dir or tempfile.mkdtemp(prefix="proof_gen_workers_"))
+        scratch_dir.mkdir(parents=True, exist_ok=True)
+        checkers = make_worker_checkers(args, thy_path, root_path, scratch_dir)
+    else:
+        checkers = [make_checker(args, thy_path, root_path, mem_limit_gb=args.worker_mem_gb)]
+
+    if metrics:
+        checkers = [MeteredChecker(c, metrics) for c in checkers]
+    cache = None
+    if args.cache_dir and checkers:
+        cache = DiskCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024)
+        version, fingerprint = isabelle_version(), sources_fingerprint(root_path, thy_path)
+        checkers = [CachedChecker(c, cache, args.session, version, fingerprint) for c in checkers]
+    if args.target_only:
+        checkers = [TargetOnlyChecker(c, thy) for c in checkers]
+
+    try:
+        yield checkers
+    finally:
+        for c in checkers:
+            c.close()
+        if scratch_dir is not None and args.scratch_dir is None:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        if cache is not None:
+            print(f"[eval] result cache: {cache.hits} hits, {cache.misses} misses", file=sys.stderr)
+
+def iter_items(jsonl_path: Path):
+    """Yields (line_no, item, error_record) for every non-empty JSONL line."""
+    with jsonl_path.open("r", encoding="utf-8") as fin:
+        for line_no, line in enumerate(fin, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield line_no, json.loads(line), None
+            except Exception as e:
+                yield line_no, None, {
+                    "line": line_no,
+                    "error": f"invalid json: {e}"
+                }
+
+def evaluate_sequential(items, thy: ThyIndex, checker, args, thy_path: Path, metrics: Metrics | None = None):
+    for line_no, item, error in items:
+        if error is not None:
+            yield [error]
+            continue
+        t0 = time.monotonic()
+        records = evaluate_item(line_no, item, thy, checker, args, thy_path)
+        if metrics:
+            metrics.emit("lemma", source="eval", line=line_no, queue_wait_s=0.0,
+                         wall_s=round(time.monotonic() - t0, 3), success=any(r.get("success") for r in records))
+        yield records
+
+def evaluate_parallel(items, thy: ThyIndex, checkers: list, args, thy_path: Path, metrics: Metrics | None = None):
+    """
+    Evaluates JSONL lines on a pool of checkers (one per worker) and yields each
+    line's records in input order, regardless of which worker finishes first.
+    """
+    pool = queue.Queue()
+    for c in checkers:
+        pool.put(c)
+
+    def work(line_no, item, submitted):
+        checker = pool.get()
+        t0 = time.monotonic()
+        try:
+            records = evaluate_item(line_no, item, thy, checker, args, thy_path)
+        finally:
+            pool.put(checker)
+        if metrics:
+            metrics.emit("lemma", source="eval", line=line_no, queue_wait_s=round(t0 - submitted, 3),
+                         wall_s=round(time.monotonic() - t0, 3), success=any(r.get("success") for r in records))
+        return records
+
+    def drain(window: deque, keep: int):
+        # Emit finished lines in order, keeping at most `keep` in flight
+        while window and (len(window) > keep or not isinstance(window[0], Future)):
+            head = window.popleft()
+            yield head.result() if isinstance(head, Future) else head
+
+    window = deque()
+    with ThreadPoolExecutor(max_workers=len(checkers)) as ex:
+        for line_no, item, error in items:
+            window.append([error] if error is not None else ex.submit(work, line_no, item, time.monotonic()))
+            yield from drain(window, 4 * len(checkers))
+        yield from drain(window, 0)
+
+def evaluate_target(items, args, thy_path: Path, root_path: Path, metrics: Metrics, write):
+    """Evaluates `items` against one theory of `args.session`, passing each line's records to `write`."""
+    thy = ThyIndex.from_file(thy_path)
+    parallel = args.workers > 1 and not args.dry_run
+    with open_checkers(args, thy, thy_path, root_path, metrics) as checkers:
+        if args.rank:
+            results = evaluate_ranked(items, thy, checkers, args, thy_path)
+        elif args.batch and checkers:
+            results = evaluate_batched(items, thy, checkers, args, thy_path)
+        elif parallel:
+            results = evaluate_parallel(items, thy, checkers, args, thy_path, metrics)
+        else:
+            results = evaluate_sequential(items, thy, checkers[0] if checkers else None, args, thy_path, metrics)
+        for records in results:
+            if (args.batch or args.rank) and checkers and metrics:
+                for line_no in {r["line"] for r in records if "line" in r}:
+                    metrics.emit("lemma", source="eval", line=line_no,
+                                 success=any(r.get("success") for r in records))
+            write(records)
+
+def route_items(items, root_path: Path, sessions: dict[str, Session]):
+    """
+    Groups JSONL lines by (session, theory file). A line's theory comes from its
+    `file` field (relative to --root, as written by extract_lemmas.py) or else
+    from a lemma name -> file index over every theory under --root; its
+    session from its `session` field or else from the ROOT files.
+    Returns ({(session, thy_path): [(line_no, item, None), ...]}, [unroutable records]).
+    """
+    session_of = session_of_file(sessions)
+    lemma_index = None
+    groups: dict[tuple[str, Path], list] = {}
+    errors = []
+    for line_no, item, error in items:
+        if error is not None:
+            errors.append([error])
+            continue
+        name = lemma_name_from_input(item.get("input", ""))
+        if item.get("file"):
+            thy_path = (root_path / item["file"]).resolve()
+        else:
+            if lemma_index is None:
+                lemma_index = build_index(find_theories(root_path))
+            entry = lemma_index.get(name) if name else None
+            thy_path = Path(entry.file).resolve() if entry else None
+        if thy_path is None or not thy_path.exists():
+            errors.append([{"line": line_no, "lemma": name, "error": "lemma_not_found_in_tree"}])
+            continue
+        session = item.get("session") or session_of(thy_path)
+        if not session:
+            errors.append([{"line": line_no, "lemma": name, "thy": str(thy_path),
+                            "error": "no_session_for_theory"}])
+            continue
+        groups.setdefault((session, thy_path), []).append((line_no, item, None))
+    return groups, errors
+
+def build_heaps(root_path: Path, names: list[str], timeout: int | None):
+    """Builds (and stores) the heaps of `names` with one `isabelle build -b`, before any theory is patched."""
+    if not names:
+        return
+    print(f"[eval] building parent heaps: {' '.join(names)}", file=sys.stderr)
+    t0 = time.monotonic()
+    try:
+        rc, out, err = run_isabelle_build(root_path, names, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        print(f"[eval] parent heap build timed out after {timeout}s; sessions will build them as needed",
+              file=sys.stderr)
+        return
+    status = "done" if rc == 0 else f"failed (rc={rc}): {tail(out + err, 1000)}"
+    print(f"[eval] parent heaps {status} in {time.monotonic() - t0:.0f}s", file=sys.stderr)
+
+def evaluate_sessions(items, args, root_path: Path, metrics: Metrics, write):
+    """
+    Evaluation over many theories and sessions (no --thy). Lines are grouped by
+    session; the heaps every group needs (parents and `sessions` imports from
+    the ROOT files) are built once up front, then sessions run in dependency
+    order, up to --session_jobs at a time. A session only starts after every
+    other evaluated session it depends on has finished, so no build ever sees
+    another session's patched theory. Theories of one session run one after
+    another. Output lines are grouped by session, not in input order.
+
+    With --backend server every running theory group opens its own checkers,
+    and each ServerChecker starts and later shuts down an `isabelle server` of
+    its own (IsabelleServer names are unique per instance), so a session that
+    finishes never stops the server of one still running. Up to
+    --session_jobs * --workers servers, each with a session loaded, can be
+    alive at once.
+    """
+    sessions = find_sessions(root_path)
+    groups, errors = route_items(items, root_path, sessions)
+    for records in errors:
+        write(records)
+    by_session: dict[str, list] = {}
+    for (session, thy_path), group in sorted(groups.items(), key=lambda kv: (kv[0][0], str(kv[0][1]))):
+        by_session.setdefault(session, []).append((thy_path, group))
+    targets = set(by_session)
+    waits = {t: ancestors(sessions, t) & targets for t in targets}
+    if not args.dry_run:
+        # `isabelle build` brings in their own ancestors; the evaluated sessions themselves are built per candidate
+        direct = {d for t in targets if t in sessions for d in [sessions[t].parent, *sessions[t].sessions] if d}
+        build_heaps(root_path, sorted(direct), args.heap_timeout)
+    print(f"[eval] {sum(len(g) for g in groups.values())} lines over {len(groups)} theories "
+          f"in {len(targets)} sessions", file=sys.stderr)
+
+    def run_session(session: str):
+        for i, (thy_path, group) in enumerate(by_session[session]):
+            sargs = argparse.Namespace(**vars(args))
+            sargs.session, sargs.server_session = session, args.server_session if len(targets) == 1 else None
+            if args.scratch_dir:
+                sargs.scratch_dir = str(Path(args.scratch_dir) / f"{session}_{i}")
+            evaluate_target(group, sargs, thy_path, root_path, metrics, write)
+
+    done: set[str] = set()
+    running: dict[Future, str] = {}
+    with ThreadPoolExecutor(max_workers=max(1, args.session_jobs)) as ex:
+        while len(done) < len(targets):
+            for t in sorted(targets - done - set(running.values())):
+                if len(running) < max(1, args.session_jobs) and waits[t] <= done:
+                    running[ex.submit(run_session, t)] = t
+            if not running:
+                sys.exit(f"[eval] cyclic session dependencies among: {' '.join(sorted(targets - done))}")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in finished:
+                done.add(running.pop(f))
+                f.result()
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--jsonl", required=True, help="Input JSONL with lemma candidates")
-    ap.add_argument("--thy", required=True, help="Target .thy file to patch")
-    ap.add_argument("--session", required=True, help="Isabelle session name, e.g., CorresK")
+    ap.add_argument("--thy", default=None,
+                    help="Target .thy file to patch (default: per line, from its `file` field or a lemma index over --root)")
+    ap.add_argument("--session", default=None,
+                    help="Isabelle session name, e.g., CorresK (default: from the line or the ROOT files)")
     ap.add_argument("--root", default=".", help="Isabelle project root for -d")
     ap.add_argument("--out", default="./build_report.jsonl", help="Output JSONL report path")
     ap.add_argument("--timeout", type=int, default=1800, help="Build timeout in seconds")
     ap.add_argument("--stop_on_success", action="store_true", help="Stop iterating variants for an item once one succeeds")
     ap.add_argument("--dry_run", action="store_true", help="Do not run build; just show planned replacements")
+    ap.add_argument("--backend", choices=["build", "server"], default="build",
+                    help="build: cold `isabelle build` per candidate; server: reuse one `isabelle server` session")
+    ap.add_argument("--server_session", default=None,
+                    help="Session heap the server loads (default: --session); its theories stay loaded between candidates")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Check candidates in parallel, each worker on its own hardlinked copy of --root")
+    ap.add_argument("--worker_threads", type=int, default=None,
+                    help="Isabelle threads per worker build (default: cpu_count // workers)")
+    ap.add_argument("--worker_mem_gb", type=float, default=None,
+                    help="Kill a worker build whose process group exceeds this resident memory")
+    ap.add_argument("--batch", action="store_true",
+                    help="Check one candidate per distinct lemma in a single build, bisecting on failure")
+    ap.add_argument("--batch_size", type=int, default=0,
+                    help="With --batch: at most this many candidates per build (0 = no limit)")
+    ap.add_argument("--cache_dir", default=None,
+                    help="Reuse verification results across runs from this directory (off by default)")
+    ap.add_argument("--cache_max_mb", type=int, default=512, help="Size cap of --cache_dir; LRU entries are evicted")
+    ap.add_argument("--target_only", action="store_true",
+                    help="Quick-check with every unchanged proof sorried (quick_and_dirty), "
+                         "then confirm passing candidates with a strict build")
+    ap.add_argument("--no_prefilter", action="store_true",
+                    help="Build every candidate, even ones the static pre-filter would reject")
+    ap.add_argument("--rank", action="store_true",
+                    help="Collapse duplicate candidates of a lemma across lines and check the rest best first "
+                         "(with --stop_on_success: until the lemma's first success)")
+    ap.add_argument("--tactic_history", default=None,
+                    help="With --rank: per-method success counts used for ordering, updated after the run")
+    ap.add_argument("--scratch_dir", default=None,
+                    help="Where worker copies of --root are created (default: a temp dir removed at exit)")
+    ap.add_argument("--session_jobs", type=int, default=1,
+                    help="Without --thy: evaluate up to this many independent sessions at the same time "
+                         "(with --backend server, each runs its own isabelle servers)")
+    ap.add_argument("--heap_timeout", type=int, default=None,
+                    help="Without --thy: timeout in seconds of the up-front parent heap build (default: none)")
+    ap.add_argument("--metrics", default=None, help="Append per-build/per-lemma metrics events to this JSONL file")
+    ap.add_argument("--prometheus", default=None, help="Also keep Prometheus text-format metrics in this file")
     args = ap.parse_args()
 
     jsonl_path = Path(args.jsonl)
-    thy_path = Path(args.thy)
     root_path = Path(args.root).resolve()
     out_path = Path(args.out)
+    lock = threading.Lock()
 
-    thy_orig = thy_path.read_text(encoding="utf-8")
+    metrics = Metrics(args.metrics, args.prometheus)
+    with out_path.open("w", encoding="utf-8") as fout:
+        def write(records):
+            with lock:
+                for rec in records:
+                    fout.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                fout.flush()
 
-    with jsonl_path.open("r", encoding="utf-8") as fin, out_path.open("w", encoding="utf-8") as fout:
-        for line_no, line in enumerate(fin, 1):
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                item = json.loads(line)
-            except Exception as e:
-                fout.write(json.dumps({
-                    "line": line_no,
-                    "error": f"invalid json: {e}"
-                }, ensure_ascii=False) + "\n")
-                continue
-
-            inp = item.get("input", "")
-            # Prefer lemma name from code; fallback to input.
-            lemma_name_hint = lemma_name_from_input(inp)
-
-            variants = []
-            for k in VARIANT_KEYS:
-                if k in item and item[k]:
-                    code = extract_isabelle_code(item[k])
-                    if code:
-                        # Try to extract lemma name from the code block itself
-                        name_in_code = lemma_name_from_code(code)
-                        lemma_name = name_in_code or lemma_name_hint
-                        variants.append((k, lemma_name, code))
-
-            if not variants:
-                fout.write(json.dumps({
-                    "line": line_no,
-                    "input_lemma_guess": lemma_name_hint,
-                    "result": "no_variants"
-                }, ensure_ascii=False) + "\n")
-                continue
-
-            for variant_key, lemma_name, code_block in variants:
-                if not lemma_name:
-                    fout.write(json.dumps({
-                        "line": line_no,
-                        "variant": variant_key,
-                        "error": "lemma_name_not_found"
-                    }, ensure_ascii=False) + "\n")
-                    continue
-
-                # Prepare replacement text
-                new_thy_text, ok = replace_lemma_block(thy_orig, lemma_name, code_block)
-                if not ok:
-                    fout.write(json.dumps({
-                        "line": line_no,
-                        "variant": variant_key,
-                        "lemma": lemma_name,
-                        "error": f"lemma_block_not_found_in_file: {thy_path.name}"
-                    }, ensure_ascii=False) + "\n")
-                    continue
-
-                # Write temp file to avoid clobbering original in case of crash
-                try:
-                    backup_path = None
-                    # Save backup once per variant attempt
-                    backup_path = thy_path.with_suffix(".thy.bak_tmp")
-                    backup_path.write_text(thy_orig, encoding="utf-8")
-
-                    # Write the replaced .thy
-                    thy_path.write_text(new_thy_text, encoding="utf-8")
-
-                    if args.dry_run:
-                        result = {
-                            "time": datetime.utcnow().isoformat() + "Z",
-                            "line": line_no,
-                            "variant": variant_key,
-                            "lemma": lemma_name,
-                            "status": "dry_run",
-                        }
-                        fout.write(json.dumps(result, ensure_ascii=False) + "\n")
-                        # Restore original
-                        thy_path.write_text(thy_orig, encoding="utf-8")
-                        if args.stop_on_success:
-                            break
-                        continue
-
-                    # Run build
-                    rc, out, err = run_isabelle_build(root=root_path, session=args.session, timeout=args.timeout)
-
-                    success = (rc == 0) and (f"Finished {args.session}" in out)
-
-                    result = {
-                        "time": datetime.utcnow().isoformat() + "Z",
-                        "line": line_no,
-                        "variant": variant_key,
-                        "lemma": lemma_name,
-                        "returncode": rc,
-                        "stdout_tail": tail(out, 4000),
-                        "stderr_tail": tail(err, 4000),
-                        "success": success,
-                        "thy": str(thy_path),
-                        "session": args.session,
-                    }
-                    
-                    fout.write(json.dumps(result, ensure_ascii=False) + "\n")
-                    fout.flush()
-
-                    # Restore original .thy
-                    thy_path.write_text(thy_orig, encoding="utf-8")
-                    if backup_path and backup_path.exists():
-                        backup_path.unlink(missing_ok=True)
-
-                    # Stop early if requested and success
-                    if args.stop_on_success and rc == 0:
-                        break
-
-                except subprocess.TimeoutExpired as te:
-                    # Restore and report timeout
-                    thy_path.write_text(thy_orig, encoding="utf-8")
-                    fout.write(json.dumps({
-                        "time": datetime.utcnow().isoformat() + "Z",
-                        "line": line_no,
-                        "variant": variant_key,
-                        "lemma": lemma_name,
-                        "error": f"timeout: {te}",
-                        "thy": str(thy_path),
-                        "session": args.session,
-                    }, ensure_ascii=False) + "\n")
-                except Exception as e:
-                    # Restore and report generic error
-                    try:
-                        thy_path.write_text(thy_orig, encoding="utf-8")
-                    except Exception:
-                        pass
-                    fout.write(json.dumps({
-                        "time": datetime.utcnow().isoformat() + "Z",
-                        "line": line_no,
-                        "variant": variant_key,
-                        "lemma": lemma_name,
-                        "error": f"{type(e).__name__}: {e}",
-                        "thy": str(thy_path),
-                        "session": args.session,
-                    }, ensure_ascii=False) + "\n")
+        if args.thy:
+            thy_path = Path(args.thy)
+            if not args.session:
+                args.session = session_of_file(find_sessions(root_path))(thy_path)
+                if not args.session:
+                    sys.exit(f"--session not given and no ROOT file under {root_path} lists {thy_path}")
+            evaluate_target(iter_items(jsonl_path), args, thy_path, root_path, metrics, write)
+        else:
+            evaluate_sessions(iter_items(jsonl_path), args, root_path, metrics, write)
+    metrics.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Extract {"input", "gt"} lemma records from a whole Isabelle tree (e.g. l4v).
+
+Walks every .thy file below --tree, splits each theory into goal blocks with
+thy_index (in a process pool), and writes one JSONL record per lemma whose
+proof passes the filters:
+
+  {"input": "lemma foo [simp]:\n  \"...\"", "gt": "by simp",
+   "name": "foo", "kind": "lemma", "file": "lib/Foo.thy", "session": "Lib",
+   "theory": "Foo", "offset": 1234, "line": 56, "proof_lines": 1}
+
+`input`/`gt` have the same shape as data/lemmas_short.jsonl, so the output
+can be fed to gen_proof.py / eval.py / fewshot_index.py directly. Unnamed
+blocks and proofs containing sorry/oops are skipped.
+
+Extraction is incremental: the parsed blocks of every file are kept in a
+state file (default: <out>.state.json.gz) together with the file's size,
+mtime and SHA-256. A file is re-read only if its size or mtime changed and
+re-parsed only if its content hash changed; filters are applied afterwards,
+so changing them never requires a re-parse.
+
+Usage:
+  python3 extract_lemmas.py --tree ~/l4v --out ./data/l4v_lemmas.jsonl --max-proof-lines 5
+  python3 extract_lemmas.py --tree ~/l4v --out ./data/l4v_corres.jsonl \
+      --sessions CorresK AInvs --kinds lemma --max-proof-lines 10
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from isabelle_root import find_sessions, find_theories, session_of_file
+from thy_index import GOAL_COMMANDS, ThyIndex
+
+STATE_VERSION = 1
+UNFINISHED_RE = re.compile(r"(?<![\w'])(sorry|oops)(?![\w'])")
+
+
+def parse_file(path: str, known_sha: str | None) -> tuple[str, list[dict] | None]:
+    """
+    (sha256, blocks) of one theory; blocks is None when the content hash equals
+    `known_sha` (unchanged content, the cached blocks stay valid).
+    Runs in a worker process.
+    """
+    data = Path(path).read_bytes()
+    sha = hashlib.sha256(data).hexdigest()
+    if sha == known_sha:
+        return sha, None
+    text = data.decode("utf-8", errors="replace")
+    blocks = []
+    for e in ThyIndex(text).entries:
+        if e.kind not in GOAL_COMMANDS or e.proof_start is None:
+            continue
+        proof = text[e.proof_start:e.end].strip()
+        blocks.append({
+            "name": e.name, "kind": e.kind, "offset": e.start, "line": text.count("\n", 0, e.start) + 1,
+            "input": text[e.start:e.proof_start].strip(), "gt": proof,
+            "proof_lines": sum(1 for ln in proof.splitlines() if ln.strip()),
+            "attributes": e.attributes,
+        })
+    return sha, blocks
+
+
+def load_state(path: Path) -> dict:
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("version") == STATE_VERSION:
+            return state
+    except (OSError, ValueError):
+        pass
+    return {"version": STATE_VERSION, "files": {}}
+
+
+def save_state(path: Path, state: dict):
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def keep(block: dict, args) -> bool:
+    if not block["name"] or block["kind"] not in args.kinds:
+        return False
+    if block["proof_lines"] < args.min_proof_lines:
+        return False
+    if args.max_proof_lines and block["proof_lines"] > args.max_proof_lines:
+        return False
+    if not args.include_unfinished and UNFINISHED_RE.search(block["gt"]):
+        return False
+    return True
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Extract lemma/proof records from an Isabelle tree")
+    ap.add_argument("--tree", required=True, help="Root of the Isabelle sources (e.g. l4v checkout)")
+    ap.add_argument("--out", required=True, help="Output JSONL path")
+    ap.add_argument("--state", default=None, help="Incremental state file (default: <out>.state.json.gz)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Parser processes")
+    ap.add_argument("--min-proof-lines", type=int, default=1)
+    ap.add_argument("--max-proof-lines", type=int, default=5, help="0 = no limit")
+    ap.add_argument("--kinds", nargs="+", choices=GOAL_COMMANDS, default=list(GOAL_COMMANDS))
+    ap.add_argument("--sessions", nargs="+", default=None, help="Only lemmas of these sessions")
+    ap.add_argument("--include-unfinished", action="store_true", help="Keep proofs containing sorry/oops")
+    args = ap.parse_args()
+
+    tree = Path(args.tree).resolve()
+    out_path = Path(args.out)
+    state_path = Path(args.state) if args.state else out_path.with_name(out_path.name + ".state.json.gz")
+    if out_path.parent:
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+    t0 = time.monotonic()
+
+    state = load_state(state_path)
+    old = state["files"]
+    session_of = session_of_file(find_sessions(tree))
+    wanted = set(args.sessions) if args.sessions else None
+
+    files, stale = [], {}
+    for p in find_theories(tree):
+        rel = p.relative_to(tree).as_posix()
+        st = p.stat()
+        files.append((rel, p, st))
+        prev = old.get(rel)
+        if not prev or prev["size"] != st.st_size or prev["mtime_ns"] != st.st_mtime_ns:
+            stale[rel] = prev["sha"] if prev else None
+
+    new_files, counts = {}, {"files": len(files), "reparsed": 0, "rehashed": 0, "blocks": 0, "written": 0}
+    tmp_out = out_path.with_name(f"{out_path.name}.{os.getpid()}.tmp")
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool, \
+            open(tmp_out, "w", encoding="utf-8") as fout:
+        futures = {rel: pool.submit(parse_file, str(tree / rel), sha) for rel, sha in stale.items()}
+        # files are written in path order as soon as their parse result is available
+        for rel, p, st in files:
+            entry = old.get(rel)
+            if rel in futures:
+                try:
+                    sha, blocks = futures.pop(rel).result()
+                except (OSError, UnicodeError) as e:
+                    print(f"[extract] skipping {rel}: {e}", file=sys.stderr)
+                    continue
+                if blocks is None:
+                    counts["rehashed"] += 1
+                else:
+                    counts["reparsed"] += 1
+                    entry = {"sha": sha, "blocks": blocks}
+                entry = {**entry, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+            new_files[rel] = entry
+
+            session = session_of(p)
+            if wanted is not None and session not in wanted:
+                continue
+            counts["blocks"] += len(entry["blocks"])
+            for b in entry["blocks"]:
+                if not keep(b, args):
+                    continue
+                rec = {"input": b["input"], "gt": b["gt"], "name": b["name"], "kind": b["kind"], "file": rel,
+                       "session": session, "theory": p.stem, "offset": b["offset"], "line": b["line"],
+                       "proof_lines": b["proof_lines"]}
+                fout.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                counts["written"] += 1
+    os.replace(tmp_out, out_path)
+    state["files"] = new_files          # drops deleted files
+    save_state(state_path, state)
+
+    print(f"[extract] {counts['files']} theories ({counts['reparsed']} parsed, {counts['rehashed']} touched but "
+          f"unchanged), {counts['blocks']} goal blocks, {counts['written']} records -> {out_path} "
+          f"in {time.monotonic() - t0:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
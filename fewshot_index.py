@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+BM25 retrieval of few-shot examples.
+
+Instead of the first k lines of the few-shot file, every lemma gets the
+examples whose statements share the most (rare) constants and symbols with
+it, packed greedily into a prompt-token budget.
+
+Terms are Isabelle tokens of the example `input`: identifiers (and, for
+compound names like `corres_underlyingK`, also their `_`-separated parts, so
+`corres` matches `corres_mapM`), symbols such as `\\<lbrace>`, and operators.
+Outer-syntax keywords (lemma, assumes, shows, ...) are dropped.
+
+The index is built once and saved as gzipped JSON next to the corpus (or at
+`index_path`); it is rebuilt automatically when the corpus content changes.
+
+  python3 fewshot_index.py build --corpus ./data/lemmas_AInvs.jsonl
+  python3 fewshot_index.py query --corpus ./data/lemmas_AInvs.jsonl --lemma "lemma foo: ..."
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+
+TERM_RE = re.compile(r"\\<[A-Za-z^]+>|[A-Za-z_][\w']*|[^\s\w\"()\[\],]+")
+NAME_RE = re.compile(r"^\s*(?:lemma|theorem|corollary|proposition|schematic_goal)\s+([\w'.]+)")
+STOP_TERMS = {
+    "lemma", "theorem", "corollary", "proposition", "schematic_goal", "assumes", "shows", "fixes",
+    "and", "obtains", "for", "in", "where", "is", "if", "simp", "intro", "dest", "elim", "rule",
+}
+INDEX_VERSION = 1
+
+
+def terms(text: str) -> list[str]:
+    out = []
+    for t in TERM_RE.findall(text):
+        if t in STOP_TERMS:
+            continue
+        out.append(t)
+        if "_" in t.strip("_"):
+            out.extend(p for p in t.split("_") if len(p) > 1 and p not in STOP_TERMS)
+    return out
+
+
+def approx_tokens(text: str) -> int:
+    # rough LLM token estimate; Isabelle symbols like \<lbrace> are several tokens each
+    return len(text) // 4 + 1
+
+
+def format_shot(i: int, inp: str, out: str) -> str:
+    return f"\nExample {i}:\nInput:\n{inp}\n\nOutput:\n{out}\n"
+
+
+def format_block(shots: list[tuple[str, str]], title: str = "Few-shot Isabelle Proof Examples") -> str:
+    """Same layout as gen_proof.fewshot_block."""
+    if not shots:
+        return ""
+    parts = [f"{title}:"]
+    parts += [format_shot(i, inp, out) for i, (inp, out) in enumerate(shots, 1)]
+    parts.append("\n--- End of Few-shot Examples ---\n")
+    return "\n".join(parts)
+
+
+def _corpus_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FewshotIndex:
+    def __init__(self, docs: list[tuple[str, str]], k1: float = 1.2, b: float = 0.75, corpus_sha: str = ""):
+        self.docs = docs
+        self.k1 = k1
+        self.b = b
+        self.corpus_sha = corpus_sha
+        self.doc_len = []
+        self.postings: dict[str, list[tuple[int, int]]] = defaultdict(list)
+        for d, (inp, _) in enumerate(docs):
+            tf = Counter(terms(inp))
+            self.doc_len.append(sum(tf.values()))
+            for t, n in tf.items():
+                self.postings[t].append((d, n))
+        self._finish()
+
+    def _finish(self):
+        n = len(self.docs)
+        self.avgdl = (sum(self.doc_len) / n) if n else 0.0
+        self.idf = {t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self.postings.items()}
+        self.names = [(NAME_RE.match(inp) or [None, None])[1] for inp, _ in self.docs]
+
+    # ---------- persistence ----------
+    @classmethod
+    def from_corpus(cls, path: str) -> "FewshotIndex":
+        docs = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    continue
+                inp, out = (r.get("input") or "").strip(), (r.get("gt") or "").strip()
+                if inp and out:
+                    docs.append((inp, out))
+        return cls(docs, corpus_sha=_corpus_digest(path))
+
+    def save(self, path: str):
+        data = {
+            "version": INDEX_VERSION, "corpus_sha": self.corpus_sha, "k1": self.k1, "b": self.b,
+            "docs": self.docs, "doc_len": self.doc_len, "postings": self.postings,
+        }
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "FewshotIndex":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != INDEX_VERSION:
+            raise ValueError(f"{path}: unsupported index version {data.get('version')}")
+        self = cls.__new__(cls)
+        self.docs = [tuple(d) for d in data["docs"]]
+        self.k1, self.b, self.corpus_sha = data["k1"], data["b"], data["corpus_sha"]
+        self.doc_len = data["doc_len"]
+        self.postings = {t: [tuple(p) for p in ps] for t, ps in data["postings"].items()}
+        self._finish()
+        return self
+
+    @classmethod
+    def load_or_build(cls, corpus: str, index_path: str | None = None) -> "FewshotIndex":
+        index_path = index_path or f"{corpus}.bm25.json.gz"
+        sha = _corpus_digest(corpus)
+        if os.path.exists(index_path):
+            try:
+                index = cls.load(index_path)
+                if index.corpus_sha == sha:
+                    return index
+            except (OSError, ValueError, KeyError):
+                pass
+        index = cls.from_corpus(corpus)
+        index.save(index_path)
+        return index
+
+    # ---------- retrieval ----------
+    def scores(self, query: str) -> dict[int, float]:
+        k1, b, avgdl = self.k1, self.b, self.avgdl or 1.0
+        acc: dict[int, float] = defaultdict(float)
+        for t, qtf in Counter(terms(query)).items():
+            idf = self.idf.get(t)
+            if idf is None:
+                continue
+            for d, tf in self.postings[t]:
+                acc[d] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * self.doc_len[d] / avgdl))
+        return acc
+
+    def select(self, query: str, k: int, token_budget: int | None = None) -> list[tuple[str, str]]:
+        """
+        Up to `k` (input, gt) examples by decreasing BM25 score whose formatted
+        size fits in `token_budget`. The query lemma itself (same name or same
+        statement) is never returned.
+        """
+        m = NAME_RE.match(query)
+        qname, qnorm = (m.group(1) if m else None), " ".join(query.split())
+        ranked = sorted(self.scores(query).items(), key=lambda x: (-x[1], x[0]))
+        shots, used = [], 0
+        for d, _ in ranked:
+            if len(shots) >= k:
+                break
+            inp, out = self.docs[d]
+            if (qname and self.names[d] == qname) or " ".join(inp.split()) == qnorm:
+                continue
+            cost = approx_tokens(format_shot(len(shots) + 1, inp, out))
+            if token_budget is not None and used + cost > token_budget:
+                continue
+            shots.append((inp, out))
+            used += cost
+        return shots
+
+    def block(self, query: str, k: int, token_budget: int | None = None) -> str:
+        return format_block(self.select(query, k, token_budget))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="BM25 few-shot index")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    bp = sub.add_parser("build", help="(re)build the index of a few-shot corpus")
+    bp.add_argument("--corpus", required=True)
+    bp.add_argument("--index", default=None, help="index path (default: <corpus>.bm25.json.gz)")
+    qp = sub.add_parser("query", help="show the shots selected for one lemma")
+    qp.add_argument("--corpus", required=True)
+    qp.add_argument("--index", default=None)
+    qp.add_argument("--lemma", required=True)
+    qp.add_argument("--shots", type=int, default=4)
+    qp.add_argument("--token-budget", type=int, default=1024)
+    args = ap.parse_args()
+
+    if args.cmd == "build":
+        index = FewshotIndex.from_corpus(args.corpus)
+        index.save(args.index or f"{args.corpus}.bm25.json.gz")
+        print(f"indexed {len(index.docs)} examples, {len(index.postings)} terms")
+    else:
+        index = FewshotIndex.load_or_build(args.corpus, args.index)
+        print(index.block(args.lemma, args.shots, args.token_budget))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,15 @@
-import asyncio, json, argparse, os
-from openai import AsyncOpenAI
+import asyncio, json, argparse, os, sys, hashlib, time
 from prompt import *  
+from disk_cache import DiskCache, cache_key
+from llm_client import AdaptiveLimiter, LLMError, RequestPolicy, Router, parse_base_urls
+from metrics import Metrics
+from fewshot_index import FewshotIndex
 
 DEFAULT_BASE_URL = "http://localhost:8004/v1"
+REPETITION_PENALTY = 1.1
+# variant별 생성 토큰 상한 (CoT는 plan/steps를 먼저 쓰므로 더 길게)
+VARIANT_MAX_TOKENS = {"baseline_output": 1024, "cot_output": 4096}
+ISABELLE_FENCE = "```isabelle"
 
 def fewshot_block(path, k, title="Few-shot Isabelle Proof Examples"):
     if not path or k <= 0: return ""
@@ -23,119 +30,429 @@ def fewshot_block(path, k, title="Few-shot Isabelle Proof Examples"):
     parts.append("\n--- End of Few-shot Examples ---\n")
     return "\n".join(parts)
 
-def inject_fs(tpl, lemma, fs):  # single-input prompt
-    body = tpl.format(lemma)
-    return f"{fs}\n{body}" if fs else body
+def fewshot_selector(path, k, mode="first", budget=None, index_path=None):
+    """
+    lemma -> few-shot block 함수와 block이 모든 lemma에 공통인지 여부를 반환.
+    mode="first": 파일 앞 k개 (모든 lemma 동일).
+    mode="bm25": BM25 index(fewshot_index.py, 없거나 corpus가 바뀌면 생성 후 저장)에서
+    lemma와 관련도가 높은 예제를 최대 k개, 추정 토큰 수 budget 이내로 선택.
+    """
+    if mode == "first" or not path or k <= 0:
+        fs = fewshot_block(path, k)
+        return (lambda lemma: fs), True
+    index = FewshotIndex.load_or_build(path, index_path)
+    return (lambda lemma: index.block(lemma, k, budget)), False
+
+def inject_fs(tpl, lemma, fs, shared=True):  # single-input prompt
+    # few-shot + 템플릿 헤더는 모든 lemma에 대해 byte 단위로 동일한 prefix, lemma는 그 뒤
+    # -> vLLM prefix caching이 고정 부분의 prefill을 재사용
+    head, tail = tpl.split("{}", 1)
+    if not fs:
+        return head + lemma + tail
+    if shared:
+        return f"{fs}\n{head}" + lemma + tail
+    # lemma별 few-shot: 고정 템플릿 헤더를 prefix로 유지하도록 예제는 마지막 "Input:" 바로 앞에 삽입
+    cut = head.rfind("Input:")
+    cut = cut if cut >= 0 else len(head)
+    return f"{head[:cut]}{fs}\n{head[cut:]}" + lemma + tail
 
 def inject_fs_cot(tpl, lemma, sketch, fs):  # lemma+sketch prompt
     body = tpl.format(lemma, sketch)
     return f"{fs}\n{body}" if fs else body
 
-async def llm(client, model, prompt, temperature=0.65, top_p=0.95):
-    r = await client.chat.completions.create(
-        model=model, messages=[{"role":"user","content":prompt}],
-        temperature=temperature, top_p=top_p, extra_body={"repetition_penalty": 1.1}
-    )
-    return r.choices[0].message.content
+def usage_of(r):
+    if not r.usage: return None
+    u = {"prompt_tokens": r.usage.prompt_tokens, "completion_tokens": r.usage.completion_tokens}
+    details = getattr(r.usage, "prompt_tokens_details", None)
+    if details is not None and getattr(details, "cached_tokens", None) is not None:
+        u["cached_prompt_tokens"] = details.cached_tokens
+    return u
+
+class FenceTracker:
+    """
+    streaming 출력에서 ```isabelle 블록이 닫히는 위치를 찾음. 새로 붙은 부분만 검사하므로
+    chunk 수에 대해 선형. CoT 출력의 ```plaintext 블록은 무시.
+    """
+    def __init__(self):
+        self.text = ""
+        self.open_end = None
 
-async def do_baseline(client, model, lemma, fs="", T=0.65, top_p=0.95):
-    return await llm(client, model, inject_fs(BASELINE_PROMPT, lemma, fs), temperature=T, top_p=top_p)
+    def feed(self, delta):
+        """delta를 붙이고, isabelle 블록이 닫혔으면 닫는 fence 직후 위치를 반환."""
+        prev = len(self.text)
+        self.text += delta
+        if self.open_end is None:
+            i = self.text.find(ISABELLE_FENCE, max(0, prev - len(ISABELLE_FENCE)))
+            if i < 0:
+                return None
+            self.open_end = i + len(ISABELLE_FENCE)
+        j = self.text.find("```", max(self.open_end, prev - 2))
+        return None if j < 0 else j + 3
 
-async def do_cot(client, model, lemma, fs="", T=0.65, top_p=0.95):
-    return await llm(client, model, inject_fs(COT_GEN_PROMPT, lemma, fs), temperature=T, top_p=top_p)
+async def read_until_fence(stream, n):
+    """
+    stream=True 응답을 읽으면서 각 choice의 isabelle 블록이 닫히면 그 뒤는 버림.
+    모든 choice가 끝나면(하나라도 fence에서 끊겼으면 바로) stream을 닫아 서버의 decode를 중단.
+    (contents, finish_reasons, usage 또는 None, 받은 chunk 수, 첫 token 시각) 반환.
+    """
+    trackers = [FenceTracker() for _ in range(n)]
+    finish = [None] * n
+    usage, chunks, first = None, 0, None
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage = chunk
+            for c in chunk.choices:
+                i = c.index
+                if finish[i] is not None:
+                    continue
+                if c.delta and c.delta.content:
+                    chunks += 1
+                    if first is None:
+                        first = time.monotonic()
+                    cut = trackers[i].feed(c.delta.content)
+                    if cut is not None:
+                        trackers[i].text = trackers[i].text[:cut]
+                        finish[i] = "fence"
+                        continue
+                if c.finish_reason:
+                    finish[i] = c.finish_reason
+            # 자연 종료만 있으면 마지막 usage chunk까지 읽음
+            if all(finish) and "fence" in finish:
+                break
+    finally:
+        await stream.close()
+    return [t.text for t in trackers], finish, (usage_of(usage) if usage else None), chunks, first
 
-async def process_one_sample(client, model, lemma, fs_block, T, top_p, sample_id):
+async def chat(client, model, prompt, n=1, temperature=0.65, top_p=0.95, cache=None, sample_key=None, policy=None,
+               max_tokens=None, fence_stop=False, vllm_usage_stats=False):
     """
-    한 lemma에 대한 단일 샘플을 생성.
+    n개의 샘플을 한 번의 요청으로 생성 (prompt prefill은 한 번만). (contents, usage) 반환.
+    cache(DiskCache)가 주어지면 (model, prompt hash, sampling 파라미터, sample_key)로 응답을 재사용.
+    sample_key는 같은 prompt의 서로 다른 샘플이 하나로 합쳐지지 않도록 구분하는 값 (sample_id).
+    policy(RequestPolicy)가 주어지면 timeout/재시도/adaptive concurrency를 적용하고,
+    재시도 후에도 실패하면 LLMError를 던짐. client는 AsyncOpenAI 또는 여러 endpoint의 Router.
+    max_tokens는 생성 토큰 상한, fence_stop=True이면 streaming으로 받다가 ```isabelle 블록이
+    닫히는 순간 요청을 끊음. usage에는 max_tokens, choice별 finish_reason("fence"/"stop"/"length"),
+    성공한 시도의 latency_s와 (streaming이면) 첫 token까지의 ttft_s를 추가.
+    vllm_usage_stats=True이면 stream마다 vLLM 전용 continuous_usage_stats도 요청
+    (다른 OpenAI 호환 서버는 이 옵션을 400으로 거부할 수 있음).
     """
-    out = {
-        "input": lemma,
-        "baseline_output": None,
-        "cot_output": None,
-        "sample_id": sample_id
-    }
+    key = None
+    if cache is not None:
+        decode = () if max_tokens is None and not fence_stop else (max_tokens, fence_stop)
+        key = cache_key(model, hashlib.sha256(prompt.encode("utf-8")).hexdigest(), temperature, top_p,
+                        REPETITION_PENALTY, n, sample_key, *decode)
+        hit = cache.get(key)
+        if hit is not None:
+            return hit["contents"], dict(hit["usage"] or {}, cached_response=True)
 
-    async def safe(coro):
-        try:
-            return await coro
-        except Exception as e:
-            return f"[ERROR] {e}"
+    async def attempt(create):
+        t0 = time.monotonic()
+        kwargs = dict(
+            model=model, messages=[{"role":"user","content":prompt}], n=n, max_tokens=max_tokens,
+            temperature=temperature, top_p=top_p, extra_body={"repetition_penalty": REPETITION_PENALTY}
+        )
+        if not fence_stop:
+            r = await create(**kwargs)
+            if len(r.choices) < n:
+                raise LLMError("incomplete", f"server returned {len(r.choices)} of {n} choices")
+            choices = sorted(r.choices, key=lambda c: c.index)
+            timing = {"latency_s": round(time.monotonic() - t0, 3)}
+            return [c.message.content for c in choices], [c.finish_reason for c in choices], usage_of(r), timing
+        # continuous_usage_stats(vLLM 전용): 중간에 끊어도 마지막으로 받은 chunk의 usage가 남음
+        stream_options = {"include_usage": True}
+        if vllm_usage_stats:
+            stream_options["continuous_usage_stats"] = True
+        stream = await create(stream=True, stream_options=stream_options, **kwargs)
+        contents, finish, usage, chunks, first = await read_until_fence(stream, n)
+        timing = {"latency_s": round(time.monotonic() - t0, 3),
+                  "ttft_s": round(first - t0, 3) if first is not None else None}
+        if None in finish:
+            raise LLMError("incomplete", f"stream ended before {finish.count(None)} of {n} choices finished")
+        if usage is None:
+            # usage를 받기 전에 끊음 -> chunk 수로 추정 (vLLM은 보통 chunk당 1 token)
+            usage = {"completion_tokens": chunks, "estimated": True}
+        return contents, finish, usage, timing
 
-    b_task = asyncio.create_task(safe(do_baseline(client, model, lemma, fs=fs_block, T=T, top_p=top_p)))
-    c_task = asyncio.create_task(safe(do_cot(client, model, lemma, fs=fs_block, T=T, top_p=top_p)))
-    r_b, r_c = await asyncio.gather(b_task, c_task)
+    async def request():
+        # Router: timeout은 stream을 끝까지 읽는 시간까지 포함, 실패는 replica 제외에 반영
+        if isinstance(client, Router):
+            return await client.attempt(attempt)
+        return await attempt(client.chat.completions.create)
 
-    out["baseline_output"] = r_b
-    # do_cot가 tuple을 반환하지 않도록 유지(스케치 따로 없음)
-    out["cot_output"] = r_c
+    contents, finish, usage, timing = await (policy.call(request) if policy is not None else request())
+    if usage is not None:
+        usage = dict(usage, max_tokens=max_tokens, finish_reasons=finish)
+    if key is not None:
+        cache.put(key, {"contents": contents, "usage": usage})
+    return contents, dict(usage or {}, **timing)
 
-    return out
+def error_info(e):
+    """실패한 요청의 구조화된 에러 (출력 텍스트 필드와 분리해 record의 "errors"에 기록)."""
+    if isinstance(e, LLMError):
+        return e.to_dict()
+    return {"type": "unexpected", "message": f"{type(e).__name__}: {e}", "attempts": 1}
 
-async def process_one(client, model, item, fs_block, T, top_p, samples):
+# ---------- runner ----------
+VARIANT_PROMPTS = {"baseline_output": BASELINE_PROMPT, "cot_output": COT_GEN_PROMPT}
+
+def emit_request(metrics, key, n, usage, err, enqueued):
     """
-    한 lemma에 대해 'samples' 횟수만큼 생성하여 리스트로 반환.
+    llm_request 이벤트 기록. queue_wait_s는 job이 큐에 들어간 뒤 (성공한) 요청이 시작될 때까지의
+    시간 (worker 대기 + concurrency limiter 대기 + 재시도 backoff 포함).
     """
-    lemma = item.get("input","")
-    gt = item.get("gt")
-    results = []
+    if not metrics:
+        return
+    u = usage or {}
+    started = time.monotonic() - (u.get("latency_s") or 0)
+    metrics.emit("llm_request", variant=key, n=n, latency_s=u.get("latency_s"), ttft_s=u.get("ttft_s"),
+                 queue_wait_s=round(started - enqueued, 3), prompt_tokens=u.get("prompt_tokens"),
+                 completion_tokens=u.get("completion_tokens"), cached=bool(u.get("cached_response")),
+                 error=err["type"] if err else None)
 
-    # 샘플 개수만큼 병렬 실행 가능하도록 태스크 생성
-    tasks = [
-        asyncio.create_task(process_one_sample(client, model, lemma, fs_block, T, top_p, sample_id=i))
-        for i in range(1, samples+1)
-    ]
-    samples_out = await asyncio.gather(*tasks, return_exceptions=True)
+def is_done(v):
+    # 실패한 variant는 None (+ "errors"), 예전 출력에서는 "[ERROR] ..." 문자열
+    return isinstance(v, str) and not v.startswith("[ERROR]")
 
-    # 각 샘플 결과에 ground truth 추가(있다면) 및 예외 처리
-    for i, res in enumerate(samples_out, start=1):
-        if isinstance(res, Exception):
-            results.append({
-                "input": lemma, "gt": gt,
-                "baseline_output": f"[ERROR] {res}",
-                "cot_output": f"[ERROR] {res}",
-                "sample_id": i
-            })
-        else:
-            res["gt"] = gt
-            results.append(res)
+def load_previous(outp):
+    """
+    기존 출력 파일을 읽어 (input, sample_id)별로 병합한 record 반환.
+    같은 key가 여러 번 있으면 실패하지 않은 최신 결과를 우선.
+    """
+    merged = {}
+    if not os.path.exists(outp):
+        return merged
+    with open(outp, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except Exception:
+                continue  # crash로 마지막 줄이 잘렸을 수 있음
+            if r.get("input") is None or r.get("sample_id") is None:
+                continue
+            key = (r["input"], r["sample_id"])
+            if key not in merged:
+                merged[key] = r
+                continue
+            m = merged[key]
+            for k in VARIANT_PROMPTS:
+                if is_done(r.get(k)) or not is_done(m.get(k)):
+                    m[k] = r.get(k)
+                    if k in r.get("usage", {}):
+                        m.setdefault("usage", {})[k] = r["usage"][k]
+                    if k in r.get("errors", {}):
+                        m.setdefault("errors", {})[k] = r["errors"][k]
+                    else:
+                        m.get("errors", {}).pop(k, None)
+            if not m.get("errors"):
+                m.pop("errors", None)
+    return merged
 
-    return results
+def compact_output(inp, outp):
+    """
+    append-only로 쌓인 출력을 (input, sample_id)당 한 줄로 정리해 입력 순서대로 다시 기록.
+    임시 파일에 쓴 뒤 rename하므로 도중에 죽어도 기존 파일은 그대로.
+    """
+    merged = load_previous(outp)
+    by_input = {}
+    for key in sorted(merged, key=lambda k: k[1]):
+        by_input.setdefault(key[0], []).append(key)
+    tmp = f"{outp}.compact.tmp"
+    with open(inp, "r", encoding="utf-8") as fin, open(tmp, "w", encoding="utf-8") as fout:
+        written = set()
+        for line in fin:
+            try:
+                lemma = json.loads(line).get("input", "")
+            except Exception:
+                continue
+            for key in by_input.pop(lemma, []):
+                fout.write(json.dumps(merged[key], ensure_ascii=False) + "\n")
+                written.add(key)
+        # 입력에 없는 record도 버리지 않음
+        for key, rec in merged.items():
+            if key not in written:
+                fout.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp, outp)
 
-# ---------- runner ----------
-async def run(inp, outp, model, base_url, temperature, top_p, fs_file, shots, samples):
-    client = AsyncOpenAI(api_key="EMPTY", base_url=base_url)
-    fs_block = fewshot_block(fs_file, shots)
+async def run(inp, outp, model, base_url, temperature, top_p, fs_file, shots, samples, max_concurrency=64,
+              server_n=False, resume=False, fsync_every=32, cache_dir=None, cache_max_mb=1024,
+              request_timeout=600, max_retries=5, min_concurrency=1, adaptive=True,
+              max_tokens=None, fence_stop=True, metrics_path=None, prom_path=None,
+              fewshot_mode="first", fewshot_budget=None, fewshot_index=None, vllm_usage_stats=False):
+    """
+    입력 파일 전체의 (lemma, sample, variant) 작업을 하나의 큐에 넣고
+    max_concurrency개의 worker가 처리. 완료된 line부터 입력 순서대로 기록.
+    server_n=True이면 (lemma, variant)마다 n=samples 요청 하나로 모든 샘플을 생성.
+    resume=True이면 기존 출력에서 실패 없이 끝난 (input, sample_id, variant)는 건너뛰고
+    나머지만 생성해 append. 출력은 fsync_every개 record마다 fsync.
+    cache_dir가 주어지면 동일한 prompt/파라미터의 응답은 서버 호출 없이 캐시에서 재사용.
+    요청마다 request_timeout초 제한, 재시도 가능한 실패는 max_retries번까지 backoff 후 재시도.
+    base_url은 endpoint 하나 또는 목록(쉼표 구분 가능). 여러 개면 미처리 요청이 가장 적은
+    정상 replica로 보내고, 실패가 이어지는 replica는 health check가 성공할 때까지 제외.
+    동시 요청 수는 min_concurrency..max_concurrency×(endpoint 수) 사이에서 AIMD로 조절 (adaptive=False면 고정).
+    재시도 후에도 실패한 variant는 None으로 두고 record의 "errors"에 {type, message, attempts}를 기록.
+    max_tokens는 variant별 생성 토큰 상한 (기본 VARIANT_MAX_TOKENS), fence_stop이면
+    ```isabelle 블록이 닫히는 즉시 생성을 끊음 (vllm_usage_stats는 chat 참고).
+    metrics_path/prom_path가 주어지면 요청/lemma 단위 이벤트를 기록 (metrics.py 참고).
+    fewshot_mode="bm25"이면 lemma마다 관련 예제를 fewshot_budget 토큰 이내로 검색 (fewshot_selector 참고).
+    """
+    metrics = Metrics(metrics_path, prom_path)
+    max_tokens = {**VARIANT_MAX_TOKENS, **(max_tokens or {})}
+    client = Router(parse_base_urls(base_url), timeout=request_timeout)
+    client.start()
+    max_concurrency *= len(client)
+    # 요청별 timeout은 Router가 replica 단위로 적용 (streaming이면 응답을 다 읽을 때까지, 실패한 replica 제외에 사용)
+    policy = RequestPolicy(AdaptiveLimiter(max_concurrency, min_limit=min_concurrency, adaptive=adaptive),
+                           timeout=None, max_retries=max_retries)
+    select_fs, shared_fs = fewshot_selector(fs_file, shots, fewshot_mode, fewshot_budget, fewshot_index)
 
     # 출력 파일 디렉토리 생성 (없으면)
     out_dir = os.path.dirname(outp)
     if out_dir:  # 빈 문자열이 아닐 때만 생성 시도
         os.makedirs(out_dir, exist_ok=True)
 
-    with open(inp, "r", encoding="utf-8") as fin, open(outp, "w", encoding="utf-8") as fout:
-        for line in fin:
-            try:
-                item = json.loads(line)
-            except Exception as e:
-                fout.write(json.dumps({
-                    "input": None, "gt": None,
-                    "baseline_output": None,
-                    "cot_output": None,
-                    "sample_id": None,
-                    "error": f"[ERROR] invalid json: {e}"
-                }, ensure_ascii=False) + "\n")
-                continue
-            try:
-                all_samples = await process_one(client, model, item, fs_block, temperature, top_p, samples)
-                for rec in all_samples:
+    queue = asyncio.Queue(maxsize=max_concurrency * 2)
+    lines = {}       # line idx -> {"recs": [...], "remaining": n}
+    finished = {}    # line idx -> 기록할 record 리스트
+    next_idx = 0
+    totals = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_prompt_tokens": 0, "cache_hits": 0,
+              "fence_stops": 0, "length_stops": 0}
+    cache = DiskCache(cache_dir, max_bytes=cache_max_mb * 1024 * 1024) if cache_dir else None
+    previous = load_previous(outp) if resume else {}
+    unsynced = 0
+
+    if resume and os.path.exists(outp) and os.path.getsize(outp) > 0:
+        # 잘린 마지막 줄 뒤에 이어 쓰지 않도록 줄바꿈 보정
+        with open(outp, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+        if needs_newline:
+            with open(outp, "a", encoding="utf-8") as f:
+                f.write("\n")
+
+    with open(outp, "a" if resume else "w", encoding="utf-8") as fout:
+        def flush(force=False):
+            # 앞선 line이 모두 끝난 경우에만 기록 -> 최종 순서는 입력 순서와 동일
+            nonlocal next_idx, unsynced
+            while next_idx in finished:
+                for rec in finished.pop(next_idx):
                     fout.write(json.dumps(rec, ensure_ascii=False) + "\n")
-            except Exception as e:
-                fout.write(json.dumps({
-                    "input": item.get("input"),
-                    "gt": item.get("gt"),
-                    "baseline_output": f"[ERROR] {e}",
-                    "cot_output": f"[ERROR] {e}",
-                    "sample_id": None
-                }, ensure_ascii=False) + "\n")
+                    unsynced += 1
+                next_idx += 1
+            fout.flush()
+            if unsynced and (force or unsynced >= fsync_every):
+                os.fsync(fout.fileno())
+                unsynced = 0
+
+        async def worker():
+            while True:
+                job = await queue.get()
+                if job is None:
+                    return
+                idx, sample_ids, key, enqueued = job
+                state = lines[idx]
+                recs = [state["recs"][i - 1] for i in sample_ids]
+                prompt = inject_fs(VARIANT_PROMPTS[key], recs[0]["input"], state["fs"], shared_fs)
+                try:
+                    contents, usage = await chat(client, model, prompt, n=len(sample_ids),
+                                                 temperature=temperature, top_p=top_p,
+                                                 cache=cache, sample_key=sample_ids, policy=policy,
+                                                 max_tokens=max_tokens[key], fence_stop=fence_stop,
+                                                 vllm_usage_stats=vllm_usage_stats)
+                    err = None
+                except Exception as e:
+                    contents, usage, err = [None] * len(recs), None, error_info(e)
+                emit_request(metrics, key, len(sample_ids), usage, err, enqueued)
+                if usage and usage.get("cached_response"):
+                    totals["cache_hits"] += 1
+                elif err is None:
+                    totals["requests"] += 1
+                    for k in ("prompt_tokens", "completion_tokens", "cached_prompt_tokens"):
+                        totals[k] += (usage or {}).get(k) or 0
+                    finish = (usage or {}).get("finish_reasons") or []
+                    totals["fence_stops"] += finish.count("fence")
+                    totals["length_stops"] += finish.count("length")
+                for j, rec in enumerate(recs):
+                    rec[key] = contents[j]
+                    if err is not None:
+                        rec.setdefault("errors", {})[key] = err
+                    if usage:
+                        # 요청 단위 사용량 (n개 샘플이 prompt를 공유)
+                        rec.setdefault("usage", {})[key] = dict(usage, request_samples=len(sample_ids))
+                state["remaining"] -= len(sample_ids)
+                if state["remaining"] == 0:
+                    finished[idx] = [r for r in lines.pop(idx)["recs"] if r["sample_id"] in state["todo"]]
+                    metrics.emit("lemma", source="gen", line=idx + 1,
+                                 wall_s=round(time.monotonic() - state["started"], 3),
+                                 failed=sum(1 for r in finished[idx] if r.get("errors")))
+                    flush()
+
+        workers = [asyncio.create_task(worker()) for _ in range(max_concurrency)]
+
+        with open(inp, "r", encoding="utf-8") as fin:
+            for idx, line in enumerate(fin):
+                try:
+                    item = json.loads(line)
+                except Exception as e:
+                    finished[idx] = [{
+                        "input": None, "gt": None,
+                        "baseline_output": None,
+                        "cot_output": None,
+                        "sample_id": None,
+                        "errors": {"input": {"type": "invalid_json", "message": str(e), "attempts": 0}}
+                    }]
+                    flush()
+                    continue
+                lemma = item.get("input", "")
+                recs = []
+                missing = {key: [] for key in VARIANT_PROMPTS}  # variant -> 아직 생성할 sample_id
+                for i in range(1, samples + 1):
+                    rec = {"input": lemma, "baseline_output": None, "cot_output": None,
+                           "sample_id": i, "gt": item.get("gt")}
+                    prev = previous.get((lemma, i), {})
+                    for key in VARIANT_PROMPTS:
+                        if is_done(prev.get(key)):
+                            # 이미 끝난 variant는 복사해서 새 record도 완전한 형태로 기록
+                            rec[key] = prev[key]
+                            if key in prev.get("usage", {}):
+                                rec.setdefault("usage", {})[key] = prev["usage"][key]
+                        else:
+                            missing[key].append(i)
+                    recs.append(rec)
+                todo = {i for ids in missing.values() for i in ids}
+                lines[idx] = {"recs": recs, "remaining": sum(len(ids) for ids in missing.values()), "todo": todo,
+                              "started": time.monotonic(), "fs": select_fs(lemma) if todo else ""}
+                if not todo:
+                    finished[idx] = []
+                    lines.pop(idx)
+                    flush()
+                    continue
+                for key, ids in missing.items():
+                    groups = [tuple(ids)] if server_n else [(i,) for i in ids]
+                    for g in groups:
+                        if g:
+                            await queue.put((idx, g, key, time.monotonic()))
+
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        flush(force=True)
+
+    await client.close()
+    metrics.close()
+    if resume:
+        compact_output(inp, outp)
+
+    print(f"[gen] {totals['requests']} requests ({totals['cache_hits']} served from cache), "
+          f"prompt_tokens={totals['prompt_tokens']} (cached {totals['cached_prompt_tokens']}), "
+          f"completion_tokens={totals['completion_tokens']} ({totals['fence_stops']} samples cut at the closing fence, "
+          f"{totals['length_stops']} hit max_tokens); {policy.summary()}",
+          file=sys.stderr)
+    if len(client) > 1:
+        print(f"[gen] {client.summary()}", file=sys.stderr)
 
 # ---------- cli ----------
 if __name__ == "__main__":
@@ -143,12 +460,47 @@ if __name__ == "__main__":
     ap.add_argument("--input", "-i", default="./data/lemmas_short.jsonl")
     ap.add_argument("--output", "-o", default="./results/gen_results/Qwen2.5_7b_CoT_proofs.jsonl")
     ap.add_argument("--model", "-m", default="Qwen/Qwen2.5-Coder-7B-Instruct")
-    ap.add_argument("--base-url", default=DEFAULT_BASE_URL)
+    ap.add_argument("--base-url", nargs="+", default=[DEFAULT_BASE_URL],
+                    help="one or more OpenAI-compatible endpoints (space or comma separated)")
     ap.add_argument("--temperature", type=float, default=0.7)
     ap.add_argument("--top-p", type=float, default=0.8)
     ap.add_argument("--fewshot-file", type=str, default='./data/lemmas_AInvs.jsonl')
     ap.add_argument("--shots", type=int, default=4)
+    ap.add_argument("--fewshot-mode", choices=["first", "bm25"], default="first",
+                    help="first: the first --shots examples for every lemma; bm25: the most relevant ones per lemma")
+    ap.add_argument("--fewshot-budget", type=int, default=1024,
+                    help="approximate prompt-token budget of the retrieved examples (bm25 mode)")
+    ap.add_argument("--fewshot-index", default=None,
+                    help="persisted BM25 index (default: <fewshot-file>.bm25.json.gz, rebuilt when the file changes)")
     ap.add_argument("--samples", "-s", type=int, default=5, help="number of generations per lemma")
+    ap.add_argument("--max-concurrency", type=int, default=64, help="max in-flight requests per endpoint")
+    ap.add_argument("--resume", action="store_true",
+                    help="keep finished (input, sample_id, variant) results in --output and generate only the rest")
+    ap.add_argument("--fsync-every", type=int, default=32, help="fsync the output every N records")
+    ap.add_argument("--cache-dir", default=None,
+                    help="reuse responses for identical (model, prompt, sampling params, sample_id) from this directory")
+    ap.add_argument("--cache-max-mb", type=int, default=1024, help="size cap of --cache-dir (LRU eviction)")
+    ap.add_argument("--server-n", action="store_true",
+                    help="request all samples of a (lemma, variant) at once via the `n` parameter")
+    ap.add_argument("--request-timeout", type=float, default=600,
+                    help="seconds per request attempt, including reading a streamed response")
+    ap.add_argument("--max-retries", type=int, default=5,
+                    help="retries (exponential backoff with jitter) for timeouts, 429/5xx and connection errors")
+    ap.add_argument("--min-concurrency", type=int, default=1,
+                    help="lower bound of the adaptive in-flight limit (upper bound is --max-concurrency)")
+    ap.add_argument("--fixed-concurrency", action="store_true",
+                    help="always allow --max-concurrency requests instead of adapting to server load")
+    ap.add_argument("--max-tokens-baseline", type=int, default=VARIANT_MAX_TOKENS["baseline_output"],
+                    help="max generated tokens for the baseline variant")
+    ap.add_argument("--max-tokens-cot", type=int, default=VARIANT_MAX_TOKENS["cot_output"],
+                    help="max generated tokens for the CoT variant")
+    ap.add_argument("--no-fence-stop", action="store_true",
+                    help="do not stream/cut the response once the ```isabelle block is closed")
+    ap.add_argument("--vllm-usage-stats", action="store_true",
+                    help="ask a vLLM server for token usage on every streamed chunk (continuous_usage_stats), "
+                         "so responses cut at the fence report exact completion tokens")
+    ap.add_argument("--metrics", default=None, help="append per-request/per-lemma metrics events to this JSONL file")
+    ap.add_argument("--prometheus", default=None, help="also keep Prometheus text-format metrics in this file")
     args = ap.parse_args()
 
     asyncio.run(run(
@@ -160,5 +512,23 @@ if __name__ == "__main__":
         top_p=args.top_p,
         fs_file=args.fewshot_file,
         shots=args.shots,
-        samples=args.samples
+        samples=args.samples,
+        max_concurrency=args.max_concurrency,
+        server_n=args.server_n,
+        resume=args.resume,
+        fsync_every=args.fsync_every,
+        cache_dir=args.cache_dir,
+        cache_max_mb=args.cache_max_mb,
+        request_timeout=args.request_timeout,
+        max_retries=args.max_retries,
+        min_concurrency=args.min_concurrency,
+        adaptive=not args.fixed_concurrency,
+        max_tokens={"baseline_output": args.max_tokens_baseline, "cot_output": args.max_tokens_cot},
+        fence_stop=not args.no_fence_stop,
+        vllm_usage_stats=args.vllm_usage_stats,
+        metrics_path=args.metrics,
+        prom_path=args.prometheus,
+        fewshot_mode=args.fewshot_mode,
+        fewshot_budget=args.fewshot_budget,
+        fewshot_index=args.fewshot_index
     ))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Reading Isabelle ROOT files.
+
+Like thy_index.py this is a scanner rather than a full parser: it tokenizes a
+ROOT file (strings, cartouches, words, `= + ( ) [ ]`, comments dropped) and
+picks out, per `session` entry, the parent, `sessions` imports, `directories`
+and `theories`. Options, descriptions and document/export entries are
+skipped.
+
+`find_sessions(tree)` reads every ROOT file below a directory;
+`session_of_file` maps a .thy file to the session that owns it and
+`ancestors` gives the sessions one depends on (parents and `sessions` imports).
+"""
+
+import os
+import re
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|\\<open>.*?\\<close>|[=+()\[\],]|[^\s"=+()\[\],]+', re.S)
+SECTIONS = {
+    "description", "options", "sessions", "directories", "theories", "document_theories",
+    "document_files", "export_files", "export_classpath",
+}
+SKIP_DIRS = {".git", ".hg", "__pycache__", "node_modules"}
+
+
+class Session(NamedTuple):
+    name: str
+    parent: str | None
+    dir: Path                 # session directory (ROOT directory + `in` clause)
+    root_file: Path
+    theories: list[str]       # as written in ROOT, e.g. "ARM/ArchFoo" or "$L4V_ARCH/ArchFoo"
+    directories: list[str]
+    sessions: list[str]       # `sessions` imports
+    chapter: str | None = None
+
+
+def _strip_comments(text: str) -> str:
+    out, i, n, depth = [], 0, len(text), 0
+    while i < n:
+        if text.startswith("(*", i):
+            depth, i = depth + 1, i + 2
+        elif depth and text.startswith("*)", i):
+            depth, i = depth - 1, i + 2
+        elif depth:
+            i += 1
+        elif text[i] == '"':
+            j = i + 1
+            while j < n and text[j] != '"':
+                j += 2 if text[j] == "\\" else 1
+            out.append(text[i:j + 1])
+            i = j + 1
+        else:
+            out.append(text[i])
+            i += 1
+    return "".join(out)
+
+
+def _unquote(tok: str) -> str:
+    if tok.startswith('"') and tok.endswith('"'):
+        return tok[1:-1]
+    if tok.startswith("\\<open>"):
+        return tok[7:-8]
+    return tok
+
+
+def tokens(text: str) -> list[str]:
+    return TOKEN_RE.findall(_strip_comments(text))
+
+
+def _skip_group(toks: list[str], i: int, open_: str, close: str) -> int:
+    """Index just past the group opened at toks[i] (== open_)."""
+    depth = 0
+    while i < len(toks):
+        depth += (toks[i] == open_) - (toks[i] == close)
+        i += 1
+        if depth == 0:
+            break
+    return i
+
+
+def parse_root(path) -> list[Session]:
+    path = Path(path)
+    toks = tokens(path.read_text(encoding="utf-8", errors="replace"))
+    sessions, chapter, i = [], None, 0
+    while i < len(toks):
+        tok = toks[i]
+        if tok == "chapter" and i + 1 < len(toks):
+            chapter, i = _unquote(toks[i + 1]), i + 2
+            continue
+        if tok != "session" or i + 1 >= len(toks):
+            i += 1
+            continue
+        name, i = _unquote(toks[i + 1]), i + 2
+        sdir = path.parent
+        # header: [(groups)] [in DIR] = [PARENT +]
+        while i < len(toks) and toks[i] != "=":
+            if toks[i] == "(":
+                i = _skip_group(toks, i, "(", ")")
+            elif toks[i] == "in" and i + 1 < len(toks):
+                sdir, i = path.parent / _unquote(toks[i + 1]), i + 2
+            else:
+                i += 1
+        i += 1
+        parent = None
+        if i + 1 < len(toks) and toks[i + 1] == "+":
+            parent, i = _unquote(toks[i]), i + 2
+        theories, directories, imports, section = [], [], [], None
+        while i < len(toks) and toks[i] not in ("session", "chapter"):
+            tok = toks[i]
+            if tok in SECTIONS:
+                section, i = tok, i + 1
+            elif tok == "[":
+                i = _skip_group(toks, i, "[", "]")        # options / theory qualifiers
+            elif tok == "(":
+                i = _skip_group(toks, i, "(", ")")        # (global), (in dir), ...
+            else:
+                if section == "theories":
+                    theories.append(_unquote(tok))
+                elif section == "directories":
+                    directories.append(_unquote(tok))
+                elif section == "sessions":
+                    imports.append(_unquote(tok))
+                i += 1
+        sessions.append(Session(name, parent, sdir, path, theories, directories, imports, chapter))
+    return sessions
+
+
+def find_roots(tree) -> list[Path]:
+    roots = []
+    for dirpath, dirnames, filenames in os.walk(tree):
+        dirnames[:] = sorted(d for d in dirnames if d not in SKIP_DIRS and not d.startswith("."))
+        if "ROOT" in filenames:
+            roots.append(Path(dirpath) / "ROOT")
+    return roots
+
+
+def find_theories(tree) -> list[Path]:
+    out = []
+    for dirpath, dirnames, filenames in os.walk(tree):
+        dirnames[:] = sorted(d for d in dirnames if d not in SKIP_DIRS and not d.startswith("."))
+        out.extend(Path(dirpath) / f for f in sorted(filenames) if f.endswith(".thy"))
+    return out
+
+
+def find_sessions(tree) -> dict[str, Session]:
+    """Session name -> Session over every ROOT file below `tree` (first definition wins)."""
+    table: dict[str, Session] = {}
+    for root in find_roots(tree):
+        for s in parse_root(root):
+            table.setdefault(s.name, s)
+    return table
+
+
+def theory_path(session: Session, theory: str) -> Path:
+    """.thy file of a `theories` entry (environment variables such as $L4V_ARCH expanded)."""
+    return (session.dir / f"{os.path.expandvars(theory)}.thy").resolve()
+
+
+def session_of_file(sessions: dict[str, Session]) -> Callable[[Path], str | None]:
+    """
+    Returns f(path) -> session name or None. A theory listed in a session's
+    `theories` belongs to that session; otherwise the session with the
+    deepest directory (session dir or one of its `directories`) containing
+    the file wins.
+    """
+    listed: dict[Path, str] = {}
+    dirs: list[tuple[int, Path, str]] = []
+    for s in sessions.values():
+        for t in s.theories:
+            listed.setdefault(theory_path(s, t), s.name)
+        for d in [s.dir] + [s.dir / os.path.expandvars(x) for x in s.directories]:
+            d = d.resolve()
+            dirs.append((len(d.parts), d, s.name))
+    dirs.sort(key=lambda x: -x[0])
+
+    def lookup(path) -> str | None:
+        p = Path(path).resolve()
+        if p in listed:
+            return listed[p]
+        for _, d, name in dirs:
+            if p.parent == d or d in p.parents:
+                return name
+        return None
+
+    return lookup
+
+
+def ancestors(sessions: dict[str, Session], name: str) -> set[str]:
+    """Every session `name` depends on through parents and `sessions` imports (known or not)."""
+    out, todo = set(), [name]
+    while todo:
+        s = sessions.get(todo.pop())
+        if s is None:
+            continue
+        for d in [s.parent, *s.sessions]:
+            if d and d not in out:
+                out.add(d)
+                todo.append(d)
+    out.discard(name)
+    return out
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Minimal client for the Isabelle server protocol (`isabelle server`).
+
+The server keeps a session heap loaded between requests, so checking a patched
+theory with `use_theories` only pays for the theory itself instead of a cold
+`isabelle build` per candidate.
+
+Protocol summary (see the "Isabelle server" chapter of the system manual):
+- messages are a single line, or a decimal byte length on its own line
+  followed by that many bytes;
+- replies are `OK <json>` / `ERROR <json>` for synchronous commands, and
+  asynchronous tasks additionally send `NOTE`, then `FINISHED` or `FAILED`.
+"""
+
+import itertools
+import json
+import os
+import re
+import socket
+import subprocess
+import threading
+
+SERVER_INFO_RE = re.compile(r'server "([^"]+)" = ([^:\s]+):(\d+) \(password "([^"]+)"\)')
+
+
+class IsabelleServerError(RuntimeError):
+    pass
+
+
+class IsabelleServer:
+    """
+    Starts (or, for an explicit `name` that is already running, attaches to)
+    an `isabelle server` and connects to it. Without `name` every instance
+    gets its own server. Only the instance that started the server shuts it
+    down in close().
+    """
+    _instances = itertools.count()
+
+    def __init__(self, name: str | None = None, isabelle: str = "isabelle"):
+        if name is None:
+            self.name = f"proof_gen_{os.getpid()}_{next(self._instances)}"
+            self.owner = True
+        else:
+            # `isabelle server -n NAME` starts a server only if NAME is not running yet
+            self.name = name
+            self.owner = name not in self._running(isabelle)
+        cmd = [isabelle, "server", "-n", self.name]
+        try:
+            self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        except OSError as e:
+            raise IsabelleServerError(f"cannot start {' '.join(cmd)}: {e}") from e
+
+        line = self.proc.stdout.readline()
+        m = SERVER_INFO_RE.search(line)
+        if not m:
+            self.proc.kill()
+            err = self.proc.stdout.read()
+            raise IsabelleServerError(f"unexpected server banner: {line.strip() or err.strip()}")
+        host, port, password = m.group(2), int(m.group(3)), m.group(4)
+        # nobody reads the server's log output after the banner; keep the pipe from filling up
+        threading.Thread(target=self.proc.stdout.read, daemon=True).start()
+
+        try:
+            self.sock = socket.create_connection((host, port))
+        except OSError as e:
+            self.proc.kill()
+            raise IsabelleServerError(f"cannot connect to {host}:{port}: {e}") from e
+        # read the raw socket through our own buffer: a makefile() reader is unusable after a timeout
+        self._buf = bytearray()
+        self._send_raw(password)
+        kind, payload = self._read_message()
+        if kind != "OK":
+            self.close()
+            raise IsabelleServerError(f"server rejected password: {kind} {payload}")
+        self.info = payload
+
+    @staticmethod
+    def _running(isabelle: str) -> set[str]:
+        """Names of the servers listed by `isabelle server -l`."""
+        try:
+            proc = subprocess.run([isabelle, "server", "-l"], capture_output=True, text=True, timeout=60)
+        except (OSError, subprocess.TimeoutExpired):
+            return set()
+        return {m.group(1) for m in SERVER_INFO_RE.finditer(proc.stdout)}
+
+    # ---------- wire format ----------
+    def _send_raw(self, text: str):
+        data = text.encode("utf-8")
+        if b"\n" in data:
+            data = str(len(data)).encode("ascii") + b"\n" + data
+        else:
+            data = data + b"\n"
+        self.sock.sendall(data)
+
+    def _recv_more(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise IsabelleServerError("server closed the connection")
+        self._buf += chunk
+
+    def _read_message(self) -> tuple[str, object]:
+        """
+        Reads one message. Bytes are only consumed once the whole message is
+        buffered, so after a socket timeout reading can simply resume.
+        """
+        while True:
+            i = self._buf.find(b"\n")
+            if i >= 0:
+                head = self._buf[:i].decode("utf-8")
+                if not head.isdigit():
+                    text, end = head, i + 1
+                    break
+                if len(self._buf) >= i + 1 + int(head):
+                    end = i + 1 + int(head)
+                    text = self._buf[i + 1:end].decode("utf-8")
+                    break
+            self._recv_more()
+        del self._buf[:end]
+        kind, _, rest = text.partition(" ")
+        payload = json.loads(rest) if rest.strip() else None
+        return kind, payload
+
+    def _send(self, command: str, args=None):
+        self._send_raw(command if args is None else f"{command} {json.dumps(args)}")
+
+    # ---------- commands ----------
+    def command(self, command: str, args=None):
+        """Synchronous command: returns the payload of `OK`, raises on `ERROR`."""
+        self._send(command, args)
+        while True:
+            kind, payload = self._read_message()
+            if kind == "OK":
+                return payload
+            if kind == "ERROR":
+                raise IsabelleServerError(f"{command}: {payload}")
+            # stray NOTE/FINISHED of an earlier (cancelled) task
+
+    def task(self, command: str, args=None, timeout: float | None = None):
+        """
+        Asynchronous command: waits for `FINISHED` and returns its payload.
+        Raises IsabelleServerError on `FAILED` and subprocess.TimeoutExpired
+        (after cancelling the task) when `timeout` seconds pass without an answer.
+        """
+        task_id = self.command(command, args)["task"]
+        self.sock.settimeout(timeout)
+        try:
+            while True:
+                try:
+                    kind, payload = self._read_message()
+                except socket.timeout:
+                    self.sock.settimeout(None)
+                    self._send("cancel", {"task": task_id})
+                    raise subprocess.TimeoutExpired(command, timeout)
+                if not isinstance(payload, dict) or payload.get("task") != task_id:
+                    continue
+                if kind == "FINISHED":
+                    return payload
+                if kind == "FAILED":
+                    raise IsabelleServerError(f"{command}: {payload.get('message', payload)}")
+        finally:
+            self.sock.settimeout(None)
+
+    def session_start(self, session: str, dirs: list[str] | None = None, options: list[str] | None = None,
+                      timeout: float | None = None) -> str:
+        args = {"session": session}
+        if dirs:
+            args["dirs"] = dirs
+        if options:
+            args["options"] = options
+        return self.task("session_start", args, timeout=timeout)["session_id"]
+
+    def use_theories(self, session_id: str, theories: list[str], master_dir: str | None = None,
+                     timeout: float | None = None) -> dict:
+        args = {"session_id": session_id, "theories": theories}
+        if master_dir:
+            args["master_dir"] = master_dir
+        return self.task("use_theories", args, timeout=timeout)
+
+    def purge_theories(self, session_id: str, theories: list[str], master_dir: str | None = None):
+        args = {"session_id": session_id, "theories": theories}
+        if master_dir:
+            args["master_dir"] = master_dir
+        return self.command("purge_theories", args)
+
+    def session_stop(self, session_id: str, timeout: float | None = None):
+        return self.task("session_stop", {"session_id": session_id}, timeout=timeout)
+
+    def close(self):
+        if self.owner:
+            try:
+                self.command("shutdown")
+            except Exception:
+                pass
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
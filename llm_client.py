@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Request policy for the OpenAI-compatible LLM client.
+
+`RequestPolicy.call(make_request)` runs one request with a per-attempt
+timeout, retries retryable failures with exponential backoff and full jitter
+(honouring `Retry-After` when the server sends one), and raises `LLMError`
+with a structured `kind` once it gives up.
+
+Concurrency goes through an `AdaptiveLimiter` (AIMD): the in-flight limit
+grows by about one per window of successful requests and is multiplied by
+`decrease` when the server shows overload (timeouts, 429/5xx, connection
+errors, or a latency EWMA well above the best seen so far). At most one
+decrease happens per latency period, so a burst of failures from the same
+overload episode does not collapse the limit to the minimum.
+
+`Router` spreads requests over several OpenAI-compatible endpoints (e.g. one
+vLLM replica per GPU): each request goes to the healthy replica with the
+fewest outstanding requests (`Router.attempt` also keeps the reading of a
+streamed response on that replica and under its timeout). A replica is
+ejected after `eject_after` consecutive overload failures and probed with `GET /models` in the background;
+it is readmitted once a probe succeeds (ejected replicas are probed with
+doubling backoff, healthy ones every `health_interval` seconds).
+"""
+
+import asyncio
+import random
+import time
+
+import openai
+from openai import AsyncOpenAI
+
+# kind -> retryable
+ERROR_KINDS = {
+    "timeout": True,
+    "connection": True,
+    "rate_limited": True,
+    "server_error": True,
+    "incomplete": True,
+    "bad_request": False,
+    "auth": False,
+    "not_found": False,
+    "unexpected": False,
+}
+# kinds that mean the server is overloaded and concurrency should go down
+OVERLOAD_KINDS = {"timeout", "connection", "rate_limited", "server_error"}
+
+
+class LLMError(Exception):
+    def __init__(self, kind: str, message: str, attempts: int = 1, status: int | None = None):
+        super().__init__(f"{kind}: {message}")
+        self.kind = kind
+        self.message = message
+        self.attempts = attempts
+        self.status = status
+
+    def to_dict(self) -> dict:
+        d = {"type": self.kind, "message": self.message, "attempts": self.attempts}
+        if self.status is not None:
+            d["status"] = self.status
+        return d
+
+
+def classify(exc: BaseException) -> tuple[str, int | None]:
+    """(kind, HTTP status) of an exception raised by a request."""
+    if isinstance(exc, LLMError):
+        return exc.kind, exc.status
+    if isinstance(exc, (asyncio.TimeoutError, openai.APITimeoutError)):
+        return "timeout", None
+    if isinstance(exc, openai.APIConnectionError):
+        return "connection", None
+    # errors of the HTTP transport (httpx) are raised as-is while iterating a streamed response;
+    # matched by class name so that no particular httpx package has to be importable here
+    bases = {c.__name__ for c in type(exc).__mro__}
+    if "TimeoutException" in bases:
+        return "timeout", None
+    if "TransportError" in bases or isinstance(exc, ConnectionError):
+        return "connection", None
+    if isinstance(exc, openai.APIStatusError):
+        status = exc.status_code
+        if status == 429:
+            return "rate_limited", status
+        if status in (401, 403):
+            return "auth", status
+        if status == 404:
+            return "not_found", status
+        if status in (408, 409) or status >= 500:
+            return "server_error", status
+        return "bad_request", status
+    return "unexpected", None
+
+
+def retry_after(exc: BaseException) -> float | None:
+    response = getattr(exc, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class AdaptiveLimiter:
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: int | None = None, decrease: float = 0.7,
+                 latency_tolerance: float = 2.0, ewma_alpha: float = 0.2, adaptive: bool = True):
+        self.max_limit = max_limit or initial
+        self.min_limit = min(min_limit, self.max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.ewma_alpha = ewma_alpha
+        self.adaptive = adaptive
+        self.inflight = 0
+        self.latency_ewma = None
+        self.best_ewma = None
+        self.samples = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+
+    async def release(self, latency: float | None, overloaded: bool):
+        async with self._cond:
+            self.inflight -= 1
+            if self.adaptive:
+                self._update(latency, overloaded)
+            self._cond.notify_all()
+
+    def _update(self, latency: float | None, overloaded: bool):
+        if latency is not None and not overloaded:
+            self.samples += 1
+            a = self.ewma_alpha
+            self.latency_ewma = latency if self.latency_ewma is None else (1 - a) * self.latency_ewma + a * latency
+            if self.samples >= 10:
+                self.best_ewma = min(self.best_ewma or self.latency_ewma, self.latency_ewma)
+        slow = (self.best_ewma is not None and self.latency_ewma > self.latency_tolerance * self.best_ewma)
+        if overloaded or slow:
+            t = time.monotonic()
+            if t - self._last_decrease >= (self.latency_ewma or 1.0):
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self._last_decrease = t
+                self.decreases += 1
+        else:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+
+class RequestPolicy:
+    def __init__(self, limiter: AdaptiveLimiter, timeout: float | None = 600, max_retries: int = 5,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0):
+        self.limiter = limiter
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = 0
+        self.failures = 0
+
+    async def call(self, make_request):
+        """
+        Awaits `make_request()` (a fresh coroutine per attempt) under the limiter.
+        `make_request` may raise LLMError("incomplete", ...) itself to ask for a retry.
+        """
+        for attempt in range(1, self.max_retries + 2):
+            await self.limiter.acquire()
+            t0 = time.monotonic()
+            try:
+                result = await asyncio.wait_for(make_request(), self.timeout)
+            except asyncio.CancelledError:
+                await self.limiter.release(None, False)
+                raise
+            except Exception as e:
+                kind, status = classify(e)
+                await self.limiter.release(None, kind in OVERLOAD_KINDS)
+                if not ERROR_KINDS[kind] or attempt > self.max_retries:
+                    self.failures += 1
+                    message = e.message if isinstance(e, LLMError) else (str(e) or type(e).__name__)
+                    raise LLMError(kind, message, attempts=attempt, status=status) from e
+                self.retries += 1
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+                await asyncio.sleep(max(delay, retry_after(e) or 0))
+            else:
+                await self.limiter.release(time.monotonic() - t0, False)
+                return result
+
+    def summary(self) -> str:
+        lim = self.limiter
+        return (f"{self.retries} retries, {self.failures} failed requests, concurrency limit {int(lim.limit)} "
+                f"({lim.decreases} decreases)")
+
+
+def parse_base_urls(values) -> list[str]:
+    """`--base-url` values: one or more URLs, each possibly a comma-separated list."""
+    if isinstance(values, str):
+        values = [values]
+    return [u.strip() for v in values for u in v.split(",") if u.strip()]
+
+
+class Replica:
+    def __init__(self, base_url: str, timeout: float | None):
+        self.base_url = base_url
+        self.client = AsyncOpenAI(api_key="EMPTY", base_url=base_url, max_retries=0, timeout=timeout)
+        self.outstanding = 0
+        self.failures = 0          # consecutive
+        self.healthy = True
+        self.probe_delay = 0.0
+        self.next_probe = 0.0
+        self.requests = 0
+        self.ejections = 0
+
+
+class Router:
+    def __init__(self, base_urls: list[str], timeout: float | None = 600, eject_after: int = 3,
+                 health_interval: float = 10.0, max_probe_delay: float = 300.0):
+        if not base_urls:
+            raise ValueError("no base url given")
+        self.replicas = [Replica(u, timeout) for u in base_urls]
+        self.timeout = timeout
+        self.eject_after = eject_after
+        self.health_interval = health_interval
+        self.max_probe_delay = max_probe_delay
+        self._rr = 0
+        self._health_task = None
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def start(self):
+        if self._health_task is None and len(self.replicas) > 1:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+
+    def pick(self) -> Replica:
+        pool = [r for r in self.replicas if r.healthy] or self.replicas
+        least = min(r.outstanding for r in pool)
+        ties = [r for r in pool if r.outstanding == least]
+        # rotate among ties so an idle fleet is filled evenly
+        self._rr = (self._rr + 1) % len(ties)
+        return ties[self._rr]
+
+    def _eject(self, rep: Replica):
+        if rep.healthy:
+            rep.healthy = False
+            rep.ejections += 1
+            rep.probe_delay = self.health_interval
+            rep.next_probe = time.monotonic() + rep.probe_delay
+
+    def _readmit(self, rep: Replica):
+        rep.healthy, rep.failures, rep.probe_delay = True, 0, 0.0
+
+    async def attempt(self, body):
+        """
+        Runs `body(create)` on the least loaded healthy replica, `create` being
+        its chat.completions.create. The timeout covers the whole of `body`,
+        including reading a streamed response, and an overload failure anywhere
+        in it counts toward ejecting the replica.
+        """
+        rep = self.pick()
+        rep.outstanding += 1
+        rep.requests += 1
+        try:
+            r = await asyncio.wait_for(body(rep.client.chat.completions.create), self.timeout)
+        except Exception as e:
+            if classify(e)[0] in OVERLOAD_KINDS:
+                rep.failures += 1
+                if rep.failures >= self.eject_after:
+                    self._eject(rep)
+            raise
+        finally:
+            rep.outstanding -= 1
+        rep.failures = 0
+        return r
+
+    async def create(self, **kwargs):
+        """chat.completions.create on the least loaded healthy replica."""
+        return await self.attempt(lambda create: create(**kwargs))
+
+    async def _probe(self, rep: Replica) -> bool:
+        try:
+            await asyncio.wait_for(rep.client.models.list(), min(self.health_interval, self.timeout or 30))
+            return True
+        except Exception:
+            return False
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            t = time.monotonic()
+            due = [r for r in self.replicas if r.healthy or t >= r.next_probe]
+            for rep, ok in zip(due, await asyncio.gather(*(self._probe(r) for r in due))):
+                if ok and not rep.healthy:
+                    self._readmit(rep)
+                elif not ok and rep.healthy:
+                    self._eject(rep)
+                elif not ok:
+                    rep.probe_delay = min(self.max_probe_delay, rep.probe_delay * 2)
+                    rep.next_probe = time.monotonic() + rep.probe_delay
+
+    def summary(self) -> str:
+        return ", ".join(f"{r.base_url}: {r.requests} requests, {r.ejections} ejections"
+                         + ("" if r.healthy else " (down)") for r in self.replicas)
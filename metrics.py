@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Structured performance telemetry for gen_proof.py, eval.py and pipeline.py.
+
+`Metrics(path, prom_path)` appends one JSON object per event to `path`
+({"ts": unix time, "run": run id, "event": ..., fields...}) and, if `prom_path` is given,
+keeps counters/histograms of the same events and rewrites that file in
+Prometheus text format (for node_exporter's textfile collector) every few
+seconds and on close. `Metrics()` without paths is a no-op.
+
+Events:
+  llm_request  variant, n, latency_s, ttft_s, queue_wait_s, prompt_tokens,
+               completion_tokens, cached, error
+  build        backend, wall_s, build_time, peak_rss_kb, success, returncode
+  lemma        source (gen/eval/pipeline), line, queue_wait_s, wall_s, ...
+
+Summary of one or more metrics files:
+  python3 metrics.py summary ./results/metrics.jsonl
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, float("inf"))
+HISTOGRAMS = {
+    ("llm_request", "latency_s"): "proof_gen_llm_latency_seconds",
+    ("llm_request", "ttft_s"): "proof_gen_llm_ttft_seconds",
+    ("llm_request", "queue_wait_s"): "proof_gen_llm_queue_wait_seconds",
+    ("build", "wall_s"): "proof_gen_build_seconds",
+    ("lemma", "queue_wait_s"): "proof_gen_lemma_queue_wait_seconds",
+}
+COUNTERS = {
+    ("llm_request", "prompt_tokens"): "proof_gen_prompt_tokens_total",
+    ("llm_request", "completion_tokens"): "proof_gen_completion_tokens_total",
+}
+MAX_GAUGES = {
+    ("build", "peak_rss_kb"): "proof_gen_build_peak_rss_kb",
+}
+
+
+class Metrics:
+    def __init__(self, path=None, prom_path=None, prom_every: float = 10.0):
+        self.path = path
+        self.prom_path = prom_path
+        self.prom_every = prom_every
+        self.run_id = f"{os.getpid()}-{int(time.time())}"
+        self._lock = threading.Lock()
+        self._f = None
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._f = open(path, "a", encoding="utf-8")
+        self._events = defaultdict(int)
+        self._hist = defaultdict(lambda: [0] * len(BUCKETS))   # name -> bucket counts
+        self._hist_sum = defaultdict(float)
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._last_prom = 0.0
+
+    def __bool__(self):
+        return bool(self.path or self.prom_path)
+
+    def emit(self, event: str, **fields):
+        if not self:
+            return
+        rec = {"ts": round(time.time(), 3), "run": self.run_id, "event": event, **fields}
+        with self._lock:
+            if self._f is not None:
+                self._f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                self._f.flush()
+            if self.prom_path:
+                self._observe(event, fields)
+                if time.monotonic() - self._last_prom >= self.prom_every:
+                    self._write_prom()
+
+    def _observe(self, event: str, fields: dict):
+        self._events[event] += 1
+        for (ev, field), name in HISTOGRAMS.items():
+            v = fields.get(field)
+            if ev == event and isinstance(v, (int, float)):
+                counts = self._hist[name]
+                for i, b in enumerate(BUCKETS):
+                    if v <= b:
+                        counts[i] += 1
+                self._hist_sum[name] += v
+        for (ev, field), name in COUNTERS.items():
+            v = fields.get(field)
+            if ev == event and isinstance(v, (int, float)):
+                self._counters[name] += v
+        for (ev, field), name in MAX_GAUGES.items():
+            v = fields.get(field)
+            if ev == event and isinstance(v, (int, float)):
+                self._gauges[name] = max(self._gauges.get(name, 0), v)
+
+    def _write_prom(self):
+        lines = ["# TYPE proof_gen_events_total counter"]
+        lines += [f'proof_gen_events_total{{event="{e}"}} {n}' for e, n in sorted(self._events.items())]
+        for name in sorted(self._hist):
+            lines.append(f"# TYPE {name} histogram")
+            for b, c in zip(BUCKETS, self._hist[name]):
+                le = "+Inf" if b == float("inf") else f"{b:g}"
+                lines.append(f'{name}_bucket{{le="{le}"}} {c}')
+            lines.append(f"{name}_sum {self._hist_sum[name]:.6f}")
+            lines.append(f"{name}_count {self._hist[name][-1]}")
+        for name in sorted(self._counters):
+            lines += [f"# TYPE {name} counter", f"{name} {self._counters[name]:g}"]
+        for name in sorted(self._gauges):
+            lines += [f"# TYPE {name} gauge", f"{name} {self._gauges[name]:g}"]
+        tmp = f"{self.prom_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.prom_path)
+        self._last_prom = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self.prom_path:
+                self._write_prom()
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+
+# ---------- summary ----------
+def percentile(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(paths: list[str]) -> dict:
+    events = defaultdict(list)
+    spans = {}      # run id -> (first ts, last ts); runs appended to one file are added up
+    for p in paths:
+        with open(p, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    continue
+                events[r.get("event")].append(r)
+                t = r.get("ts", 0)
+                lo, hi = spans.get((p, r.get("run")), (t, t))
+                spans[(p, r.get("run"))] = (min(lo, t), max(hi, t))
+    hours = sum(hi - lo for lo, hi in spans.values()) / 3600
+
+    def series(event, field, pred=lambda r: True):
+        return [r[field] for r in events[event] if isinstance(r.get(field), (int, float)) and pred(r)]
+
+    def pct(event, field, pred=lambda r: True):
+        v = series(event, field, pred)
+        return {"p50": percentile(v, 50), "p95": percentile(v, 95), "n": len(v)}
+
+    live = lambda r: not r.get("cached")
+    builds = events["build"]
+    lemmas = events["lemma"]
+    out = {
+        "wall_hours": round(hours, 4),
+        "lemmas": len(lemmas),
+        "lemmas_per_hour": len(lemmas) / hours if hours else None,
+        "llm_requests": len(series("llm_request", "latency_s", live)),
+        "llm_errors": sum(1 for r in events["llm_request"] if r.get("error")),
+        "prompt_tokens": sum(series("llm_request", "prompt_tokens", live)),
+        "completion_tokens": sum(series("llm_request", "completion_tokens", live)),
+        "builds": len(builds),
+        "builds_per_hour": len(builds) / hours if hours else None,
+        "latency_s": pct("llm_request", "latency_s", live),
+        "ttft_s": pct("llm_request", "ttft_s", live),
+        "llm_queue_wait_s": pct("llm_request", "queue_wait_s"),
+        "build_wall_s": pct("build", "wall_s"),
+        "lemma_queue_wait_s": pct("lemma", "queue_wait_s"),
+        "build_peak_rss_kb": pct("build", "peak_rss_kb"),
+    }
+    out["completion_tokens_per_s"] = out["completion_tokens"] / (hours * 3600) if hours else None
+    out["max_peak_rss_kb"] = max(series("build", "peak_rss_kb"), default=None)
+    return out
+
+
+def _fmt(v) -> str:
+    if v is None:
+        return "-"
+    return f"{v:.3f}" if isinstance(v, float) else str(v)
+
+
+def print_summary(s: dict):
+    print(f"wall time          {s['wall_hours'] * 60:.1f} min")
+    print(f"lemmas             {s['lemmas']}  ({_fmt(s['lemmas_per_hour'])} / hour)")
+    print(f"llm requests       {s['llm_requests']}  ({s['llm_errors']} failed)")
+    print(f"tokens             prompt {s['prompt_tokens']}, completion {s['completion_tokens']} "
+          f"({_fmt(s['completion_tokens_per_s'])} completion tokens/s)")
+    print(f"builds             {s['builds']}  ({_fmt(s['builds_per_hour'])} / hour), "
+          f"max peak RSS {_fmt(s['max_peak_rss_kb'])} kB")
+    print(f"{'':18} {'p50':>10} {'p95':>10} {'n':>8}")
+    for key in ("latency_s", "ttft_s", "llm_queue_wait_s", "build_wall_s", "lemma_queue_wait_s"):
+        d = s[key]
+        print(f"{key:18} {_fmt(d['p50']):>10} {_fmt(d['p95']):>10} {d['n']:>8}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Telemetry tools")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sp = sub.add_parser("summary", help="throughput and latency percentiles of metrics JSONL files")
+    sp.add_argument("files", nargs="+")
+    sp.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = ap.parse_args()
+
+    s = summarize(args.files)
+    if args.json:
+        print(json.dumps(s, indent=2))
+    else:
+        print_summary(s)
+
+
+if __name__ == "__main__":
+    main()
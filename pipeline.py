@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Streaming generate -> verify pipeline.
+
+gen_proof.py followed by eval.py generates every sample of every lemma before
+the first build runs. Here each generated variant goes through the static
+pre-filter and into a verification queue as soon as its response arrives, and
+a lemma stops generating and checking further samples once one candidate
+passes.
+
+Per lemma at most --per-lemma-inflight candidates are outstanding (being
+generated or waiting for a verdict), so a solved lemma does not leave a tail
+of useless samples behind; throughput comes from running --max-lemmas lemmas
+at once over --max-concurrency LLM requests and --verify-workers checkers.
+
+Outputs:
+- --gen-output: the generations, in the same format as gen_proof.py (one
+  record per (lemma, sample_id), written when the lemma is finished);
+- --report: eval.py report records with an extra "sample_id", in completion
+  order; candidates dropped because their lemma was already solved get
+  {"result": "skipped", "reason": "solved"}, and every finished lemma gets a
+  {"result": "lemma_summary"} record with its repair rounds and tokens.
+
+With --repair-rounds N a failed candidate is not just dropped: the first
+Isabelle error inside it (message, failing line, goal state) goes back to the
+model through REPAIR_PROMPT and the revised proof is checked again, up to N
+times per candidate or until the lemma's --repair-token-budget is spent.
+Repairs are cheapest with --target-only (only the candidate is really
+checked) or --backend server.
+
+A candidate whose canonical form (candidate_rank.canonical_key: layout,
+comments and simp-argument order ignored) was already checked for the same
+lemma is not built again; its report record repeats the earlier verdict with
+"duplicate_of".
+
+Usage:
+  python3 pipeline.py \
+      --input ./data/lemmas_short.jsonl \
+      --thy ./CorresK_Lemmas.thy --session CorresK --root . \
+      --gen-output ./results/gen.jsonl --report ./results/report.jsonl \
+      [--verify-workers 4 --backend server]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from candidate_rank import canonical_key
+from disk_cache import DiskCache
+from eval import (error_record, first_error, lemma_name_from_input, now, open_checkers, plan_item,
+                  result_record)
+from gen_proof import (DEFAULT_BASE_URL, VARIANT_MAX_TOKENS, VARIANT_PROMPTS, chat, emit_request, error_info,
+                       fewshot_selector, inject_fs)
+from llm_client import AdaptiveLimiter, RequestPolicy, Router, parse_base_urls
+from metrics import Metrics
+from prompt import REPAIR_PROMPT
+from thy_index import ThyIndex
+
+
+def repair_feedback(err: dict | None, code: str, span: tuple[int, int] | None) -> str:
+    """Error description for REPAIR_PROMPT: position in the attempt, failing line, message and goal state."""
+    if err is None:
+        return "The proof was rejected (no error message was reported)."
+    parts = []
+    if err["line"] is not None and span and span[0] <= err["line"] <= span[1]:
+        lines = code.splitlines()
+        rel = err["line"] - span[0]
+        where = f"Line {rel + 1} of the previous attempt"
+        if rel < len(lines):
+            where += f": {lines[rel].strip()}"
+        parts.append(where)
+    if err["command"]:
+        parts.append(f'At command "{err["command"]}"')
+    parts.append(err["message"] or "Error")
+    if err["goal"]:
+        parts.append(err["goal"])
+    return "\n".join(parts)
+
+
+class LemmaState:
+    def __init__(self, line_no: int, item: dict, samples: int, inflight: int):
+        self.line_no = line_no
+        self.lemma = item.get("input", "")
+        self.fs = ""
+        self.gt = item.get("gt")
+        self.recs = {}                     # sample_id -> generation record
+        self.solved = False
+        self.gen_tasks: set[asyncio.Task] = set()
+        self.permits = asyncio.Semaphore(inflight)
+        self.inflight = inflight
+        self.jobs = [(i, key) for i in range(1, samples + 1) for key in VARIANT_PROMPTS]
+        self.rounds = 0                    # deepest repair round reached
+        self.repairs = 0                   # repair requests answered
+        self.tokens = 0                    # prompt + completion tokens, generation and repair
+        self.repair_tokens = 0
+        self.verdicts: dict[str, dict] = {}    # canonical_key -> report record of its first check
+
+    def add_usage(self, usage: dict | None, repair: bool = False):
+        n = ((usage or {}).get("prompt_tokens") or 0) + ((usage or {}).get("completion_tokens") or 0)
+        self.tokens += n
+        if repair:
+            self.repair_tokens += n
+
+    def record(self, sample_id: int) -> dict:
+        if sample_id not in self.recs:
+            self.recs[sample_id] = {"input": self.lemma, "baseline_output": None, "cot_output": None,
+                                    "sample_id": sample_id, "gt": self.gt}
+        return self.recs[sample_id]
+
+
+async def run(args):
+    thy_path = Path(args.thy).resolve()
+    root_path = Path(args.root).resolve()
+    thy = ThyIndex.from_file(thy_path)
+    for p in (args.gen_output, args.report):
+        if os.path.dirname(p):
+            os.makedirs(os.path.dirname(p), exist_ok=True)
+
+    client = Router(parse_base_urls(args.base_url), timeout=args.request_timeout)
+    client.start()
+    max_concurrency = args.max_concurrency * len(client)
+    policy = RequestPolicy(AdaptiveLimiter(max_concurrency, min_limit=args.min_concurrency,
+                                           adaptive=not args.fixed_concurrency),
+                           timeout=None, max_retries=args.max_retries)
+    select_fs, shared_fs = fewshot_selector(args.fewshot_file, args.shots, args.fewshot_mode,
+                                            args.fewshot_budget, args.fewshot_index)
+    llm_cache = (DiskCache(args.llm_cache_dir, max_bytes=args.llm_cache_max_mb * 1024 * 1024)
+                 if args.llm_cache_dir else None)
+    requests = asyncio.Semaphore(max_concurrency)
+    max_tokens = {"baseline_output": args.max_tokens_baseline, "cot_output": args.max_tokens_cot}
+    lemma_slots = asyncio.Semaphore(args.max_lemmas)
+    verify_q = asyncio.Queue()
+    stats = {"lemmas": 0, "solved": 0, "generated": 0, "gen_errors": 0, "gen_cancelled": 0,
+             "gen_not_started": 0, "checks": 0, "checks_skipped": 0, "checks_deduped": 0, "repairs": 0}
+
+    metrics = Metrics(args.metrics, args.prometheus)
+    with open_checkers(args, thy, thy_path, root_path, metrics) as checkers, \
+            open(args.gen_output, "w", encoding="utf-8") as gen_out, \
+            open(args.report, "w", encoding="utf-8") as report:
+
+        def write_report(rec: dict):
+            report.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            report.flush()
+
+        def mark_solved(state: LemmaState):
+            if state.solved:
+                return
+            state.solved = True
+            stats["solved"] += 1
+            for t in state.gen_tasks:
+                t.cancel()
+
+        def spawn(state: LemmaState, coro):
+            """
+            Runs a generate/repair coroutine that owns one of the lemma's permits.
+            The coroutine gives the permit back itself, except when mark_solved
+            cancels the task before its first step: then its body (and finally)
+            never runs, so the permit is returned here.
+            """
+            started = False
+
+            async def body():
+                nonlocal started
+                started = True
+                await coro
+
+            def done(t: asyncio.Task):
+                state.gen_tasks.discard(t)
+                if not started:
+                    coro.close()
+                    stats["gen_not_started"] += 1
+                    state.permits.release()
+
+            t = asyncio.create_task(body())
+            state.gen_tasks.add(t)
+            t.add_done_callback(done)
+
+        async def enqueue(state: LemmaState, sample_id: int, key: str, text: str, round_: int = 0) -> bool:
+            """Pre-filters one generated variant; True if a candidate went to the verify queue."""
+            handed_off = False
+            item = {"input": state.lemma, key: text}
+            for slot in plan_item(state.line_no, item, thy, thy_path, prefilter=not args.no_prefilter):
+                slot["sample_id"] = sample_id
+                if round_:
+                    slot["round"] = round_
+                if "code" in slot:
+                    await verify_q.put((state, slot))
+                    handed_off = True
+                else:
+                    write_report(slot)
+            return handed_off
+
+        async def generate(state: LemmaState, sample_id: int, key: str):
+            # Holds one of the lemma's permits; it is handed to the verify queue
+            # together with the candidate, or released here if there is none.
+            handed_off = False
+            enqueued = time.monotonic()
+            try:
+                async with requests:
+                    if state.solved:
+                        return
+                    prompt = inject_fs(VARIANT_PROMPTS[key], state.lemma, state.fs, shared_fs)
+                    try:
+                        contents, usage = await chat(client, args.model, prompt, temperature=args.temperature,
+                                                     top_p=args.top_p, cache=llm_cache, sample_key=(sample_id,),
+                                                     policy=policy, max_tokens=max_tokens[key],
+                                                     fence_stop=not args.no_fence_stop,
+                                                     vllm_usage_stats=args.vllm_usage_stats)
+                    except asyncio.CancelledError:
+                        stats["gen_cancelled"] += 1
+                        raise
+                    except Exception as e:
+                        stats["gen_errors"] += 1
+                        state.record(sample_id).setdefault("errors", {})[key] = error_info(e)
+                        emit_request(metrics, key, 1, None, error_info(e), enqueued)
+                        return
+                emit_request(metrics, key, 1, usage, None, enqueued)
+                stats["generated"] += 1
+                state.add_usage(usage)
+                rec = state.record(sample_id)
+                rec[key] = contents[0]
+                if usage:
+                    rec.setdefault("usage", {})[key] = usage
+                handed_off = await enqueue(state, sample_id, key, contents[0])
+            finally:
+                if not handed_off:
+                    state.permits.release()
+
+        async def repair(state: LemmaState, slot: dict, feedback: str):
+            # Takes over the permit of the failed candidate, like generate
+            handed_off = False
+            enqueued = time.monotonic()
+            sample_id, key, round_ = slot["sample_id"], slot["variant"], slot.get("round", 0) + 1
+            try:
+                async with requests:
+                    if state.solved:
+                        return
+                    prompt = REPAIR_PROMPT.format(state.lemma, slot["code"], feedback)
+                    try:
+                        contents, usage = await chat(client, args.model, prompt, temperature=args.temperature,
+                                                     top_p=args.top_p, cache=llm_cache, sample_key=(sample_id,),
+                                                     policy=policy, max_tokens=max_tokens["baseline_output"],
+                                                     fence_stop=not args.no_fence_stop,
+                                                     vllm_usage_stats=args.vllm_usage_stats)
+                    except asyncio.CancelledError:
+                        stats["gen_cancelled"] += 1
+                        raise
+                    except Exception as e:
+                        stats["gen_errors"] += 1
+                        emit_request(metrics, "repair", 1, None, error_info(e), enqueued)
+                        return
+                emit_request(metrics, "repair", 1, usage, None, enqueued)
+                stats["repairs"] += 1
+                state.repairs += 1
+                state.rounds = max(state.rounds, round_)
+                state.add_usage(usage, repair=True)
+                state.record(sample_id).setdefault("repairs", []).append(
+                    {"variant": key, "round": round_, "output": contents[0], **({"usage": usage} if usage else {})})
+                handed_off = await enqueue(state, sample_id, key, contents[0], round_)
+            finally:
+                if not handed_off:
+                    state.permits.release()
+
+        def can_repair(state: LemmaState, slot: dict) -> bool:
+            return (not state.solved and slot.get("round", 0) < args.repair_rounds
+                    and not (args.repair_token_budget and state.repair_tokens >= args.repair_token_budget))
+
+        async def verify_worker(checker):
+            while True:
+                job = await verify_q.get()
+                if job is None:
+                    return
+                state, slot = job
+                handed_off = False
+                try:
+                    line_no, variant_key, lemma_name = slot["line"], slot["variant"], slot["lemma"]
+                    if state.solved:
+                        stats["checks_skipped"] += 1
+                        write_report({"time": now(), "line": line_no, "variant": variant_key, "lemma": lemma_name,
+                                      "sample_id": slot["sample_id"], "result": "skipped", "reason": "solved"})
+                        continue
+                    key = canonical_key(slot["code"])
+                    prev = state.verdicts.get(key)
+                    if prev is not None:
+                        # already checked (and, if it failed, already handed to repair)
+                        stats["checks_deduped"] += 1
+                        rec = {k: v for k, v in prev.items() if k != "round"}
+                        rec.update(time=now(), line=line_no, variant=variant_key, sample_id=slot["sample_id"],
+                                   duplicate_of={"sample_id": prev["sample_id"], "variant": prev["variant"]},
+                                   **({"round": slot["round"]} if slot.get("round") else {}))
+                        write_report(rec)
+                        continue
+                    new_thy_text, spans = thy.replace({lemma_name: slot["code"]})
+                    stats["checks"] += 1
+                    feedback = None
+                    try:
+                        res = await asyncio.to_thread(checker.check, new_thy_text)
+                    except subprocess.TimeoutExpired as te:
+                        rec = error_record(line_no, variant_key, lemma_name, f"timeout: {te}", args, thy_path)
+                        feedback = f"Isabelle did not finish checking this proof within {args.timeout} seconds."
+                    except Exception as e:
+                        rec = error_record(line_no, variant_key, lemma_name, f"{type(e).__name__}: {e}",
+                                           args, thy_path)
+                    else:
+                        rec = result_record(line_no, variant_key, lemma_name, res, args, thy_path)
+                        if res["returncode"] == 0 and not args.no_early_stop:
+                            mark_solved(state)
+                        elif res["returncode"] != 0:
+                            err = first_error(res["stdout"] + "\n" + res["stderr"], thy_path.name,
+                                              spans.get(lemma_name))
+                            feedback = repair_feedback(err, slot["code"], spans.get(lemma_name))
+                    rec["sample_id"] = slot["sample_id"]
+                    if slot.get("round"):
+                        rec["round"] = slot["round"]
+                    if "error" not in rec or rec["error"].startswith("timeout"):
+                        state.verdicts[key] = rec
+                    write_report(rec)
+                    if feedback and can_repair(state, slot):
+                        spawn(state, repair(state, slot, feedback))
+                        handed_off = True
+                finally:
+                    if not handed_off:
+                        state.permits.release()
+
+        async def drive(state: LemmaState):
+            t0 = time.monotonic()
+            try:
+                for n, (sample_id, key) in enumerate(state.jobs):
+                    await state.permits.acquire()
+                    if state.solved:
+                        state.permits.release()
+                        stats["gen_not_started"] += len(state.jobs) - n
+                        break
+                    spawn(state, generate(state, sample_id, key))
+                # every permit back = nothing generating, repairing or waiting for a verdict
+                for _ in range(state.inflight):
+                    await state.permits.acquire()
+                for sample_id in sorted(state.recs):
+                    gen_out.write(json.dumps(state.recs[sample_id], ensure_ascii=False) + "\n")
+                gen_out.flush()
+                summary = {"solved": state.solved, "samples": len(state.recs), "repair_rounds": state.rounds,
+                           "repairs": state.repairs, "tokens": state.tokens, "repair_tokens": state.repair_tokens}
+                write_report({"time": now(), "line": state.line_no, "lemma": lemma_name_from_input(state.lemma),
+                              "result": "lemma_summary", **summary})
+                metrics.emit("lemma", source="pipeline", line=state.line_no, wall_s=round(time.monotonic() - t0, 3),
+                             success=state.solved, samples=len(state.recs), repair_rounds=state.rounds,
+                             tokens=state.tokens)
+            finally:
+                lemma_slots.release()
+
+        workers = [asyncio.create_task(verify_worker(c)) for c in checkers]
+        drivers = set()
+        with open(args.input, "r", encoding="utf-8") as fin:
+            for line_no, line in enumerate(fin, start=1):
+                try:
+                    item = json.loads(line)
+                except Exception as e:
+                    write_report({"line": line_no, "error": f"json_parse_error: {e}"})
+                    continue
+                stats["lemmas"] += 1
+                name = lemma_name_from_input(item.get("input", ""))
+                if name and name not in thy:
+                    # nothing generated for this lemma could be checked
+                    write_report({"line": line_no, "lemma": name,
+                                  "error": f"lemma_block_not_found_in_file: {thy_path.name}"})
+                    continue
+                await lemma_slots.acquire()
+                state = LemmaState(line_no, item, args.samples, args.per_lemma_inflight)
+                state.fs = select_fs(state.lemma)
+                t = asyncio.create_task(drive(state))
+                drivers.add(t)
+                t.add_done_callback(drivers.discard)
+
+        await asyncio.gather(*drivers)
+        for _ in workers:
+            await verify_q.put(None)
+        await asyncio.gather(*workers)
+    await client.close()
+    metrics.close()
+
+    print(f"[pipeline] {stats['lemmas']} lemmas, {stats['solved']} solved; "
+          f"{stats['generated']} generations + {stats['repairs']} repairs ({stats['gen_errors']} errors, {stats['gen_cancelled']} cancelled, "
+          f"{stats['gen_not_started']} not started); "
+          f"{stats['checks']} checks ({stats['checks_skipped']} skipped after success, "
+          f"{stats['checks_deduped']} duplicates); {policy.summary()}",
+          file=sys.stderr)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Generate proofs and check them as they arrive, stopping per lemma on success")
+    # generation (same flags as gen_proof.py)
+    ap.add_argument("--input", "-i", default="./data/lemmas_short.jsonl")
+    ap.add_argument("--gen-output", default="./results/gen_results/pipeline_proofs.jsonl")
+    ap.add_argument("--model", "-m", default="Qwen/Qwen2.5-Coder-7B-Instruct")
+    ap.add_argument("--base-url", nargs="+", default=[DEFAULT_BASE_URL],
+                    help="one or more OpenAI-compatible endpoints (space or comma separated)")
+    ap.add_argument("--temperature", type=float, default=0.7)
+    ap.add_argument("--top-p", type=float, default=0.8)
+    ap.add_argument("--fewshot-file", type=str, default='./data/lemmas_AInvs.jsonl')
+    ap.add_argument("--shots", type=int, default=4)
+    ap.add_argument("--fewshot-mode", choices=["first", "bm25"], default="first")
+    ap.add_argument("--fewshot-budget", type=int, default=1024, help="prompt-token budget of retrieved examples")
+    ap.add_argument("--fewshot-index", default=None, help="persisted BM25 index (gen_proof.py --fewshot-index)")
+    ap.add_argument("--samples", "-s", type=int, default=5, help="max generations per lemma and variant")
+    ap.add_argument("--max-concurrency", type=int, default=64, help="max in-flight LLM requests per endpoint")
+    ap.add_argument("--request-timeout", type=float, default=600,
+                    help="seconds per request attempt, including reading a streamed response")
+    ap.add_argument("--max-retries", type=int, default=5)
+    ap.add_argument("--min-concurrency", type=int, default=1, help="lower bound of the adaptive in-flight limit")
+    ap.add_argument("--fixed-concurrency", action="store_true")
+    ap.add_argument("--max-tokens-baseline", type=int, default=VARIANT_MAX_TOKENS["baseline_output"])
+    ap.add_argument("--max-tokens-cot", type=int, default=VARIANT_MAX_TOKENS["cot_output"])
+    ap.add_argument("--no-fence-stop", action="store_true")
+    ap.add_argument("--vllm-usage-stats", action="store_true", help="as gen_proof.py --vllm-usage-stats")
+    ap.add_argument("--llm-cache-dir", default=None, help="response cache directory (as gen_proof.py --cache-dir)")
+    ap.add_argument("--llm-cache-max-mb", type=int, default=1024)
+    # verification (same meaning as the eval.py flags)
+    ap.add_argument("--thy", required=True, help="Target .thy file to patch")
+    ap.add_argument("--session", required=True, help="Isabelle session name, e.g., CorresK")
+    ap.add_argument("--root", default=".", help="Isabelle project root for -d")
+    ap.add_argument("--report", default="./build_report.jsonl", help="Output JSONL report path")
+    ap.add_argument("--timeout", type=int, default=1800, help="Build timeout in seconds")
+    ap.add_argument("--backend", choices=["build", "server"], default="build")
+    ap.add_argument("--server-session", dest="server_session", default=None)
+    ap.add_argument("--verify-workers", dest="workers", type=int, default=1,
+                    help="Number of checkers running in parallel (each in its own scratch tree if > 1)")
+    ap.add_argument("--worker-threads", dest="worker_threads", type=int, default=None)
+    ap.add_argument("--worker-mem-gb", dest="worker_mem_gb", type=float, default=None)
+    ap.add_argument("--check-cache-dir", dest="cache_dir", default=None, help="Build result cache (eval.py --cache_dir)")
+    ap.add_argument("--check-cache-max-mb", dest="cache_max_mb", type=int, default=512)
+    ap.add_argument("--target-only", dest="target_only", action="store_true")
+    ap.add_argument("--no-prefilter", dest="no_prefilter", action="store_true")
+    ap.add_argument("--scratch-dir", dest="scratch_dir", default=None)
+    # scheduling
+    ap.add_argument("--max-lemmas", type=int, default=32, help="Lemmas being worked on at the same time")
+    ap.add_argument("--per-lemma-inflight", type=int, default=2,
+                    help="Candidates per lemma that may be generating or waiting for a verdict at once")
+    ap.add_argument("--no-early-stop", action="store_true",
+                    help="Generate and check every sample even after a lemma is solved")
+    ap.add_argument("--repair-rounds", type=int, default=0,
+                    help="Feed the first Isabelle error of a failed candidate back to the model up to this many "
+                         "times per candidate (0 = no repair)")
+    ap.add_argument("--repair-token-budget", type=int, default=0,
+                    help="Stop repairing a lemma once its repair requests used this many tokens (0 = no limit)")
+    ap.add_argument("--metrics", default=None, help="Append metrics events to this JSONL file")
+    ap.add_argument("--prometheus", default=None, help="Also keep Prometheus text-format metrics in this file")
+    ap.set_defaults(dry_run=False)
+    args = ap.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cheap static checks on an LLM candidate before any Isabelle build.
+
+`reject_reason(raw_output, code, input_text, reference)` returns None for a
+plausible candidate, or a (reason, detail) pair for one that cannot pass:
+  empty_output, unbalanced_fence, no_lemma_in_output, name_mismatch,
+  statement_mismatch, forbidden_command, unbalanced_quotes,
+  unbalanced_cartouches, unbalanced_parens, missing_proof,
+  unfinished_proof, unbalanced_proof_qed
+"""
+
+import re
+
+from thy_index import PROOF_KEYWORDS, ThyIndex, mask
+
+# Commands/attributes that would let a candidate cheat or escape the proof checker
+FORBIDDEN_WORDS = {
+    "sorry", "oops", "axiomatization", "axioms", "oracle", "quick_and_dirty", "skip_proof",
+    "cheat_tac", "ML", "ML_val", "ML_command", "ML_file", "ML_prf", "setup", "local_setup",
+    "method_setup", "attribute_setup", "declaration",
+}
+WORD_RE = re.compile(r"(?<![\w'.])[A-Za-z_][\w']*")
+TOKEN_RE = re.compile(r"\\<[^>]*>|[A-Za-z_][\w'.]*|\d+|\S")
+FENCE_OPEN_RE = re.compile(r"```isabelle")
+
+
+def tokens(s: str) -> list[str]:
+    return TOKEN_RE.findall(s)
+
+
+def _first_diff(a: list[str], b: list[str]) -> str:
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return f"token {i}: expected {x!r}, got {y!r}"
+    return f"expected {len(a)} tokens, got {len(b)}"
+
+
+def _syntax_problem(code: str, masked: str, entry) -> tuple[str, str] | None:
+    if masked.count('"') % 2:
+        return "unbalanced_quotes", "odd number of string quotes"
+    opens, closes = code.count("\\<open>"), code.count("\\<close>")
+    if opens != closes:
+        return "unbalanced_cartouches", f"{opens} \\<open> vs {closes} \\<close>"
+    for o, c in ("()", "[]"):
+        depth = 0
+        for ch in masked:
+            depth += (ch == o) - (ch == c)
+            if depth < 0:
+                break
+        if depth:
+            return "unbalanced_parens", f"unbalanced {o}{c}"
+
+    if entry.proof_start is None:
+        return "missing_proof", "no proof command after the statement"
+    proof = masked[entry.proof_start:entry.end]
+    words = WORD_RE.findall(proof)
+    if words.count("proof") != words.count("qed"):
+        return "unbalanced_proof_qed", f"{words.count('proof')} proof vs {words.count('qed')} qed"
+    last = [w for w in words if w in PROOF_KEYWORDS][-1:]
+    if last and last[0] in ("apply", "unfolding", "using", "including", "supply", "defer", "prefer"):
+        return "unfinished_proof", f"proof ends with '{last[0]}'"
+    return None
+
+
+def reject_reason(raw_output: str, code: str, input_text: str, reference=None) -> tuple[str, str] | None:
+    """
+    `reference` is the lemma's entry in the target theory (a thy_index.LemmaEntry);
+    when given, its statement is authoritative, since dataset inputs may be cut
+    short. Otherwise the statement is parsed from `input_text`.
+    """
+    if not code.strip():
+        return "empty_output", "no code extracted"
+    if raw_output.count("```") % 2 or (FENCE_OPEN_RE.search(raw_output) and raw_output.count("```") < 2):
+        return "unbalanced_fence", "unterminated ``` block"
+
+    cand = ThyIndex(code)
+    goals = [e for e in cand.entries if e.kind != "lemmas"]
+    if not goals:
+        detail = "no ```isabelle fence" if not FENCE_OPEN_RE.search(raw_output) else "no lemma block in code"
+        return "no_lemma_in_output", detail
+
+    target = [reference] if reference is not None else ThyIndex(input_text).entries[:1]
+    entry = goals[0]
+    if target:
+        expected = target[0]
+        entry = (cand.get(expected.name) or goals[0]) if expected.name else goals[0]
+        if expected.name and entry.name != expected.name:
+            return "name_mismatch", f"expected {expected.name}, got {entry.name}"
+        want, got = tokens(expected.statement), tokens(entry.statement)
+        if want != got:
+            return "statement_mismatch", _first_diff(want, got)
+
+    masked = mask(code)
+    forbidden = sorted(set(WORD_RE.findall(masked)) & FORBIDDEN_WORDS)
+    if forbidden:
+        return "forbidden_command", ", ".join(forbidden)
+
+    return _syntax_problem(code, masked, entry)
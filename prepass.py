@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tactic pre-pass: try stock proof methods on every lemma before any LLM call.
+
+For each lemma of --input that is found in --thy, the portfolio (--tactics,
+default DEFAULT_TACTICS) is tried in order on the original statement and the
+lemma counts as solved by the first method that passes. Templates containing
+{defs} are expanded with the `_def` theorems of the constants in the
+statement that have a `definition` somewhere under --root (at most
+--max-defs of them) and skipped when there are none.
+
+Checking reuses eval.py: --timeout is the limit per check, so it is the
+per-tactic timeout with --backend server (the session stays loaded) and
+per-tactic plus theory load with --target-only builds. With --batch every
+round packs one tactic per unsolved lemma into a single build (bisected on
+failure, see eval.check_rounds).
+
+Outputs:
+- --unsolved: the input lines the portfolio could not close, unchanged, to
+  feed to gen_proof.py / pipeline.py;
+- --solved: one gen_proof.py-style record per solved lemma, the proof in
+  "prepass_output" and the method in "tactic";
+- --report: eval.py report records for every check, with "tactic".
+
+Usage:
+  python3 prepass.py --input ./data/lemmas_short.jsonl \
+      --thy ./CorresK_Lemmas.thy --session CorresK --root . --target-only --timeout 120 \
+      --unsolved ./results/unsolved.jsonl --solved ./results/prepass_solved.jsonl
+  python3 gen_proof.py -i ./results/unsolved.jsonl ...
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+from pathlib import Path
+
+from eval import (check_in_order, check_rounds, error_record, iter_items, lemma_name_from_input, now, open_checkers,
+                  result_record)
+from isabelle_root import find_theories
+from metrics import Metrics
+from thy_index import ThyIndex, mask
+
+DEFAULT_TACTICS = [
+    "by simp",
+    "by auto",
+    "by blast",
+    "by wpsimp",
+    "by (simp add: {defs})",
+    "by (auto simp: {defs})",
+    "unfolding {defs} by blast",
+    "by (wpsimp simp: {defs})",
+]
+DEFINITION_RE = re.compile(r"(?m)^[ \t]*definition\b")
+DEFINED_NAME_RE = re.compile(r"\s+(?:\(\s*in\s+[\w'.]+\s*\)\s*)?\"?([A-Za-z][\w']*)")
+IDENT_RE = re.compile(r"[A-Za-z][\w']*")
+
+
+def defined_constants(root: Path) -> set[str]:
+    """Names introduced by `definition` in any theory under `root` (they have a NAME_def theorem)."""
+    names = set()
+    for p in find_theories(root):
+        try:
+            text = p.read_text(encoding="utf-8", errors="replace")
+        except OSError:
+            continue
+        # keyword found outside comments/strings, name read from the real text (it may be quoted)
+        for m in DEFINITION_RE.finditer(mask(text)):
+            nm = DEFINED_NAME_RE.match(text, m.end())
+            if nm:
+                names.add(nm.group(1))
+    return names
+
+
+def statement_defs(statement: str, defined: set[str], limit: int) -> list[str]:
+    """`_def` theorems of the defined constants in `statement`, in order of appearance."""
+    out = []
+    for name in IDENT_RE.findall(statement):
+        d = f"{name}_def"
+        if name in defined and d not in out:
+            out.append(d)
+    return out[:limit]
+
+
+def portfolio(tactics: list[str], defs: list[str]) -> list[str]:
+    out = []
+    for t in tactics:
+        if "{defs}" in t:
+            if not defs:
+                continue
+            t = t.replace("{defs}", " ".join(defs))
+        if t not in out:
+            out.append(t)
+    return out
+
+
+def plan_lemma(line_no: int, item: dict, thy: ThyIndex, tactics: list[str], defined: set[str], max_defs: int):
+    """Candidate slots (one per tactic) for one line, or None if its lemma is not in the theory."""
+    name = lemma_name_from_input(item.get("input", ""))
+    e = thy.get(name) if name else None
+    if e is None or e.proof_start is None:
+        return None
+    header = thy.text[e.start:e.proof_start].rstrip()
+    return [{"line": line_no, "variant": "tactic", "lemma": name, "tactic": t, "code": f"{header}\n  {t}\n"}
+            for t in portfolio(tactics, statement_defs(e.statement, defined, max_defs))]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Stock-tactic pre-pass before LLM generation")
+    ap.add_argument("--input", "-i", default="./data/lemmas_short.jsonl")
+    ap.add_argument("--unsolved", default="./results/prepass_unsolved.jsonl",
+                    help="Input lines not closed by any tactic (feed these to gen_proof.py)")
+    ap.add_argument("--solved", default="./results/prepass_solved.jsonl", help="Solved lemmas with their proof")
+    ap.add_argument("--report", default="./results/prepass_report.jsonl", help="Report record of every check")
+    ap.add_argument("--tactics", nargs="+", default=DEFAULT_TACTICS,
+                    help="Portfolio in order; {defs} expands to the statement's constant definitions")
+    ap.add_argument("--max-defs", type=int, default=4, help="At most this many *_def theorems per {defs}")
+    # verification (same meaning as the eval.py flags)
+    ap.add_argument("--thy", required=True, help="Target .thy file to patch")
+    ap.add_argument("--session", required=True, help="Isabelle session name, e.g., CorresK")
+    ap.add_argument("--root", default=".", help="Isabelle project root for -d")
+    ap.add_argument("--timeout", type=int, default=120, help="Seconds per check (= per tactic, or per batch build)")
+    ap.add_argument("--backend", choices=["build", "server"], default="build")
+    ap.add_argument("--server-session", dest="server_session", default=None)
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--worker-threads", dest="worker_threads", type=int, default=None)
+    ap.add_argument("--worker-mem-gb", dest="worker_mem_gb", type=float, default=None)
+    ap.add_argument("--batch", action="store_true", help="One build per round of one tactic per unsolved lemma")
+    ap.add_argument("--batch-size", dest="batch_size", type=int, default=0)
+    ap.add_argument("--cache-dir", dest="cache_dir", default=None)
+    ap.add_argument("--cache-max-mb", dest="cache_max_mb", type=int, default=512)
+    ap.add_argument("--target-only", dest="target_only", action="store_true")
+    ap.add_argument("--scratch-dir", dest="scratch_dir", default=None)
+    ap.add_argument("--metrics", default=None, help="Append per-build metrics events to this JSONL file")
+    ap.add_argument("--prometheus", default=None)
+    ap.set_defaults(dry_run=False, stop_on_success=True, no_prefilter=True)
+    args = ap.parse_args()
+
+    thy_path = Path(args.thy).resolve()
+    root_path = Path(args.root).resolve()
+    thy = ThyIndex.from_file(thy_path)
+    for p in (args.unsolved, args.solved, args.report):
+        if os.path.dirname(p):
+            os.makedirs(os.path.dirname(p), exist_ok=True)
+    t0 = time.monotonic()
+
+    needs_defs = any("{defs}" in t for t in args.tactics)
+    defined = defined_constants(root_path) if needs_defs else set()
+    items, plans = {}, {}
+    with open(args.report, "w", encoding="utf-8") as report:
+        for line_no, item, error in iter_items(Path(args.input)):
+            if error is not None:
+                report.write(json.dumps(error, ensure_ascii=False) + "\n")
+                continue
+            items[line_no] = item
+            slots = plan_lemma(line_no, item, thy, args.tactics, defined, args.max_defs)
+            if slots:
+                plans[line_no] = slots
+
+        metrics = Metrics(args.metrics, args.prometheus)
+        with open_checkers(args, thy, thy_path, root_path, metrics) as checkers:
+            # a batch build patches each lemma once, so batch queues are per lemma rather than per line
+            queues = {}
+            for line_no, slots in plans.items():
+                queues.setdefault(slots[0]["lemma"] if args.batch else line_no, deque()).extend(slots)
+            stats = (check_rounds if args.batch else check_in_order)(queues, thy, checkers, args, thy_path)
+            print(f"[prepass] {stats['candidates']} checks in {stats['builds']} builds", file=sys.stderr)
+        metrics.close()
+
+        solved = {}
+        for line_no, slots in plans.items():
+            for slot in slots:
+                v = slot.get("verdict")
+                if v is None:
+                    continue
+                if "error" in v:
+                    rec = error_record(line_no, "tactic", slot["lemma"], v["error"], args, thy_path)
+                else:
+                    rec = result_record(line_no, "tactic", slot["lemma"], v, args, thy_path)
+                    if v["returncode"] == 0 and line_no not in solved:
+                        solved[line_no] = slot
+                rec["tactic"] = slot["tactic"]
+                report.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    with open(args.solved, "w", encoding="utf-8") as fs, open(args.unsolved, "w", encoding="utf-8") as fu:
+        for line_no, item in items.items():
+            slot = solved.get(line_no)
+            if slot is None:
+                fu.write(json.dumps(item, ensure_ascii=False) + "\n")
+                continue
+            fs.write(json.dumps({"input": item.get("input"), "gt": item.get("gt"), "sample_id": 1,
+                                 "prepass_output": f"```isabelle\n{slot['code']}```", "tactic": slot["tactic"],
+                                 "time": now()}, ensure_ascii=False) + "\n")
+
+    print(f"[prepass] {len(items)} lemmas, {len(plans)} found in {thy_path.name}, {len(solved)} solved by the "
+          f"portfolio, {len(items) - len(solved)} left for generation ({time.monotonic() - t0:.0f}s)",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
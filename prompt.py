@@ -200,4 +200,27 @@ Input:
 {}
 
 Output:
-'''
\ No newline at end of file
+'''
+REPAIR_PROMPT = '''You are an Isabelle/seL4 proof assistant.
+Your previous proof of the lemma below was rejected by Isabelle.
+Use the error message and the remaining goal state to write a corrected proof.
+
+Requirements:
+- Wrap output strictly within ```isabelle ... ```.
+- Keep the lemma statement exactly as it is; only change the proof.
+- Do not write natural language, comments, or explanations.
+- Prefer concise seL4 style proofs (simp, auto, wpsimp, etc.).
+
+Input:
+{}
+
+Previous attempt:
+```isabelle
+{}
+```
+
+Isabelle error:
+{}
+
+Output:
+'''
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SQLite store for generation and verification results.
+
+`ingest` loads gen_proof.py / pipeline.py generation files and eval.py /
+pipeline.py / prepass.py reports into one database. Files are read
+incrementally: the byte offset reached is stored per file, so re-running
+ingest after a file grew only parses the new lines (a file that shrank or
+whose head changed is re-read from scratch). stdout/stderr tails go to a
+separate zlib-compressed `logs` table; candidates are indexed by
+(model, variant, lemma, sample_id), and per-(model, run, variant, lemma)
+attempt/success counts are kept up to date in `lemma_stats`, so `report`
+never touches the candidate rows.
+
+`report` prints, per model and variant, the lemmas attempted and solved and
+the unbiased pass@k estimate (Chen et al. 2021) averaged over the lemmas
+with at least k attempts. Candidates skipped after an earlier success
+(--stop_on_success, pipeline early stop) are not attempts, so pass@k is only
+meaningful for runs that checked every sample.
+
+Usage:
+  python3 results_db.py ingest --db results.db --model Qwen2.5-7B ./results/gen_results/qwen7b.jsonl
+  python3 results_db.py ingest --db results.db --model Qwen2.5-7B --gen ./results/gen_results/qwen7b.jsonl \
+      ./build_report.jsonl
+  python3 results_db.py report --db results.db --k 1 5
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from collections import defaultdict
+from pathlib import Path
+
+from eval import lemma_name_from_input
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY, path TEXT UNIQUE, kind TEXT, model TEXT, run TEXT,
+    offset INTEGER DEFAULT 0, head_sha TEXT, lines INTEGER DEFAULT 0, ingested REAL
+);
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY, file_id INTEGER, line INTEGER, model TEXT, run TEXT,
+    lemma TEXT, sample_id INTEGER, variant TEXT, output TEXT,
+    prompt_tokens INTEGER, completion_tokens INTEGER, error TEXT
+);
+CREATE TABLE IF NOT EXISTS candidates (
+    id INTEGER PRIMARY KEY, file_id INTEGER, line INTEGER, model TEXT, run TEXT,
+    variant TEXT, lemma TEXT, sample_id INTEGER, status TEXT, success INTEGER,
+    error TEXT, build_time REAL, session TEXT, thy TEXT, time TEXT, log_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS logs (id INTEGER PRIMARY KEY, data BLOB);
+CREATE TABLE IF NOT EXISTS lemma_stats (
+    model TEXT, run TEXT, variant TEXT, lemma TEXT, n INTEGER, c INTEGER,
+    PRIMARY KEY (model, run, variant, lemma)
+);
+CREATE INDEX IF NOT EXISTS candidates_key ON candidates (model, variant, lemma, sample_id);
+CREATE INDEX IF NOT EXISTS candidates_file ON candidates (file_id, line);
+CREATE INDEX IF NOT EXISTS generations_key ON generations (model, variant, lemma, sample_id);
+CREATE INDEX IF NOT EXISTS generations_file ON generations (file_id, line);
+"""
+HEAD_BYTES = 4096
+COUNTED = ("success", "failed", "error", "rejected")   # statuses that are attempts
+
+
+def connect(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def pass_at_k(n: int, c: int, k: int) -> float:
+    """Unbiased pass@k: 1 - C(n - c, k) / C(n, k), computed as a stable product."""
+    if n - c < k:
+        return 1.0
+    p = 1.0
+    for i in range(n - c + 1, n + 1):
+        p *= 1.0 - k / i
+    return 1.0 - p
+
+
+def detect_kind(path: Path) -> str | None:
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                continue
+            if "variant" in r or "success" in r:
+                return "report"
+            if "sample_id" in r and "input" in r:
+                return "gen"
+    return None
+
+
+def candidate_status(r: dict) -> str:
+    if r.get("result") == "skipped" or r.get("skipped"):
+        return "skipped"
+    if r.get("status") == "dry_run":
+        return "dry_run"
+    if r.get("result") == "rejected":
+        return "rejected"
+    if "error" in r:
+        return "error"
+    return "success" if r.get("success") else "failed"
+
+
+class Ingester:
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+        self.stats = defaultdict(lambda: [0, 0])      # (model, run, variant, lemma) -> [n, c] delta
+
+    def reset_file(self, file_id: int):
+        for model, run, variant, lemma, n, c in self.db.execute(
+                f"SELECT model, run, variant, lemma, COUNT(*), SUM(success) FROM candidates "
+                f"WHERE file_id = ? AND status IN ({','.join('?' * len(COUNTED))}) "
+                f"GROUP BY model, run, variant, lemma", (file_id, *COUNTED)):
+            d = self.stats[(model, run, variant, lemma)]
+            d[0] -= n
+            d[1] -= c or 0
+        self.db.execute("DELETE FROM logs WHERE id IN (SELECT log_id FROM candidates WHERE file_id = ?)", (file_id,))
+        self.db.execute("DELETE FROM candidates WHERE file_id = ?", (file_id,))
+        self.db.execute("DELETE FROM generations WHERE file_id = ?", (file_id,))
+
+    def add_gen(self, file_id: int, line: int, r: dict, model: str, run: str):
+        lemma = lemma_name_from_input(r.get("input") or "")
+        errors = r.get("errors") or {}
+        for key, value in r.items():
+            if not key.endswith("_output"):
+                continue
+            usage = (r.get("usage") or {}).get(key) or {}
+            err = errors.get(key)
+            self.db.execute(
+                "INSERT INTO generations (file_id, line, model, run, lemma, sample_id, variant, output, "
+                "prompt_tokens, completion_tokens, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (file_id, line, model, run, lemma, r.get("sample_id"), key, value,
+                 usage.get("prompt_tokens"), usage.get("completion_tokens"),
+                 json.dumps(err, ensure_ascii=False) if err else None))
+
+    def add_report(self, file_id: int, r: dict, model: str, run: str):
+        if "variant" not in r or not r.get("lemma"):
+            return      # json errors, lemma summaries, ...
+        status = candidate_status(r)
+        log_id = None
+        if r.get("stdout_tail") or r.get("stderr_tail"):
+            blob = zlib.compress(json.dumps({"stdout_tail": r.get("stdout_tail", ""),
+                                             "stderr_tail": r.get("stderr_tail", "")}).encode("utf-8"))
+            log_id = self.db.execute("INSERT INTO logs (data) VALUES (?)", (blob,)).lastrowid
+        success = 1 if status == "success" else 0 if status in COUNTED else None
+        self.db.execute(
+            "INSERT INTO candidates (file_id, line, model, run, variant, lemma, sample_id, status, success, error, "
+            "build_time, session, thy, time, log_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (file_id, r.get("line"), model, run, r["variant"], r["lemma"], r.get("sample_id"), status, success,
+             r.get("error") or r.get("reject_reason"), r.get("build_time"), r.get("session"), r.get("thy"),
+             r.get("time"), log_id))
+        if success is not None:
+            d = self.stats[(model, run, r["variant"], r["lemma"])]
+            d[0] += 1
+            d[1] += success
+
+    def flush_stats(self):
+        self.db.executemany(
+            "INSERT INTO lemma_stats (model, run, variant, lemma, n, c) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (model, run, variant, lemma) DO UPDATE SET n = n + excluded.n, c = c + excluded.c",
+            [(*key, n, c) for key, (n, c) in self.stats.items() if n or c])
+        self.db.execute("DELETE FROM lemma_stats WHERE n <= 0")
+        self.stats.clear()
+
+    def ingest(self, path: Path, kind: str | None, model: str, run: str) -> int:
+        """Reads the lines of `path` not ingested yet; returns how many records were added."""
+        key = str(path.resolve())
+        row = self.db.execute("SELECT id, kind, offset, head_sha, lines FROM files WHERE path = ?", (key,)).fetchone()
+        size = path.stat().st_size
+        if row is None:
+            kind = kind or detect_kind(path)
+            if kind is None:
+                return 0
+            file_id = self.db.execute("INSERT INTO files (path, kind, model, run) VALUES (?, ?, ?, ?)",
+                                      (key, kind, model, run)).lastrowid
+            offset, lines = 0, 0
+        else:
+            file_id, kind, offset, head_sha, lines = row
+            model, run = self.db.execute("SELECT model, run FROM files WHERE id = ?", (file_id,)).fetchone()
+            with path.open("rb") as f:
+                head = f.read(min(HEAD_BYTES, offset))
+            if size < offset or hashlib.sha1(head).hexdigest() != head_sha:
+                self.reset_file(file_id)
+                offset, lines = 0, 0
+
+        added = 0
+        with path.open("rb") as f:
+            f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break           # partial last line, picked up next time
+                offset += len(raw)
+                lines += 1
+                try:
+                    r = json.loads(raw)
+                except ValueError:
+                    continue
+                if kind == "gen":
+                    self.add_gen(file_id, lines, r, model, run)
+                else:
+                    self.add_report(file_id, r, model, run)
+                added += 1
+            f.seek(0)
+            head_sha = hashlib.sha1(f.read(min(HEAD_BYTES, offset))).hexdigest()
+        self.flush_stats()
+        self.db.execute("UPDATE files SET offset = ?, head_sha = ?, lines = ?, ingested = ? WHERE id = ?",
+                        (offset, head_sha, lines, time.time(), file_id))
+        return added
+
+    def link_samples(self, report: Path, gen: Path):
+        """Fills sample_id of report rows from the generation record on the same line of `gen`."""
+        ids = [self.db.execute("SELECT id FROM files WHERE path = ?", (str(p.resolve()),)).fetchone()
+               for p in (report, gen)]
+        if None in ids:
+            return
+        self.db.execute(
+            "UPDATE candidates SET sample_id = (SELECT g.sample_id FROM generations g WHERE g.file_id = ? "
+            "AND g.line = candidates.line LIMIT 1) WHERE file_id = ? AND sample_id IS NULL",
+            (ids[1][0], ids[0][0]))
+
+
+def report(db: sqlite3.Connection, ks: list[int], model: str | None = None, run: str | None = None) -> list[dict]:
+    where, params = [], []
+    for col, val in (("model", model), ("run", run)):
+        if val is not None:
+            where.append(f"{col} = ?")
+            params.append(val)
+    sql = ("SELECT model, variant, lemma, SUM(n), SUM(c) FROM lemma_stats "
+           + (f"WHERE {' AND '.join(where)} " if where else "") + "GROUP BY model, variant, lemma")
+    acc = {}
+    solved_any = defaultdict(set)
+    lemmas_any = defaultdict(set)
+    for m, variant, lemma, n, c in db.execute(sql, params):
+        a = acc.setdefault((m, variant), {"model": m, "variant": variant, "lemmas": 0, "candidates": 0,
+                                          "successes": 0, "solved": 0, "pass": {k: [0.0, 0] for k in ks}})
+        a["lemmas"] += 1
+        a["candidates"] += n
+        a["successes"] += c
+        a["solved"] += c > 0
+        lemmas_any[m].add(lemma)
+        if c > 0:
+            solved_any[m].add(lemma)
+        for k in ks:
+            if n >= k:
+                a["pass"][k][0] += pass_at_k(n, c, k)
+                a["pass"][k][1] += 1
+    rows = []
+    for (m, variant), a in sorted(acc.items()):
+        a["pass"] = {f"pass@{k}": (s / cnt if cnt else None) for k, (s, cnt) in a["pass"].items()}
+        rows.append(a)
+    for m in sorted(lemmas_any):
+        rows.append({"model": m, "variant": "*", "lemmas": len(lemmas_any[m]), "solved": len(solved_any[m])})
+    return rows
+
+
+def print_report(rows: list[dict], ks: list[int]):
+    head = f"{'model':28} {'variant':18} {'lemmas':>7} {'solved':>7} {'cands':>8} {'succ':>7}"
+    head += "".join(f" {'pass@' + str(k):>8}" for k in ks)
+    print(head)
+    for r in rows:
+        line = f"{str(r['model'])[:28]:28} {r['variant'][:18]:18} {r['lemmas']:>7} {r['solved']:>7}"
+        if r["variant"] == "*":
+            print(line)
+            continue
+        line += f" {r['candidates']:>8} {r['successes']:>7}"
+        for k in ks:
+            v = r["pass"][f"pass@{k}"]
+            line += f" {('-' if v is None else f'{v:.3f}'):>8}"
+        print(line)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Results store")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ip = sub.add_parser("ingest", help="add (the new lines of) generation and report JSONL files")
+    ip.add_argument("files", nargs="+")
+    ip.add_argument("--db", default="./results/results.db")
+    ip.add_argument("--model", default="unknown", help="model name recorded for these files (first ingest only)")
+    ip.add_argument("--run", default="", help="run/experiment label recorded for these files")
+    ip.add_argument("--kind", choices=["gen", "report"], default=None, help="default: detected from the records")
+    ip.add_argument("--gen", default=None, help="generation file the reports were evaluated from (fills sample_id)")
+    rp = sub.add_parser("report", help="success table and pass@k per model and variant")
+    rp.add_argument("--db", default="./results/results.db")
+    rp.add_argument("--k", type=int, nargs="+", default=[1, 5])
+    rp.add_argument("--model", default=None)
+    rp.add_argument("--run", default=None)
+    rp.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+
+    if args.cmd == "ingest" and os.path.dirname(args.db):
+        os.makedirs(os.path.dirname(args.db), exist_ok=True)
+    db = connect(args.db)
+    if args.cmd == "ingest":
+        ing = Ingester(db)
+        gen = Path(args.gen) if args.gen else None
+        if gen is not None and str(gen) not in args.files:
+            with db:
+                ing.ingest(gen, "gen", args.model, args.run)
+        for f in args.files:
+            t0 = time.monotonic()
+            with db:
+                n = ing.ingest(Path(f), args.kind, args.model, args.run)
+                if gen is not None and Path(f) != gen:
+                    ing.link_samples(Path(f), gen)
+            print(f"[results_db] {f}: {n} new records ({time.monotonic() - t0:.1f}s)", file=sys.stderr)
+    else:
+        t0 = time.monotonic()
+        rows = report(db, args.k, args.model, args.run)
+        if args.json:
+            print(json.dumps(rows, indent=2))
+        else:
+            print_report(rows, args.k)
+        print(f"[results_db] report in {(time.monotonic() - t0) * 1000:.0f} ms", file=sys.stderr)
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
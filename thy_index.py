@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Lightweight structural scanning of Isabelle .thy files.
+
+This is not an Isabelle parser: it masks strings, cartouches and comments and
+then relies on indentation, the way seL4/l4v theories are laid out (top-level
+commands at the block's own indentation, proof commands indented further or
+starting with a proof keyword).
+
+`ThyIndex` parses a theory once into a table of named blocks
+(lemma/theorem/corollary/proposition/schematic_goal/lemmas) with offsets,
+attributes and statement text, for O(1) lookup and splice-based patching.
+`build_index` does the same over several files.
+"""
+
+import re
+from pathlib import Path
+from typing import NamedTuple
+
+GOAL_COMMANDS = ("lemma", "theorem", "corollary", "proposition", "schematic_goal")
+FACT_COMMANDS = ("lemmas",)
+BLOCK_COMMANDS = GOAL_COMMANDS + FACT_COMMANDS
+PROOF_KEYWORDS = {
+    "by", "apply", "apply_end", "proof", "unfolding", "using", "including", "supply",
+    "done", "oops", "sorry", "qed", "defer", "prefer", "subgoal", "back", "next",
+}
+# Keywords that may start a continuation line of a goal statement
+STATEMENT_KEYWORDS = {
+    "assumes", "shows", "fixes", "and", "obtains", "for", "includes", "notes", "defines",
+    "constrains", "if", "where", "is",
+}
+
+BLOCK_START_RE = re.compile(r"(?m)^([ \t]*)(" + "|".join(sorted(BLOCK_COMMANDS, reverse=True)) + r")\b")
+PROOF_START_RE = re.compile(r"(?<![\w'.])(" + "|".join(sorted(PROOF_KEYWORDS)) + r")(?![\w'])")
+LINE_WORD_RE = re.compile(r"[ \t]*([A-Za-z_][\w']*)")
+THEORY_BEGIN_RE = re.compile(r"\bbegin\b")
+# After the command keyword: optional `(in locale)`, optional name, optional attributes
+HEADER_RE = re.compile(r"\s*(?:\(\s*in\s+[\w'.]+\s*\)\s*)?(?:([\w'.]+)\s*(?=[\[:=]))?")
+
+
+def mask(text: str) -> str:
+    """
+    Same length as `text`, with the contents of strings, cartouches and
+    (nested) comments blanked out. Newlines and the delimiters of strings and
+    cartouches are kept, so offsets and line numbers stay valid.
+    """
+    out = list(text)
+    i, n = 0, len(text)
+
+    def blank(a, b):
+        for j in range(a, b):
+            if out[j] != "\n":
+                out[j] = " "
+
+    while i < n:
+        if text.startswith("(*", i):
+            depth, j = 1, i + 2
+            while j < n and depth:
+                if text.startswith("(*", j):
+                    depth, j = depth + 1, j + 2
+                elif text.startswith("*)", j):
+                    depth, j = depth - 1, j + 2
+                else:
+                    j += 1
+            blank(i, j)
+            i = j
+        elif text[i] in "\"`":
+            q, j = text[i], i + 1
+            while j < n and text[j] != q:
+                j += 2 if text[j] == "\\" else 1
+            blank(i + 1, j)
+            i = j + 1
+        elif text.startswith("\\<open>", i):
+            depth, j = 1, i + 7
+            while j < n and depth:
+                if text.startswith("\\<open>", j):
+                    depth, j = depth + 1, j + 7
+                elif text.startswith("\\<close>", j):
+                    depth, j = depth - 1, j + 8
+                else:
+                    j += 1
+            blank(i + 7, j - 8 if not depth else j)
+            i = j
+        else:
+            i += 1
+    return "".join(out)
+
+
+def iter_blocks(text: str, masked: str | None = None):
+    """
+    Yields (kind, start, proof_start, end) for every goal command
+    (lemma/theorem/...) and `lemmas` declaration in `text`. `end` is just past
+    the newline of the last non-blank line of the block; `proof_start` is None
+    for a block without proof.
+    """
+    masked = mask(text) if masked is None else masked
+    for m in BLOCK_START_RE.finditer(masked):
+        indent = len(m.group(1).expandtabs())
+        start, kind = m.start(2), m.group(2)
+
+        # The block ends at the next goal command, or at the first later line that
+        # is not indented deeper and does not continue a statement or proof
+        first_nl = masked.find("\n", start)
+        pos = last_content = len(text) if first_nl < 0 else first_nl + 1
+        while pos < len(text):
+            nl = masked.find("\n", pos)
+            line_end = len(text) if nl < 0 else nl + 1
+            line = masked[pos:line_end]
+            if line.strip():
+                wm = LINE_WORD_RE.match(line)
+                word = wm.group(1) if wm else None
+                line_indent = len(line.expandtabs()) - len(line.expandtabs().lstrip())
+                if word in BLOCK_COMMANDS:
+                    break
+                if (line_indent <= indent and word is not None
+                        and word not in PROOF_KEYWORDS and word not in STATEMENT_KEYWORDS):
+                    break
+                last_content = line_end
+            pos = line_end
+        end = last_content
+
+        pm = None if kind in FACT_COMMANDS else PROOF_START_RE.search(masked, m.end(2), end)
+        yield kind, start, (pm.start() if pm else None), end
+
+
+def iter_goal_blocks(text: str, masked: str | None = None):
+    """Like iter_blocks, restricted to goal commands (blocks that carry a proof)."""
+    for block in iter_blocks(text, masked):
+        if block[0] in GOAL_COMMANDS:
+            yield block
+
+
+def _split_attributes(s: str) -> list[str]:
+    attrs, depth, cur = [], 0, []
+    for ch in s:
+        if ch in "[(":
+            depth += 1
+        elif ch in "])":
+            depth -= 1
+        if ch == "," and depth == 0:
+            attrs.append("".join(cur).strip())
+            cur = []
+        else:
+            cur.append(ch)
+    if "".join(cur).strip():
+        attrs.append("".join(cur).strip())
+    return attrs
+
+
+class LemmaEntry(NamedTuple):
+    name: str | None
+    kind: str
+    start: int
+    end: int
+    proof_start: int | None
+    attributes: list[str]
+    statement: str
+    file: str | None = None
+
+
+def parse_block(text: str, masked: str, kind: str, start: int, proof_start: int | None, end: int,
+                file: str | None = None) -> LemmaEntry:
+    pos = start + len(kind)
+    hm = HEADER_RE.match(masked, pos)
+    name = hm.group(1) if hm and hm.group(1) else None
+    pos = hm.end() if hm else pos
+
+    attributes = []
+    if masked.startswith("[", pos):
+        depth, j = 0, pos
+        while j < end:
+            depth += {"[": 1, "]": -1}.get(masked[j], 0)
+            j += 1
+            if depth == 0:
+                break
+        attributes = _split_attributes(text[pos + 1:j - 1])
+        pos = j
+    sep = re.compile(r"\s*[:=]").match(masked, pos)
+    if sep:
+        pos = sep.end()
+    stmt_end = proof_start if proof_start is not None else end
+    return LemmaEntry(name, kind, start, end, proof_start, attributes, text[pos:stmt_end].strip(), file)
+
+
+class ThyIndex:
+    """
+    One-time parse of a theory text into named blocks.
+
+    Unnamed blocks are kept in `entries` but are not addressable by name; if a
+    name occurs twice (e.g. in two contexts) the first block wins.
+    """
+    def __init__(self, text: str, file: str | None = None):
+        self.text = text
+        self.file = file
+        masked = mask(text)
+        self.entries = [parse_block(text, masked, *b, file=file) for b in iter_blocks(text, masked)]
+        self.by_name: dict[str, LemmaEntry] = {}
+        for e in self.entries:
+            if e.name and e.name not in self.by_name:
+                self.by_name[e.name] = e
+
+    @classmethod
+    def from_file(cls, path) -> "ThyIndex":
+        return cls(Path(path).read_text(encoding="utf-8"), file=str(path))
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.by_name
+
+    def get(self, name: str) -> LemmaEntry | None:
+        return self.by_name.get(name)
+
+    def block(self, name: str) -> str:
+        e = self.by_name[name]
+        return self.text[e.start:e.end]
+
+    def replace(self, blocks: dict[str, str]) -> tuple[str, dict[str, tuple[int, int]]]:
+        """
+        Splices new text for several named blocks into the theory in one pass.
+        Returns (new_text, {name: (first_line, last_line)}) with the 1-based line
+        span of every replaced block in the new text; unknown names are skipped.
+        """
+        found = sorted((self.by_name[n].start, self.by_name[n].end, n, b) for n, b in blocks.items()
+                       if n in self.by_name)
+        parts, spans, pos, line = [], {}, 0, 1
+        for start, end, name, block in found:
+            if not block.endswith("\n"):
+                block += "\n"
+            parts.append(self.text[pos:start])
+            line += self.text.count("\n", pos, start)
+            parts.append(block)
+            n_lines = block.count("\n")
+            spans[name] = (line, line + n_lines - 1)
+            line += n_lines
+            pos = end
+        parts.append(self.text[pos:])
+        return "".join(parts), spans
+
+
+def build_index(paths) -> dict[str, LemmaEntry]:
+    """Lemma name -> entry over several .thy files (first definition wins)."""
+    table: dict[str, LemmaEntry] = {}
+    for p in paths:
+        for name, e in ThyIndex.from_file(p).by_name.items():
+            table.setdefault(name, e)
+    return table
+
+
+def sorry_proofs(text: str, keep) -> str:
+    """
+    Replaces the proof of every goal block whose start offset is not in `keep`
+    by `sorry`, padded with the removed newlines so every line keeps its number,
+    and enables quick_and_dirty right after the theory's `begin`.
+    """
+    masked = mask(text)
+    parts, pos = [], 0
+    for kind, start, proof_start, end in iter_goal_blocks(text, masked):
+        if start in keep or proof_start is None:
+            continue
+        parts.append(text[pos:proof_start])
+        parts.append("sorry" + "\n" * text.count("\n", proof_start, end))
+        pos = end
+    parts.append(text[pos:])
+    out = "".join(parts)
+
+    m = THEORY_BEGIN_RE.search(mask(out))
+    if m:
+        out = out[:m.end()] + " declare [[quick_and_dirty]]" + out[m.end():]
+    return out